@@ -0,0 +1,650 @@
+# Copyright (C) 2018 Leiden University Medical Center
+# This file is part of pytest-workflow
+#
+# pytest-workflow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# pytest-workflow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+
+"""
+Executors launch the commands of workflows. The local executor runs them in
+a subprocess. The remote executor submits them to a worker daemon, which can
+run on another machine that shares the filesystem with the test session. The
+batch executor submits them as array jobs to a batch scheduler.
+Other executors can be provided with the pytest_workflow_executor hook.
+
+A worker daemon is started with:
+``python -m pytest_workflow.executors --listen HOST:PORT``
+Every request to the daemon carries a shared token, which is read from the
+PYTEST_WORKFLOW_TOKEN environment variable.
+"""
+
+import abc
+import argparse
+import hmac
+import itertools
+import json
+import os
+import secrets
+import shlex
+import signal
+import socket
+import socketserver
+import subprocess  # nosec: security implications have been considered
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .util import parse_address
+
+# The environment variable with the token that is shared by the worker
+# daemon and the remote executors.
+TOKEN_VARIABLE = "PYTEST_WORKFLOW_TOKEN"
+
+
+class Job(abc.ABC):
+    """A command that was launched by an executor."""
+
+    @property
+    @abc.abstractmethod
+    def returncode(self) -> Optional[int]:
+        """The exit code of the command, or None if it has not finished."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def wait(self, timeout: Optional[float] = None) -> int:
+        """
+        Waits for the command to finish.
+        :param timeout: The number of seconds to wait. No limit if None.
+        :return: The exit code of the command.
+        :raises subprocess.TimeoutExpired: when the command has not finished
+        within the timeout.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def signal(self, signal_number: int):
+        """Sends a signal to the command and all processes it started. Does
+        nothing when these have already exited."""
+        raise NotImplementedError
+
+    def add_done_callback(self,
+                          callback: Callable[[Optional[Exception]], Any]):
+        """
+        Calls a function when the command has finished. By default the job
+        is waited on in a separate thread. Jobs that are monitored together
+        can override this, so no thread is needed per job.
+        :param callback: Called with the error that occurred while waiting
+        on the command, or None.
+        """
+        def wait():
+            try:
+                self.wait()
+            except Exception as error:
+                callback(error)
+            else:
+                callback(None)
+
+        threading.Thread(target=wait, daemon=True).start()
+
+
+class Executor(abc.ABC):
+    """Launches the commands of workflows."""
+
+    @abc.abstractmethod
+    def submit(self, args: List[str], cwd: Path, stdout_file: Path,
+               stderr_file: Path) -> Job:
+        """
+        Launches a command in the background.
+        :param args: The command and its arguments
+        :param cwd: The directory the command is run in
+        :param stdout_file: The file the stdout of the command is written to.
+        It should exist once the command has finished.
+        :param stderr_file: The file the stderr of the command is written to.
+        It should exist once the command has finished.
+        :return: The job, which is used to wait on and kill the command.
+        """
+        raise NotImplementedError
+
+
+class LocalJob(Job):
+    """A command that runs in a subprocess on this machine."""
+
+    def __init__(self, popen: subprocess.Popen):
+        self.popen = popen
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.popen.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        return self.popen.wait(timeout)
+
+    def signal(self, signal_number: int):
+        if self.popen.returncode is not None:
+            # The command has been reaped. Its process group id may already
+            # be used by other processes.
+            return
+        try:
+            os.killpg(self.popen.pid, signal_number)
+        except (ProcessLookupError, PermissionError):
+            # All processes of the command have already exited.
+            pass
+
+
+class LocalExecutor(Executor):
+    """Runs commands in a subprocess on this machine. This is the default
+    executor."""
+
+    def submit(self, args: List[str], cwd: Path, stdout_file: Path,
+               stderr_file: Path) -> LocalJob:
+        with stdout_file.open("wb") as stdout_h, \
+                stderr_file.open("wb") as stderr_h:
+            # The command runs in its own process group. So all processes it
+            # starts can be killed together.
+            return LocalJob(subprocess.Popen(  # nosec: Shell is not enabled.
+                args, stdout=stdout_h, stderr=stderr_h, cwd=str(cwd),
+                start_new_session=True))
+
+
+class RemoteJob(Job):
+    """A command that runs on a worker daemon. Its status is polled until it
+    has finished, after which the daemon forgets the job."""
+
+    def __init__(self, executor: "RemoteExecutor", job_id: str,
+                 args: List[str], stdout_file: Path, stderr_file: Path):
+        self.executor = executor
+        self.job_id = job_id
+        self.args = args
+        self.stdout_file = stdout_file
+        self.stderr_file = stderr_file
+        self._returncode: Optional[int] = None
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        start_time = time.monotonic()
+        while self._returncode is None:
+            status = self.executor.request(action="status", job=self.job_id)
+            if status["returncode"] is not None:
+                self.executor.request(action="forget", job=self.job_id)
+                self._returncode = status["returncode"]
+                break
+            if (timeout is not None and
+                    time.monotonic() - start_time >= timeout):
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(self.executor.poll_interval_secs)
+        return self._returncode
+
+    def signal(self, signal_number: int):
+        if self._returncode is None:
+            self.executor.request(action="signal", job=self.job_id,
+                                  signal=int(signal_number))
+
+
+class RemoteExecutor(Executor):
+    """Submits commands to a worker daemon over a socket. The daemon runs
+    the commands in the same directories and writes their stdout and stderr
+    to the same files, so it should share the filesystem with the test
+    session."""
+
+    def __init__(self, address: Tuple[str, int], token: str,
+                 poll_interval_secs: float = 0.5):
+        """
+        :param address: The host and port of the worker daemon
+        :param token: The token of the worker daemon
+        :param poll_interval_secs: How often the status of a running command
+        is requested.
+        """
+        self.address = address
+        self.token = token
+        self.poll_interval_secs = poll_interval_secs
+
+    def request(self, **message: Any) -> Dict[str, Any]:
+        """Sends a request to the worker daemon and returns its answer."""
+        request = dict(message, token=self.token)
+        with socket.create_connection(self.address) as connection:
+            connection.sendall(json.dumps(request).encode() + b"\n")
+            with connection.makefile("rb") as answers:
+                answer = json.loads(answers.readline())
+        if "error" in answer:
+            raise RuntimeError(f"The worker daemon at "
+                               f"{self.address[0]}:{self.address[1]} could "
+                               f"not {message['action']}: {answer['error']}")
+        return answer
+
+    def submit(self, args: List[str], cwd: Path, stdout_file: Path,
+               stderr_file: Path) -> RemoteJob:
+        # The daemon opens the files before it answers, so they exist right
+        # away, like with a local command.
+        answer = self.request(action="submit", args=args,
+                              cwd=str(cwd.absolute()),
+                              stdout=str(stdout_file.absolute()),
+                              stderr=str(stderr_file.absolute()))
+        return RemoteJob(self, answer["job"], args, stdout_file, stderr_file)
+
+
+# The task script of a workflow in an array job. It runs the command in the
+# background, so it can pass on the signals that are written to the signal
+# file. The exit code is written to the status file when the command has
+# finished, or when the scheduler terminates the task. The status file is
+# moved in place, so it is never read half written. The started file is
+# written before the signal file is checked, so a task that is killed
+# before it starts never runs its command.
+TASK_SCRIPT = """\
+#!/usr/bin/env bash
+finish() {{
+    echo "$1" > {status}.tmp && mv {status}.tmp {status}
+    exit "$1"
+}}
+terminated() {{
+    kill -"$1" "${{pid:-}}" 2> /dev/null
+    finish $((128 + $1))
+}}
+trap 'terminated 15' TERM
+trap 'terminated 2' INT
+touch {started}
+cd {cwd} || finish 1
+if [ -f {signal} ]; then
+    finish $((128 + $(cat {signal})))
+fi
+{command} > {stdout} 2> {stderr} &
+pid=$!
+(
+    while kill -0 "$pid" 2> /dev/null; do
+        if [ -f {signal} ]; then
+            kill -"$(cat {signal})" "$pid" 2> /dev/null
+        fi
+        sleep 1
+    done
+) &
+wait "$pid"
+finish $?
+"""
+
+
+class BatchJob(Job):
+    """A command that runs as a task of an array job. The task writes its
+    exit code to a status file, which is checked by the executor. The
+    callbacks are called by the thread of the executor that checks the
+    status files."""
+
+    def __init__(self, executor: "BatchExecutor", args: List[str],
+                 name: str):
+        """
+        :param executor: The executor that submits the task
+        :param args: The command and its arguments
+        :param name: The name of the task. The files of the task are named
+        after it in the batch directory of the executor.
+        """
+        self.executor = executor
+        self.args = args
+        self.script = executor.batch_dir / f"{name}.sh"
+        self.status_file = executor.batch_dir / f"{name}.exit"
+        self.signal_file = executor.batch_dir / f"{name}.signal"
+        self.started_file = executor.batch_dir / f"{name}.started"
+        # The id of the array job and the index of the task in it. The id is
+        # None if it could not be read from the output of the submit
+        # command.
+        self.array_id: Optional[str] = None
+        self.task_index: Optional[int] = None
+        # Set when the array job could not be submitted.
+        self.error: Optional[Exception] = None
+        self._returncode: Optional[int] = None
+        self._finished = threading.Event()
+        self._callbacks: List[Callable[[Optional[Exception]], Any]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._returncode
+
+    def add_done_callback(self,
+                          callback: Callable[[Optional[Exception]], Any]):
+        with self._lock:
+            if not self.finished:
+                self._callbacks.append(callback)
+                return
+        callback(self.error)
+
+    @property
+    def finished(self) -> bool:
+        """Whether the task has finished or could not be submitted."""
+        return self._finished.is_set()
+
+    @property
+    def started(self) -> bool:
+        """Whether the task has been started by the scheduler."""
+        return self.started_file.exists()
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if not self._finished.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args,
+                                            timeout)  # type: ignore
+        if self.error is not None:
+            raise self.error
+        return self._returncode  # type: ignore
+
+    def signal(self, signal_number: int):
+        """The signal is passed on by the task. A task that has not started
+        yet is cancelled, and exits right away if it starts anyway. SIGKILL
+        can not be handled by the task, so the task is cancelled and the job
+        is finished right away."""
+        self.executor.signal(self, signal_number)
+
+    def check(self):
+        """Reads the exit code from the status file, if the task has
+        finished."""
+        if self.status_file.exists():
+            self.finish(int(self.status_file.read_text()))
+
+    def finish(self, returncode: int):
+        """Marks the task as finished with an exit code. Only the first exit
+        code is kept."""
+        self._finish(returncode, None)
+
+    def fail(self, error: Exception):
+        """Marks the task as finished, because it could not be submitted."""
+        self._finish(None, error)
+
+    def _finish(self, returncode: Optional[int], error: Optional[Exception]):
+        """Marks the task as finished and calls the callbacks, once."""
+        with self._lock:
+            if self.finished:
+                return
+            self._returncode = returncode
+            self.error = error
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        # The callbacks are called without holding any locks, as they may
+        # signal other jobs.
+        for callback in callbacks:
+            callback(error)
+
+
+class BatchExecutor(Executor):
+    """Submits commands to a batch scheduler, such as Slurm. Each command is
+    written to a task script in the batch directory. The
+    commands that are submitted within an interval are submitted together as
+    one array job. The executor checks the status files the tasks write in
+    one thread, which also calls the callbacks of the finished jobs. So no
+    thread waits on each job separately. The batch
+    scheduler should share the filesystem with the test session."""
+
+    def __init__(self, submit_command: str, batch_dir: Path,
+                 task_variable: str = "SLURM_ARRAY_TASK_ID",
+                 cancel_command: Optional[str] = None,
+                 poll_interval_secs: float = 2.0):
+        """
+        :param submit_command: The command that submits an array job, such as
+        'sbatch --array=0-{last}'. {size} is replaced with the number of
+        tasks and {last} with the index of the last task. The path of the
+        array job script is appended. The last word of its output is used
+        as the id of the array job, such as '1234' in 'Submitted batch job
+        1234'.
+        :param batch_dir: The directory the array job scripts and the files
+        of the tasks are written to. These are kept out of the working
+        directories, which are linked into the directories of the workflows
+        that depend on them.
+        :param task_variable: The environment variable with the index of the
+        task in the array job, starting at 0.
+        :param cancel_command: The command that cancels a task of an array
+        job, such as 'scancel {job}_{task}'. {job} is replaced with the id
+        of the array job and {task} with the index of the task. Killed tasks
+        are not cancelled if None.
+        :param poll_interval_secs: How often the status files are checked.
+        The commands that are submitted within this interval are submitted
+        as one array job.
+        """
+        self.submit_command = submit_command
+        self.batch_dir = batch_dir
+        self.task_variable = task_variable
+        self.cancel_command = cancel_command
+        self.poll_interval_secs = poll_interval_secs
+        # The jobs that are not submitted yet, and the jobs that are
+        # submitted and have not finished.
+        self._pending: List[BatchJob] = []
+        self._submitted: List[BatchJob] = []
+        self._lock = threading.Lock()
+        self._monitor: Optional[threading.Thread] = None
+        self._arrays = itertools.count()
+        self._tasks = itertools.count()
+
+    def submit(self, args: List[str], cwd: Path, stdout_file: Path,
+               stderr_file: Path) -> BatchJob:
+        # The name of the working directory makes the files easy to find.
+        self.batch_dir.mkdir(parents=True, exist_ok=True)
+        job = BatchJob(self, args,
+                       f"{next(self._tasks)}_{cwd.absolute().name}")
+        for stale_file in (job.status_file, job.signal_file,
+                           job.started_file):
+            if stale_file.exists():
+                stale_file.unlink()
+        # The files exist right away, like with a local command.
+        stdout_file.write_bytes(b"")
+        stderr_file.write_bytes(b"")
+        job.script.write_text(TASK_SCRIPT.format(
+            cwd=shlex.quote(str(cwd.absolute())),
+            command=" ".join(shlex.quote(arg) for arg in args),
+            stdout=shlex.quote(str(stdout_file.absolute())),
+            stderr=shlex.quote(str(stderr_file.absolute())),
+            status=shlex.quote(str(job.status_file.absolute())),
+            signal=shlex.quote(str(job.signal_file.absolute())),
+            started=shlex.quote(str(job.started_file.absolute()))))
+        with self._lock:
+            self._pending.append(job)
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._monitor_jobs,
+                                                 daemon=True)
+                self._monitor.start()
+        return job
+
+    def signal(self, job: BatchJob, signal_number: int):
+        """Passes a signal on to a task. Tasks that will not handle the
+        signal are finished right away, so nothing waits on them."""
+        with self._lock:
+            if job.finished:
+                return
+            if job in self._pending:
+                # The job was never submitted.
+                self._pending.remove(job)
+                job.finish(128 + signal_number)
+                return
+        # The signal file is written before checking whether the task has
+        # started. A task that starts in between reads the signal file.
+        job.signal_file.write_text(str(int(signal_number)))
+        if signal_number == signal.SIGKILL or not job.started:
+            self._cancel(job)
+            job.finish(128 + signal_number)
+
+    def _cancel(self, job: BatchJob):
+        """Cancels a task with the cancel command, if there is one."""
+        if self.cancel_command is None or job.array_id is None:
+            return
+        command = shlex.split(self.cancel_command.format(
+            job=job.array_id, task=job.task_index))
+        try:
+            subprocess.run(  # nosec: Shell is not enabled.
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            # The task exits when it starts, as it reads the signal file.
+            pass
+
+    def _monitor_jobs(self):
+        """Submits the pending jobs and checks the status files of the
+        submitted jobs, until all jobs have finished."""
+        while True:
+            time.sleep(self.poll_interval_secs)
+            with self._lock:
+                pending, self._pending = self._pending, []
+                self._submitted.extend(pending)
+            if pending:
+                self._submit_array(pending)
+            with self._lock:
+                submitted = list(self._submitted)
+            # The callbacks of finished jobs may signal other jobs, so the
+            # lock is not held while checking.
+            for job in submitted:
+                if not job.finished:
+                    job.check()
+            with self._lock:
+                self._submitted = [job for job in self._submitted
+                                   if not job.finished]
+                if not (self._pending or self._submitted):
+                    self._monitor = None
+                    return
+
+    def _submit_array(self, jobs: List[BatchJob]):
+        """Submits the jobs as one array job. The jobs fail when the submit
+        command fails."""
+        self.batch_dir.mkdir(parents=True, exist_ok=True)
+        array_script = self.batch_dir / f"array_{next(self._arrays)}.sh"
+        scripts = "".join(f"    {shlex.quote(str(job.script.absolute()))}\n"
+                          for job in jobs)
+        array_script.write_text(
+            f"#!/usr/bin/env bash\n"
+            f"scripts=(\n{scripts})\n"
+            f"exec bash \"${{scripts[${self.task_variable}]}}\"\n")
+        command = shlex.split(self.submit_command.format(
+            size=len(jobs), last=len(jobs) - 1)) + [str(array_script)]
+        try:
+            process = subprocess.run(  # nosec: Shell is not enabled.
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as error:
+            for job in jobs:
+                job.fail(error)
+            return
+        if process.returncode != 0:
+            failure = RuntimeError(
+                f"Submitting the array job with '{' '.join(command)}' "
+                f"failed: {process.stderr.decode(errors='replace').strip()}")
+            for job in jobs:
+                job.fail(failure)
+            return
+        # For example 'Submitted batch job 1234', or '1234;cluster' with
+        # sbatch --parsable.
+        words = process.stdout.decode(errors="replace").split()
+        array_id = words[-1].split(";")[0] if words else None
+        for index, job in enumerate(jobs):
+            job.array_id = array_id
+            job.task_index = index
+
+
+class _WorkerRequestHandler(socketserver.StreamRequestHandler):
+    """Answers one request of a remote executor."""
+
+    server: "WorkerDaemon"
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            answer = self.server.answer(message)
+        except Exception as error:
+            answer = {"error": str(error)}
+        self.wfile.write(json.dumps(answer).encode() + b"\n")
+
+
+class WorkerDaemon(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Runs the commands that remote executors submit. Each request is a
+    line of JSON with an action: submit, status, signal or forget,
+    and the token of the daemon. Requests with another token are refused.
+    The token is sent in plain text, so only listen on trusted networks."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0),
+                 token: Optional[str] = None):
+        """
+        :param address: The host and port to listen on. Port 0 picks a free
+        port.
+        :param token: The token the requests should carry. A random token
+        is generated if None.
+        """
+        if token == "":
+            raise ValueError("The token of the worker daemon can not be "
+                             "empty.")
+        self.token = token or secrets.token_urlsafe(32)
+        super().__init__(address, _WorkerRequestHandler)
+        self._jobs: Dict[str, LocalJob] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._executor = LocalExecutor()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """The host and port the daemon listens on."""
+        host, port = self.server_address[:2]
+        return str(host), port
+
+    def answer(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Carries out a request."""
+        if not hmac.compare_digest(str(message.get("token", "")).encode(),
+                                   self.token.encode()):
+            raise ValueError("Invalid token")
+        action = message["action"]
+        if action == "submit":
+            with self._lock:
+                job_id = str(next(self._ids))
+            self._jobs[job_id] = self._executor.submit(
+                message["args"], Path(message["cwd"]),
+                Path(message["stdout"]), Path(message["stderr"]))
+            return {"job": job_id}
+        job_id = message["job"]
+        if job_id not in self._jobs:
+            raise ValueError(f"Unknown job: '{job_id}'")
+        job = self._jobs[job_id]
+        if action == "status":
+            return {"returncode": job.popen.poll()}
+        elif action == "signal":
+            job.signal(message["signal"])
+            return {}
+        elif action == "forget":
+            del self._jobs[job_id]
+            return {}
+        raise ValueError(f"Unknown action: '{action}'")
+
+    def server_close(self):
+        """Kills the commands that are still running."""
+        super().server_close()
+        for job in self._jobs.values():
+            job.signal(signal.SIGKILL)
+
+
+def main(args: Optional[List[str]] = None):
+    """Runs a worker daemon until it is interrupted."""
+    parser = argparse.ArgumentParser(
+        description="Runs the workflows that pytest-workflow submits with "
+                    "--workflow-remote.")
+    parser.add_argument("--listen", type=parse_address,
+                        default=("127.0.0.1", 0), metavar="HOST:PORT",
+                        help="The address to listen on. Default: a free port "
+                             "on 127.0.0.1.")
+    arguments = parser.parse_args(args)
+    # The token is not a command line argument, as these are visible to
+    # other users of the machine.
+    token = os.environ.get(TOKEN_VARIABLE)
+    with WorkerDaemon(arguments.listen, token) as daemon:
+        host, port = daemon.address
+        print(f"Listening on {host}:{port}", flush=True)
+        if token is None:
+            print(f"{TOKEN_VARIABLE}={daemon.token}", flush=True)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,37 @@
+# Copyright (C) 2018 Leiden University Medical Center
+# This file is part of pytest-workflow
+#
+# pytest-workflow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# pytest-workflow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+
+"""Hooks that plugins and conftest.py files can implement to change how
+pytest-workflow runs workflows."""
+
+from typing import Optional
+
+from _pytest.config import Config as PytestConfig
+
+import pytest
+
+from .executors import Executor
+
+
+@pytest.hookspec(firstresult=True)
+def pytest_workflow_executor(config: PytestConfig) -> Optional[Executor]:
+    """
+    Returns the executor that launches the commands of the workflows. It is
+    called once, when pytest is configured. The first executor that is
+    returned is used. By default the commands run in a subprocess, or on a
+    worker daemon when --workflow-remote is given.
+    :param config: The pytest config
+    """
@@ -16,27 +16,52 @@
 
 """core functionality of pytest-workflow plugin"""
 import argparse
+import collections
+import functools
+import itertools
+import json
+import os
 import shutil
 import tempfile
+import threading
 import warnings
+import zlib
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
 
 from _pytest.config import Config as PytestConfig
 from _pytest.config.argparsing import Parser as PytestParser
 from _pytest.mark import Mark
 from _pytest.python import FunctionDefinition, Metafunc
+from _pytest.reports import CollectReport
 
 import pytest
 
 import yaml
 
+from . import hooks
 from .content_tests import ContentTestCollector
+from .executors import BatchExecutor, Executor, LocalExecutor, \
+    RemoteExecutor, TOKEN_VARIABLE
 from .file_tests import FileTestCollector
 from .schema import WorkflowTest, workflow_tests_from_schema
-from .util import duplicate_tree, is_in_dir, replace_whitespace
+from .util import AUTO_THREADS, IgnorePatterns, WORKFLOW_GROUP_SEPARATOR, \
+    available_cpus, copy_plan, duplicate_tree, filter_plan, git_index_path, \
+    is_in_dir, link_outputs, modified_hardlinks, move_to_trash, \
+    parse_address, parse_copy_threads, parse_shard, parse_size, \
+    parse_threads, plan_file_sizes, plan_file_stats, \
+    remove_tree_in_background, remove_trees, replace_whitespace, \
+    workflow_group_from_nodeid, xdist_worker_index
 from .workflow import Workflow, WorkflowQueue
 
+COPY_PLAN_CACHE_KEY = "pytest_workflow/copy_plan"
+DISK_USAGE_CACHE_KEY = "pytest_workflow/disk_usage"
+DURATION_CACHE_KEY = "pytest_workflow/durations"
+WORKFLOW_IGNORE_FILE = ".workflowignore"
+# The pytest-xdist distribution modes in which each workflow is run by one
+# worker.
+XDIST_SHARDED_MODES = ("load", "loadfile", "loadscope")
+
 
 def pytest_addoption(parser: PytestParser):
     parser.addoption(
@@ -53,12 +78,156 @@ def pytest_addoption(parser: PytestParser):
              "directories if there are test failures. On success all "
              "directories are deleted.",
         dest="keep_workflow_wd_on_fail")
+    parser.addoption(
+        "--background-cleanup",
+        action="store_true",
+        dest="background_cleanup",
+        help="Remove the temporary directories in a background process that "
+             "keeps running after pytest has finished. The directories are "
+             "moved out of the way before pytest finishes, so the base "
+             "temporary directory can be reused immediately.")
     parser.addoption(
         "--wt", "--workflow-threads",
         dest="workflow_threads",
-        default=1,
+        default=None,
+        type=parse_threads,
+        help="The number of workflows to run simultaneously. Default: 1, or "
+             "no limit when --workflow-cpus or --workflow-memory is used. "
+             "'auto' uses the number of cpus that are available to pytest "
+             "and starts fewer workflows when the host is busy.")
+    parser.addoption(
+        "--workflow-timeout",
+        dest="workflow_timeout",
+        default=None,
+        type=float,
+        help="The number of seconds each workflow may run. Workflows that "
+             "run longer are killed. The 'timeout' key in the test YAML "
+             "overrides this. Default: no limit.")
+    parser.addoption(
+        "--workflow-remote",
+        dest="workflow_remote",
+        default=None,
+        type=parse_address,
+        metavar="HOST:PORT",
+        help="Run the workflows on the worker daemon at HOST:PORT. Start it "
+             "with 'python -m pytest_workflow.executors --listen HOST:PORT' "
+             "on a machine that shares the filesystem with pytest. The token "
+             "of the daemon is read from the PYTEST_WORKFLOW_TOKEN "
+             "environment variable.")
+    parser.addoption(
+        "--workflow-batch-submit",
+        dest="workflow_batch_submit",
+        default=None,
+        metavar="COMMAND",
+        help="Submit the workflows to a batch scheduler as array jobs with "
+             "COMMAND, for example 'sbatch --array=0-{last}'. {size} is "
+             "replaced with the number of workflows in the array job and "
+             "{last} with the index of the last one. The path of the array "
+             "job script is appended. The temporary directory should be on "
+             "a filesystem that is shared with the cluster.")
+    parser.addoption(
+        "--workflow-batch-task-variable",
+        dest="workflow_batch_task_variable",
+        default="SLURM_ARRAY_TASK_ID",
+        metavar="NAME",
+        help="The environment variable with the index of the task in an "
+             "array job, starting at 0. Default: SLURM_ARRAY_TASK_ID.")
+    parser.addoption(
+        "--workflow-batch-cancel",
+        dest="workflow_batch_cancel",
+        default=None,
+        metavar="COMMAND",
+        help="Cancel killed workflows on the batch scheduler with COMMAND, "
+             "for example 'scancel {job}_{task}'. {job} is replaced with "
+             "the id of the array job, which is the last word of the output "
+             "of the submit command, and {task} with the index of the "
+             "workflow in the array job.")
+    parser.addoption(
+        "--workflow-fail-fast",
+        action="store_true",
+        dest="workflow_fail_fast",
+        help="Stop running workflows when a workflow has failed. Waiting "
+             "workflows are skipped and running workflows are killed. With "
+             "--maxfail this happens after the given number of failed "
+             "workflows.")
+    parser.addoption(
+        "--workflow-shard",
+        dest="workflow_shard",
+        default=None,
+        type=parse_shard,
+        metavar="INDEX/TOTAL",
+        help="Divide the workflows over TOTAL shards and only run the "
+             "workflows of shard INDEX, for example 2/8. The workflows are "
+             "divided by their durations in --workflow-durations. Without "
+             "it, or when a workflow has no duration, all workflows are "
+             "divided by their name. Workflows that depend on each other "
+             "are in the same shard.")
+    parser.addoption(
+        "--workflow-durations",
+        dest="workflow_durations_file",
+        default=None,
+        type=Path,
+        metavar="PATH",
+        help="A JSON file with the durations of the workflows in seconds, "
+             "keyed by name, such as the "
+             ".pytest_cache/v/pytest_workflow/durations file of an earlier "
+             "session. Used instead of the pytest cache, so all shards of "
+             "--workflow-shard use the same durations.")
+    parser.addoption(
+        "--workflow-cpus",
+        dest="workflow_cpus",
+        default=None,
         type=int,
-        help="The number of workflows to run simultaneously.")
+        help="The number of cpus the workflows may use together. Workflows "
+             "request cpus with the 'resources' key in the test YAML, one by "
+             "default. A workflow is only started when the cpus it requests "
+             "are available.")
+    parser.addoption(
+        "--workflow-memory",
+        dest="workflow_memory",
+        default=None,
+        type=parse_size,
+        help="The memory the workflows may use together, for example '64G'. "
+             "Workflows request memory with the 'resources' key in the test "
+             "YAML. A workflow is only started when the memory it requests "
+             "is available.")
+    parser.addoption(
+        "--workflow-disk-budget",
+        dest="workflow_disk_budget",
+        default=None,
+        type=parse_size,
+        help="The disk space the temporary directories of the workflows may "
+             "use together, for example '20G'. A workflow is only started "
+             "when its estimated disk usage fits in the remaining budget and "
+             "in the free space of the base temporary directory. The "
+             "estimate is based on the files that are copied and on the "
+             "disk usage of the workflow in earlier test sessions.")
+    parser.addoption(
+        "--workflow-check-interval",
+        dest="workflow_check_interval",
+        default=1.0,
+        type=float,
+        help="The number of seconds between measurements of the disk usage "
+             "of the running workflows, and between checks of the disk "
+             "budget and the load. The interval is lengthened when measuring "
+             "takes long, for example for large working directories. "
+             "Default: 1.")
+    parser.addoption(
+        "--stream",
+        action="store_true",
+        dest="stream",
+        help="Run the tests of a workflow as soon as the workflow has "
+             "finished, while other workflows are still running. By default "
+             "the tests are run when all workflows have finished. The tests "
+             "are reported in the order their workflows finish.")
+    parser.addoption(
+        "--start-during-collection",
+        action="store_true",
+        dest="start_during_collection",
+        help="Start running workflows as soon as they are collected, rather "
+             "than after collection has finished. Workflows that are "
+             "deselected with -k, -m or --deselect may already have run. "
+             "Workflows with dependencies are started after collection.")
     parser.addoption(
         "--symlink", action="store_true",
         help="Instead of copying the current working directory, create a "
@@ -66,6 +235,60 @@ def pytest_addoption(parser: PytestParser):
              "symbolic links. This saves disk space, but should only be used "
              "for tests that do use these files read-only."
     )
+    parser.addoption(
+        "--hardlink", action="store_true",
+        help="Instead of copying the current working directory, create a "
+             "similar directory structure where all files are hardlinks to "
+             "the original files. Unlike symbolic links, hardlinks can not "
+             "be told apart from the original files. This saves disk space, "
+             "but should only be used for tests that use these files "
+             "read-only. Files modified through a hardlink are reported at "
+             "the end of the test session."
+    )
+    parser.addoption(
+        "--reflink", action="store_true",
+        help="Instead of copying the current working directory, clone all "
+             "files using copy-on-write reflinks. This is nearly "
+             "instantaneous and uses no extra disk space. Only supported on "
+             "linux filesystems such as btrfs and XFS. Files are copied when "
+             "reflinks are not supported."
+    )
+    parser.addoption(
+        "--reflink-always", action="store_true",
+        help="Like --reflink, but raise an error when reflinks are not "
+             "supported, rather than copying the files."
+    )
+    parser.addoption(
+        "--snapshot", action="store_true",
+        help="Copy the current working directory only once per test session "
+             "to a snapshot directory in the base temporary directory. The "
+             "temporary directories of the workflows are created from this "
+             "snapshot. This reduces the number of times the current "
+             "working directory is read to one. Can be combined with "
+             "--symlink, --hardlink and --reflink, which will then link to "
+             "the snapshot rather than to the current working directory."
+    )
+    parser.addoption(
+        "--workflow-ignore",
+        dest="workflow_ignore",
+        action="append",
+        type=str,
+        default=[],
+        help="Do not copy files or directories matching this gitignore-style "
+             "pattern to the temporary directories. Ignored directories are "
+             "not traversed at all. Can be used multiple times. Patterns "
+             "are also read from a '.workflowignore' file in the root "
+             "directory, if present."
+    )
+    parser.addoption(
+        "--copy-threads",
+        dest="copy_threads",
+        default=1,
+        type=parse_copy_threads,
+        help="The number of threads used to copy or link the files into the "
+             "temporary directory of each workflow. Increasing this can "
+             "speed up copying on network filesystems considerably."
+    )
     parser.addoption(
         "--ga", "--git-aware", action="store_true", dest="git_aware",
         help="Only copy files that are listed by the 'git ls-files' command. "
@@ -140,17 +363,35 @@ def pytest_configure(config: PytestConfig):
     # Using setattr is not the nicest way of doing things, but having something
     # in the globally used config is the easiest and least hackish way to get
     # this going.
-    workflow_queue = WorkflowQueue()
-    setattr(config, "workflow_queue", workflow_queue)
-
     # Save which workflows are run and which are not.
     executed_workflows: Dict[str, str] = {}
     setattr(config, "executed_workflows", executed_workflows)
 
+    # The workflows are only queued at the end of collection, when it is
+    # known which tests have been selected. Unless
+    # --start-during-collection is used.
+    workflows: Dict[str, Workflow] = {}
+    setattr(config, "workflows", workflows)
+
+    # Under pytest-xdist the workflows are divided over the workers. These
+    # are the selected workflows that are run by other workers.
+    workflows_of_other_workers: Set[str] = set()
+    setattr(config, "workflows_of_other_workers", workflows_of_other_workers)
+
     # Save workflow for cleanup in this var.
-    workflow_cleanup_dirs: List[str] = []
+    workflow_cleanup_dirs: List[Path] = []
     setattr(config, "workflow_cleanup_dirs", workflow_cleanup_dirs)
 
+    # The number of selected tests per workflow that have not finished yet.
+    # The directory of a workflow is removed as soon as this reaches zero.
+    workflow_pending_tests: Dict[str, int] = {}
+    setattr(config, "workflow_pending_tests", workflow_pending_tests)
+
+    # Directories that could not be removed during the session. These are
+    # reported at the end of the session.
+    workflow_unremovable_dirs: List[str] = []
+    setattr(config, "workflow_unremovable_dirs", workflow_unremovable_dirs)
+
     # When multiple workflows are started they should all be set in the same
     # temporary directory
     # Running in a temporary directory will prevent the project repository
@@ -181,8 +422,275 @@ def pytest_configure(config: PytestConfig):
                          f"'{rootdir}'. Please select a --basetemp that is "
                          f"not in pytest's current working directory.")
 
+    if sum((config.getoption("symlink"), config.getoption("hardlink"),
+            reflink_mode(config) is not None)) > 1:
+        raise ValueError("Only one of --symlink, --hardlink and --reflink can "
+                         "be used.")
+
+    # Save the inode, mtime and size of files hardlinked into the workflow
+    # directories, so modifications can be detected at the end of the session.
+    workflow_hardlink_stats: Dict[str, Tuple[int, int, int]] = {}
+    setattr(config, "workflow_hardlink_stats", workflow_hardlink_stats)
+
+    # The snapshot of the rootdir is created when the first workflow is
+    # queued. So no copying happens when pytest-workflow is not used.
+    workflow_snapshot_dir: Optional[Path] = None
+    setattr(config, "workflow_snapshot_dir", workflow_snapshot_dir)
+
+    # The copy plan of the rootdir is computed when the first workflow is
+    # queued and reused for all other workflows.
+    workflow_copy_plan: Optional[List[Tuple[str, bool]]] = None
+    setattr(config, "workflow_copy_plan", workflow_copy_plan)
+
+    # The sizes of the files in the copy plan and the disk usage of the
+    # workflows in earlier sessions. Both are read once, when the disk usage
+    # of the first workflow is estimated.
+    workflow_plan_file_sizes: Optional[Dict[str, int]] = None
+    setattr(config, "workflow_plan_file_sizes", workflow_plan_file_sizes)
+    workflow_previous_disk_usage: Optional[Dict[str, int]] = None
+    setattr(config, "workflow_previous_disk_usage",
+            workflow_previous_disk_usage)
+
+    # Guards the copy plan, its file sizes and the snapshot, which are shared
+    # by all workflow directories, but prepared in multiple threads.
+    workflow_setup_lock = threading.RLock()
+    setattr(config, "workflow_setup_lock", workflow_setup_lock)
+
     setattr(config, "workflow_temp_dir", workflow_temp_dir)
 
+    # The executor launches the commands of all workflows. Plugins and
+    # conftest.py files can provide their own.
+    workflow_executor: Executor = config.hook.pytest_workflow_executor(
+        config=config)
+    setattr(config, "workflow_executor", workflow_executor)
+
+    # The size of the files that are copied to the directory of each
+    # workflow. These are saved to estimate the disk usage of the workflows.
+    workflow_copy_sizes: Dict[str, int] = {}
+    setattr(config, "workflow_copy_sizes", workflow_copy_sizes)
+
+    # The queue needs the temporary directory to check the free disk space.
+    workflow_queue = WorkflowQueue(
+        disk_budget=config.getoption("workflow_disk_budget"),
+        temp_dir=workflow_temp_dir,
+        check_interval_secs=config.getoption("workflow_check_interval"),
+        cpus=config.getoption("workflow_cpus"),
+        memory=config.getoption("workflow_memory"),
+        # With --wt auto fewer workflows are started when the host is busy.
+        max_load=(available_cpus()
+                  if config.getoption("workflow_threads") == AUTO_THREADS
+                  else None),
+        # -x sets maxfail to 1. Without -x and --maxfail it is 0.
+        max_failures=((config.getoption("maxfail") or 1)
+                      if config.getoption("workflow_fail_fast") else None))
+    setattr(config, "workflow_queue", workflow_queue)
+
+
+def reflink_mode(config: PytestConfig) -> Optional[str]:
+    """Returns 'always' with --reflink-always, 'auto' with --reflink and None
+    when files are not reflinked."""
+    if config.getoption("reflink_always"):
+        return "always"
+    if config.getoption("reflink"):
+        return "auto"
+    return None
+
+
+def workflow_copy_plan(config: PytestConfig) -> List[Tuple[str, bool]]:
+    """Returns the copy plan of the rootdir. The workflow directories are
+    prepared in multiple threads, so the plan is computed under a lock."""
+    with config.workflow_setup_lock:  # type: ignore
+        return _workflow_copy_plan(config)
+
+
+def _workflow_copy_plan(config: PytestConfig) -> List[Tuple[str, bool]]:
+    """Returns the copy plan of the rootdir. The plan is computed once per
+    session. With --git-aware the plan is also stored in the pytest cache,
+    keyed on the git index. Later sessions reuse it as long as the index
+    has not changed, so git does not need to be run at all."""
+    plan: Optional[List[Tuple[str, bool]]] = config.workflow_copy_plan  # type: ignore  # noqa: E501
+    if plan is not None:
+        return plan
+
+    root_dir = Path(str(config.rootdir))
+    git_aware: bool = config.getoption("git_aware")
+    ignore_patterns: List[str] = config.getoption("workflow_ignore")
+    ignore_file = root_dir / WORKFLOW_IGNORE_FILE
+    if ignore_file.exists():
+        ignore_patterns = (ignore_file.read_text().splitlines() +
+                           ignore_patterns)
+    ignore = IgnorePatterns(ignore_patterns)
+
+    # The cache is not available when the cacheprovider plugin is disabled.
+    cache = getattr(config, "cache", None)
+    index = git_index_path(root_dir) if git_aware else None
+    cache_key = None
+    if cache is not None and index is not None:
+        index_stat = index.stat()
+        cache_key = [str(root_dir), index_stat.st_mtime_ns,
+                     index_stat.st_size, ignore_patterns]
+        cached = cache.get(COPY_PLAN_CACHE_KEY, None)
+        if cached is not None and cached.get("key") == cache_key:
+            # JSON has no tuples.
+            plan = [(path, is_dir) for path, is_dir in cached["plan"]]
+
+    if plan is None:
+        plan = copy_plan(root_dir, git_aware=git_aware, ignore=ignore)
+        if cache is not None and cache_key is not None:
+            cache.set(COPY_PLAN_CACHE_KEY, {"key": cache_key, "plan": plan})
+    setattr(config, "workflow_copy_plan", plan)
+    return plan
+
+
+def workflow_plan_file_sizes(config: PytestConfig) -> Dict[str, int]:
+    """Returns the sizes of the files in the copy plan of the rootdir. The
+    files are statted once per session, under the same lock as the plan."""
+    with config.workflow_setup_lock:  # type: ignore
+        sizes: Optional[Dict[str, int]] = config.workflow_plan_file_sizes  # type: ignore  # noqa: E501
+        if sizes is None:
+            sizes = plan_file_sizes(config.rootdir, workflow_copy_plan(config))
+            setattr(config, "workflow_plan_file_sizes", sizes)
+        return sizes
+
+
+def workflow_previous_disk_usage(config: PytestConfig) -> Dict[str, int]:
+    """Returns the disk usage of the output of the workflows in earlier
+    sessions. The pytest cache is read once per session."""
+    with config.workflow_setup_lock:  # type: ignore
+        disk_usage: Optional[Dict[str, int]] = config.workflow_previous_disk_usage  # type: ignore  # noqa: E501
+        if disk_usage is None:
+            # The cache is not available when the cacheprovider plugin is
+            # disabled.
+            cache = getattr(config, "cache", None)
+            disk_usage = ({} if cache is None
+                          else cache.get(DISK_USAGE_CACHE_KEY, {}))
+            setattr(config, "workflow_previous_disk_usage", disk_usage)
+        return disk_usage
+
+
+def workflow_threads(config: PytestConfig) -> Optional[int]:
+    """Returns the maximum number of workflows that run simultaneously.
+    Without --wt only one workflow runs at the same time, unless the cpus
+    or memory of the workflows are limited instead. With --wt auto this is
+    the number of available cpus, divided over the pytest-xdist workers."""
+    threads = config.getoption("workflow_threads")
+    shard = xdist_shard(config)
+    if threads == AUTO_THREADS and shard is not None:
+        _, worker_count = shard
+        return max(1, available_cpus() // worker_count)
+    if threads == AUTO_THREADS:
+        return available_cpus()
+    if threads is None and not (config.getoption("workflow_cpus") or
+                                config.getoption("workflow_memory")):
+        threads = 1
+    return threads
+
+
+def workflow_durations(config: PytestConfig) -> Dict[str, float]:
+    """Returns the durations of the workflows in earlier sessions. These are
+    used to start the longest workflows first. These are read from the
+    --workflow-durations file, or else from the cache, once per session."""
+    durations: Optional[Dict[str, float]] = getattr(
+        config, "workflow_durations", None)
+    if durations is None:
+        durations_file: Optional[Path] = config.getoption(
+            "workflow_durations_file")
+        # The cache is not available when the cacheprovider plugin is
+        # disabled.
+        cache = getattr(config, "cache", None)
+        if durations_file is not None:
+            durations = json.loads(durations_file.read_text())
+        else:
+            durations = ({} if cache is None
+                         else cache.get(DURATION_CACHE_KEY, {}))
+        setattr(config, "workflow_durations", durations)
+    return durations
+
+
+def start_during_collection(config: PytestConfig) -> bool:
+    """Returns whether workflows are started as soon as they are
+    collected."""
+    return (config.getoption("start_during_collection") and
+            not config.getoption("collectonly") and
+            config.getoption("workflow_shard") is None and
+            xdist_shard(config) is None)
+
+
+def xdist_shard(config: PytestConfig) -> Optional[Tuple[int, int]]:
+    """Returns the index of this pytest-xdist worker and the number of
+    workers, when the workflows are divided over the workers. None
+    otherwise."""
+    workerinput: Optional[Dict[str, Any]] = getattr(config, "workerinput",
+                                                    None)
+    if workerinput is None or not workerinput.get("workflow_sharding"):
+        return None
+    return (xdist_worker_index(workerinput["workerid"]),
+            workerinput["workercount"])
+
+
+def pytest_addhooks(pluginmanager):
+    """Adds the hooks of pytest-workflow, such as
+    pytest_workflow_executor."""
+    pluginmanager.add_hookspecs(hooks)
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_workflow_executor(config: PytestConfig) -> Executor:
+    """The default executor runs the workflows in a subprocess, on a worker
+    daemon when --workflow-remote is given, or on a batch scheduler when
+    --workflow-batch-submit is given."""
+    address = config.getoption("workflow_remote")
+    submit_command = config.getoption("workflow_batch_submit")
+    if address is not None and submit_command is not None:
+        raise ValueError("Only one of --workflow-remote and "
+                         "--workflow-batch-submit can be used.")
+    if address is not None:
+        token = os.environ.get(TOKEN_VARIABLE)
+        if not token:
+            raise ValueError(f"--workflow-remote requires the token of the "
+                             f"worker daemon in the {TOKEN_VARIABLE} "
+                             f"environment variable.")
+        return RemoteExecutor(address, token)
+    if submit_command is not None:
+        # The array job scripts are removed together with the workflow
+        # directories.
+        batch_dir = config.workflow_temp_dir / ".batch"  # type: ignore
+        config.workflow_cleanup_dirs.append(batch_dir)  # type: ignore
+        return BatchExecutor(
+            submit_command, batch_dir,
+            task_variable=config.getoption("workflow_batch_task_variable"),
+            cancel_command=config.getoption("workflow_batch_cancel"))
+    return LocalExecutor()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    """Tells the pytest-xdist workers to divide the workflows among
+    themselves. This is only done with the distribution modes that are
+    scheduled by WorkflowScheduling."""
+    node.workerinput["workflow_sharding"] = (
+        node.config.getvalue("dist") in XDIST_SHARDED_MODES)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_make_scheduler(config: PytestConfig, log):
+    """Sends all tests of a workflow to the pytest-xdist worker that runs
+    the workflow."""
+    dist = config.getvalue("dist")
+    if dist not in XDIST_SHARDED_MODES:
+        # With --dist each every worker runs all tests, so also all
+        # workflows. Other modes can not be combined with the scheduling
+        # of the workflows.
+        if dist != "each":
+            warnings.warn(
+                f"pytest-workflow can not divide the workflows over the "
+                f"pytest-xdist workers with --dist {dist}. Each worker runs "
+                f"all workflows. Use --dist load, loadfile or loadscope to "
+                f"run each workflow once.")
+        return None
+    from .xdist_scheduling import WorkflowScheduling
+    return WorkflowScheduling(config, log)
+
 
 def pytest_collection():
     """This function is started at the beginning of collection"""
@@ -233,38 +741,487 @@ def pytest_generate_tests(metafunc: Metafunc):
                          ids=workflow_names)
 
 
+def get_workflow_names_from_item(item: pytest.Item) -> Tuple[str, ...]:
+    """Returns the names of the workflows a test item belongs to. These are
+    either the workflow of the YAML file the item was collected from, or the
+    workflows in the workflow mark of a custom test."""
+    collector = item.getparent(WorkflowTestsCollector)
+    if collector is not None:
+        return (collector.workflow_test.name,)
+
+    marker = item.get_closest_marker(name="workflow")
+    if marker is None:
+        return ()
+
+    workflow_names = get_workflow_names_from_workflow_marker(marker)
+    if len(workflow_names) == 1:
+        return workflow_names
+    elif "workflow_dir" in item.fixturenames:  # type: ignore
+        # name looks like test_bla[parametrizedvalue]
+        # this parametrizedvalue should be the workflow name. The name is
+        # used rather than the nodeid, as a workflow group can be appended
+        # to the nodeid under pytest-xdist.
+        return (item.name.split('[')[-1].strip(']'),)
+    else:
+        raise NotImplementedError(f"Cannot determine workflow name for "
+                                  f"{item.nodeid}")
+
+
 def pytest_collection_modifyitems(config: PytestConfig,
                                   items: List[pytest.Function]):
     """Here we skip all tests related to workflows that are not executed"""
 
+    # Workflows that depend on each other are reported as a collection
+    # error. Unlike an exception raised here, pytest-xdist workers send this
+    # to the controller. These workflows are not run and their tests are
+    # deselected below.
+    workflows: Dict[str, Workflow] = config.workflows  # type: ignore
+    resolve_dependencies(workflows)
+    cycle = dependency_cycle(workflows)
+    if cycle is not None:
+        nodeid: str = config.executed_workflows[cycle[0]]  # type: ignore
+        config.hook.pytest_collectreport(report=CollectReport(
+            nodeid.split("::")[0], "failed",
+            f"Workflows can not depend on each other: "
+            f"{' -> '.join(cycle)}.", []))
+        for name in cycle[:-1]:
+            workflows.pop(name).cancel()
+            del config.executed_workflows[name]  # type: ignore
+
+    # The workflows of other shards are not executed. Their tests are
+    # deselected and the custom tests that use them are skipped below.
+    shard: Optional[Tuple[int, int]] = config.getoption("workflow_shard")
+    if shard is not None:
+        index, total = shard
+        # The local cache can differ between machines, so the workflows are
+        # only divided by duration with an explicit durations file.
+        durations = (workflow_durations(config)
+                     if config.getoption("workflow_durations_file") is not None
+                     else {})
+        shards = shard_workflows(workflows, durations, total)
+        for name, workflow_shard in shards.items():
+            if workflow_shard != index:
+                # Release the threads that wait on the workflow to finish.
+                workflows.pop(name).cancel()
+                del config.executed_workflows[name]  # type: ignore
+    deselected = [item for item in items
+                  if item.getparent(WorkflowTestsCollector) is not None
+                  and get_workflow_names_from_item(item)[0]
+                  not in config.executed_workflows]  # type: ignore
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = [item for item in items if item not in deselected]
+
     for item in items:
         marker = item.get_closest_marker(name="workflow")
 
         if marker is None:
             continue
 
-        workflow_names = get_workflow_names_from_workflow_marker(marker)
-        if len(workflow_names) == 1:
-            workflow_name = workflow_names[0]
-        elif "workflow_dir" in item.fixturenames:
-            # nodeid looks like test_bla.py::test_bla[parametrizedvalue]
-            # this parametrizedvalue should be the workflow name.
-            workflow_name = item.nodeid.split('[')[-1].strip(']')
-        else:
-            raise NotImplementedError(f"Cannot determine workflow name for "
-                                      f"{item.nodeid}")
+        for workflow_name in get_workflow_names_from_item(item):
+            if workflow_name not in config.executed_workflows.keys():  # type: ignore  # noqa: E501
+                skip_marker = pytest.mark.skip(
+                    reason=f"'{workflow_name}' has not run.")
+                item.add_marker(skip_marker)
 
-        if workflow_name not in config.executed_workflows.keys():  # type: ignore  # noqa: E501
-            skip_marker = pytest.mark.skip(
-                reason=f"'{workflow_name}' has not run.")
-            item.add_marker(skip_marker)
+    # Under pytest-xdist the workflow group is appended to the nodeids, so
+    # WorkflowScheduling sends all tests of a workflow to the same worker.
+    if xdist_shard(config) is None:
+        return
+    groups = workflow_groups(workflows)
+    for item in items:
+        names = [name for name in get_workflow_names_from_item(item)
+                 if name in workflows]
+        if names:
+            item._nodeid = (f"{item.nodeid}{WORKFLOW_GROUP_SEPARATOR}"
+                            f"{groups[names[0]]}")
+
+
+def resolve_dependencies(workflows: Dict[str, Workflow]):
+    """Sets the dependencies of the workflows. Dependencies that are not run
+    are left out."""
+    for workflow in workflows.values():
+        workflow.dependencies = [workflows[name]
+                                 for name in workflow.depends_on
+                                 if name in workflows]
+
+
+def dependency_cycle(workflows: Dict[str, Workflow]) -> Optional[List[str]]:
+    """Returns the names of workflows that depend on each other, starting and
+    ending with the same workflow. None if there are no such workflows. The
+    dependencies must be resolved first."""
+    finished: Set[str] = set()
+
+    def visit(workflow: Workflow, path: List[str]) -> Optional[List[str]]:
+        if workflow.name in finished:
+            return None
+        if workflow.name in path:
+            return path[path.index(workflow.name):] + [workflow.name]
+        for dependency in workflow.dependencies:
+            cycle = visit(dependency, path + [workflow.name])
+            if cycle is not None:
+                return cycle
+        finished.add(workflow.name)
+        return None
+
+    for workflow in workflows.values():
+        cycle = visit(workflow, [])
+        if cycle is not None:
+            return cycle
+    return None
 
 
-def pytest_runtestloop(session: pytest.Session):
-    """This runs after collection, but before the tests."""
-    session.config.workflow_queue.process(  # type: ignore
-        session.config.getoption("workflow_threads")
-    )
+def all_dependencies(workflow: Workflow) -> Set[str]:
+    """Returns the names of the dependencies of a workflow, including the
+    dependencies of its dependencies."""
+    names: Set[str] = set()
+    to_visit = list(workflow.dependencies)
+    while to_visit:
+        dependency = to_visit.pop()
+        if dependency.name not in names:
+            names.add(dependency.name)
+            to_visit.extend(dependency.dependencies)
+    return names
+
+
+def workflow_groups(workflows: Dict[str, Workflow]) -> Dict[str, str]:
+    """Returns the group of each workflow. Workflows that depend on each
+    other, directly or indirectly, are in the same group, so they are run
+    by the same pytest-xdist worker. A group is named after its first
+    workflow."""
+    neighbours: Dict[str, Set[str]] = {name: set() for name in workflows}
+    for name, workflow in workflows.items():
+        for dependency in workflow.depends_on:
+            if dependency in workflows:
+                neighbours[name].add(dependency)
+                neighbours[dependency].add(name)
+    groups: Dict[str, str] = {}
+    for name in workflows:
+        if name in groups:
+            continue
+        to_visit = [name]
+        while to_visit:
+            member = to_visit.pop()
+            if member not in groups:
+                groups[member] = name
+                to_visit.extend(neighbours[member])
+    return groups
+
+
+def shard_workflows(workflows: Dict[str, Workflow],
+                    durations: Dict[str, float], total: int
+                    ) -> Dict[str, int]:
+    """Divides the workflows over shards. Workflows that depend on each
+    other are in the same shard.
+    :param workflows: The workflows to divide
+    :param durations: The durations of the workflows in earlier sessions.
+    When all workflows have a duration, the groups of workflows are divided
+    with greedy bin packing: the longest group is put in the shard with the
+    least work. Otherwise all groups are divided by a stable hash of their
+    name, so the shards do not depend on which durations are known.
+    :param total: The number of shards
+    :return: The shard of each workflow. The shards start at 1.
+    """
+    members: Dict[str, List[str]] = {}
+    for name, group in workflow_groups(workflows).items():
+        members.setdefault(group, []).append(name)
+    group_shards: Dict[str, int] = {}
+    if not all(name in durations for name in workflows):
+        for group in members:
+            group_shards[group] = zlib.crc32(group.encode()) % total + 1
+    else:
+        group_durations = {
+            group: sum(durations[name] for name in names)
+            for group, names in members.items()}
+        work = [0.0] * total
+        # Sorting on the name as well keeps the shards the same on all
+        # machines when durations are equal.
+        for group in sorted(group_durations,
+                            key=lambda group: (-group_durations[group],
+                                               group)):
+            shard = work.index(min(work))
+            work[shard] += group_durations[group]
+            group_shards[group] = shard + 1
+    return {name: group_shards[group]
+            for group, names in members.items() for name in names}
+
+
+def owned_workflow_groups(session: pytest.Session) -> Optional[Set[str]]:
+    """Returns the workflow groups this pytest-xdist worker runs. The groups
+    are divided over the workers in the order they are first collected, the
+    same way WorkflowScheduling does. None if the workflows are not divided
+    over workers."""
+    shard = xdist_shard(session.config)
+    if shard is None:
+        return None
+    index, worker_count = shard
+    groups: List[str] = []
+    for item in session.items:
+        group = workflow_group_from_nodeid(item.nodeid)
+        if group is not None and group not in groups:
+            groups.append(group)
+    return {group for position, group in enumerate(groups)
+            if position % worker_count == index}
+
+
+def pytest_collection_finish(session: pytest.Session):
+    """Queue the workflows that have at least one selected test, and the
+    workflows these depend on. This runs after tests have been deselected
+    with -k, -m or --deselect. With --collect-only no workflows are
+    queued."""
+    selected_workflows: Set[str] = set()
+    workflows: Dict[str, Workflow] = session.config.workflows  # type: ignore
+    resolve_dependencies(workflows)
+    durations = workflow_durations(session.config)
+    started_early = start_during_collection(session.config)
+    owned_groups = owned_workflow_groups(session)
+    groups = workflow_groups(workflows)
+    other_workers: Set[str] = session.config.workflows_of_other_workers  # type: ignore  # noqa: E501
+    pending_tests: Dict[str, int] = (
+        session.config.workflow_pending_tests)  # type: ignore
+    if not session.config.getoption("collectonly"):
+        for item in session.items:
+            for name in get_workflow_names_from_item(item):
+                selected_workflows.add(name)
+                # Tests of workflows that are not run are skipped.
+                if name not in workflows:
+                    continue
+                # The outputs of the dependencies are linked into the
+                # directory of the workflow. So these directories are only
+                # removed when the tests of the workflow have finished.
+                for dependency in {name} | all_dependencies(workflows[name]):
+                    selected_workflows.add(dependency)
+                    pending_tests[dependency] = (
+                        pending_tests.get(dependency, 0) + 1)
+    # Workflows are queued in the order they were collected.
+    for name, workflow in workflows.items():
+        missing = [dependency for dependency in workflow.depends_on
+                   if dependency not in workflows]
+        if name in selected_workflows and missing:
+            workflow.cancel(f"'{name}' was skipped because its dependency "
+                            f"'{missing[0]}' has not run")
+        elif (name in selected_workflows and owned_groups is not None and
+              groups[name] not in owned_groups):
+            # The workflow is run by another pytest-xdist worker.
+            other_workers.add(name)
+        elif name in selected_workflows:
+            # Workflows without dependencies have already been queued with
+            # --start-during-collection.
+            if not (started_early and not workflow.depends_on):
+                workflow.expected_duration = durations.get(name)
+                session.config.workflow_queue.put(workflow)  # type: ignore
+        else:
+            # Release the threads that wait on the workflow to finish. This
+            # also removes the workflow from the queue if it has not started
+            # yet.
+            workflow.cancel()
+    # A pytest-xdist worker runs the tests itself, so the workflows are
+    # processed in the background. When the workflows are divided over the
+    # workers, the queue is closed when the session ends, as tests of other
+    # workers may still be sent to this worker.
+    workflow_queue: WorkflowQueue = session.config.workflow_queue  # type: ignore  # noqa: E501
+    if (hasattr(session.config, "workerinput") and
+            not session.config.getoption("collectonly")):
+        if not workflow_queue.started:
+            workflow_queue.start(workflow_threads(session.config))
+        if owned_groups is None:
+            workflow_queue.close()
+
+
+def pytest_runtestloop(session: pytest.Session) -> Optional[bool]:
+    """This runs after collection, but before the tests. The workflows are
+    run before pytest runs the tests. With --stream the workflows are run in
+    the background and the tests are run here."""
+    config = session.config
+    threads = workflow_threads(config)
+    if not config.getoption("stream"):
+        config.workflow_queue.process(threads)  # type: ignore
+        return None
+    return run_tests_streaming(session, threads)
+
+
+def run_tests_streaming(session: pytest.Session,
+                        threads: Optional[int]) -> bool:
+    """Runs the tests of each workflow as soon as the workflow has finished.
+    Tests that do not belong to a workflow are run first. Otherwise this
+    is the same as pytest's own runtestloop."""
+    if (session.testsfailed and
+            not session.config.option.continue_on_collection_errors):
+        raise session.Interrupted(
+            f"{session.testsfailed} "
+            f"error{'s' if session.testsfailed != 1 else ''} during "
+            f"collection")
+    if session.config.option.collectonly:
+        return True
+
+    workflow_queue: WorkflowQueue = session.config.workflow_queue  # type: ignore  # noqa: E501
+    process_errors: List[Exception] = []
+    # The messages of the workflow queue are written between the tests by
+    # this thread. Written from the threads of the queue, they would end up
+    # in the middle of the lines of the test report.
+    messages: Deque[str] = collections.deque()
+    reporter = session.config.pluginmanager.get_plugin("terminalreporter")
+
+    def write_messages():
+        while messages:
+            message = messages.popleft()
+            if reporter is None:
+                print(message)
+            else:
+                reporter.write_line(message)
+
+    workflow_queue.report = messages.append
+
+    def process():
+        try:
+            workflow_queue.process(threads)
+        except Exception as error:
+            process_errors.append(error)
+
+    processor = threading.Thread(target=process)
+    processor.start()
+    try:
+        workflows: Dict[str, Workflow] = session.config.workflows  # type: ignore  # noqa: E501
+        remaining: List[Tuple[pytest.Item, List[Workflow]]] = [
+            (item, [workflows[name]
+                    for name in get_workflow_names_from_item(item)
+                    if name in workflows])
+            for item in session.items]
+        while remaining:
+            ready = [item for item, item_workflows in remaining
+                     if not any(workflow.running
+                                for workflow in item_workflows)]
+            write_messages()
+            if not ready:
+                workflow_queue.wait_for_any(
+                    [workflow for _, item_workflows in remaining
+                     for workflow in item_workflows])
+                continue
+            ready_items = set(ready)
+            remaining = [(item, item_workflows)
+                         for item, item_workflows in remaining
+                         if item not in ready_items]
+            # The next item is a guess when it is not ready yet. Pytest tears
+            # down the right fixtures when another item is run instead.
+            next_items = ready[1:] + [item for item, _ in remaining[:1]]
+            for item, nextitem in itertools.zip_longest(ready, next_items):
+                write_messages()
+                item.config.hook.pytest_runtest_protocol(item=item,
+                                                         nextitem=nextitem)
+                if session.shouldfail:
+                    raise session.Failed(session.shouldfail)
+                if session.shouldstop:
+                    raise session.Interrupted(session.shouldstop)
+    except (session.Failed, session.Interrupted):
+        # The tests of the other workflows are not run, so these do not need
+        # to finish.
+        kill_workflows(session.config,
+                       "the test session ended before it finished")
+        raise
+    except KeyboardInterrupt:
+        # The workflows run in their own process group, so they do not
+        # receive the interrupt of Ctrl-C themselves.
+        kill_workflows(session.config, "the test session was interrupted")
+        raise
+    finally:
+        processor.join()
+        write_messages()
+        workflow_queue.report = print
+    if process_errors:
+        raise process_errors[0]
+    return True
+
+
+def eager_cleanup(config: PytestConfig) -> bool:
+    """Returns whether workflow directories can be removed as soon as all
+    tests of the workflow have finished. With --kwdof this is only known at
+    the end of the session."""
+    return not (config.getoption("keep_workflow_wd") or
+                config.getoption("keep_workflow_wd_on_fail"))
+
+
+def remove_workflow_dirs(config: PytestConfig, directories: List[Path]):
+    """Removes the given workflow directories. They are moved to a trash
+    directory first. This is atomic, so the directories are gone
+    immediately. Afterwards the trash is removed in parallel or in the
+    background. Directories that can not be removed are moved back, and
+    saved so they can be reported at the end of the session."""
+    # Directories of workflows that did not run do not exist. Without any
+    # workflow directories the temporary directory may not exist either.
+    directories = [directory for directory in directories
+                   if directory.exists()]
+    if not directories:
+        return
+    trash = Path(tempfile.mkdtemp(
+        prefix=".trash_",
+        dir=str(config.workflow_temp_dir)))  # type: ignore
+    trashed_dirs = move_to_trash(directories, trash)
+    if config.getoption("background_cleanup"):
+        remove_tree_in_background(trash)
+        return
+    unremovable_dirs: List[str] = config.workflow_unremovable_dirs  # type: ignore  # noqa: E501
+    for trashed_dir in remove_trees(trashed_dirs):
+        # Report the directory where the user expects it.
+        original_dir = trashed_dirs[trashed_dir]
+        try:
+            os.rename(trashed_dir, original_dir)
+        except OSError:
+            unremovable_dirs.append(f"{original_dir} (moved to {trashed_dir})")
+        else:
+            unremovable_dirs.append(original_dir)
+    if not any(trash.iterdir()):
+        trash.rmdir()
+
+
+def pytest_runtest_setup(item: pytest.Item):
+    """Skips the tests of workflows that were not run because one of their
+    dependencies did not succeed. Under pytest-xdist the workflows run in the
+    background, so this waits until the workflows of the test have
+    finished."""
+    workflows: Dict[str, Workflow] = item.config.workflows  # type: ignore
+    other_workers: Set[str] = item.config.workflows_of_other_workers  # type: ignore  # noqa: E501
+    for name in get_workflow_names_from_item(item):
+        if name in other_workers:
+            # The pytest-xdist worker that should run the workflow has
+            # crashed, so its tests were sent to this worker instead.
+            for dependency in ({name} |
+                               all_dependencies(workflows[name])):
+                if dependency in other_workers:
+                    other_workers.remove(dependency)
+                    item.config.workflow_queue.put(  # type: ignore
+                        workflows[dependency])
+        workflow = workflows.get(name)
+        if workflow is None:
+            continue
+        workflow.wait()
+        if workflow.skip_reason is not None:
+            pytest.skip(workflow.skip_reason)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item: pytest.Item):
+    """Removes the directory of a workflow after the last of its tests has
+    finished, so the disk usage does not add up over the whole session.
+    This runs after the fixtures of the test have been torn down."""
+    yield
+    config = item.config
+    if not eager_cleanup(config):
+        return
+    pending_tests: Dict[str, int] = config.workflow_pending_tests  # type: ignore  # noqa: E501
+    for name in get_workflow_names_from_item(item):
+        if name not in pending_tests:
+            continue
+        pending_tests[name] -= 1
+        if pending_tests[name] > 0:
+            continue
+        del pending_tests[name]
+        workflow: Workflow = config.workflows[name]  # type: ignore
+        cleanup_dirs: List[Path] = config.workflow_cleanup_dirs  # type: ignore
+        if workflow.cwd in cleanup_dirs:
+            # Skipped tests do not wait on the workflow.
+            workflow.wait()
+            cleanup_dirs.remove(workflow.cwd)
+            remove_workflow_dirs(config, [workflow.cwd])
 
 
 def pytest_collectstart(collector: pytest.Collector):
@@ -284,11 +1241,68 @@ def pytest_collectstart(collector: pytest.Collector):
             )
 
 
+def kill_workflows(config: PytestConfig, reason: str):
+    """Kills the running workflows and waits until they have been
+    terminated. Workflows that have not started are cancelled."""
+    workflows: Dict[str, Workflow] = getattr(config, "workflows", {})
+    for workflow in workflows.values():
+        workflow.cancel()
+        workflow.kill(reason)
+    for workflow in workflows.values():
+        # The workflows are killed with SIGKILL when they do not terminate
+        # within the grace period.
+        workflow.wait()
+
+
 def pytest_sessionfinish(session: pytest.Session, exitstatus: int):
+    # The workflows run in their own process group, so they do not receive
+    # the interrupt of Ctrl-C themselves. Workflows can still be running
+    # on pytest-xdist workers, or when the session was stopped by an error.
+    kill_workflows(session.config,
+                   "the test session was interrupted"
+                   if exitstatus == pytest.ExitCode.INTERRUPTED else
+                   "the test session ended before it finished")
+    # Save the disk usage of the output of the workflows, so later sessions
+    # can estimate the disk usage better.
+    cache = getattr(session.config, "cache", None)
+    copy_sizes: Dict[str, int] = session.config.workflow_copy_sizes  # type: ignore  # noqa: E501
+    workflows: Dict[str, Workflow] = session.config.workflows  # type: ignore
+    if cache is not None and copy_sizes:
+        disk_usage = cache.get(DISK_USAGE_CACHE_KEY, {})
+        for name, copy_size in copy_sizes.items():
+            usage = workflows[name].disk_usage
+            if usage is not None:
+                disk_usage[name] = max(0, usage - copy_size)
+        cache.set(DISK_USAGE_CACHE_KEY, disk_usage)
+
+    # Save the durations of the workflows, so later sessions can start the
+    # longest workflows first. Killed workflows did not run to completion.
+    finished_durations = {
+        name: workflow.duration for name, workflow in workflows.items()
+        if workflow.duration is not None and workflow.kill_reason is None}
+    if cache is not None and finished_durations:
+        durations = cache.get(DURATION_CACHE_KEY, {})
+        durations.update(finished_durations)
+        cache.set(DURATION_CACHE_KEY, durations)
+
+    hardlink_stats: Dict[str, Tuple[int, int, int]] = (
+        session.config.workflow_hardlink_stats)  # type: ignore
+    if hardlink_stats:
+        # With --snapshot the files are hardlinked to the snapshot.
+        modified_files = modified_hardlinks(
+            session.config.workflow_snapshot_dir or  # type: ignore
+            session.config.rootdir,
+            hardlink_stats)
+        if modified_files:
+            print(f"The following files were hardlinked into the workflow "
+                  f"directories and have been modified: "
+                  f"{', '.join(modified_files)}.")
+
     directories: List[Path] = session.config.workflow_cleanup_dirs  # type: ignore # noqa: E501
-    # No cleanup needed if there are no directories to cleanup. (I.e.
-    # pytest-workflow plugin was not used.)
-    if len(directories) == 0:
+    # No cleanup needed if no workflows were collected. (I.e.
+    # pytest-workflow plugin was not used.) Directories of workflows whose
+    # tests have all finished may have been removed already.
+    if len(session.config.workflows) == 0:  # type: ignore
         return
 
     keep_workflow_wd: bool = session.config.getoption("keep_workflow_wd")
@@ -311,18 +1325,29 @@ def pytest_sessionfinish(session: pytest.Session, exitstatus: int):
     print(" ".join([success_msg, remove_msg, no_flag_msg]))
 
     if removal:
-        unremovable_dirs: List[Path] = []
-        for directory in directories:
-            try:
-                shutil.rmtree(str(directory))
-            except PermissionError:
-                unremovable_dirs.append(directory)
+        if directories:
+            remove_workflow_dirs(session.config, directories)
+        unremovable_dirs: List[str] = (
+            session.config.workflow_unremovable_dirs)  # type: ignore
         if unremovable_dirs:
             print(f"Unable to remove the following directories due to "
                   f"permission errors: "
                   f"{' ,'.join(str(path) for path in unremovable_dirs)}.")
 
 
+def pytest_unconfigure(config: PytestConfig):
+    """Release the threads that wait on workflows that have not started, and
+    kill the workflows that are still running, for example when the session
+    was stopped early."""
+    kill_workflows(config, "the test session ended before it finished")
+    # With --start-during-collection the queue is processed before the
+    # tests are run. Stop processing when the session ends early.
+    workflow_queue: Optional[WorkflowQueue] = getattr(
+        config, "workflow_queue", None)
+    if workflow_queue is not None and workflow_queue.started:
+        workflow_queue.close()
+
+
 class YamlFile(pytest.File):
     """
     This class collects YAML files and turns them into test items.
@@ -355,8 +1380,11 @@ class WorkflowTestsCollector(pytest.Collector):
         self.tags = [self.workflow_test.name] + self.workflow_test.tags
 
     def queue_workflow(self):
-        """Creates a temporary directory and add the workflow to the workflow
-        queue.
+        """Creates a workflow. The workflow is added to the workflow queue
+        at the end of collection if any of its tests are selected, or right
+        away with --start-during-collection. The
+        temporary directory of the workflow is created by the workflow queue
+        just before the workflow is run. See prepare_workflow_dir.
 
         The temporary directory name is constructed from the test name by
         replacing all whitespaces with '_'. Directory paths with whitespace in
@@ -374,46 +1402,165 @@ class WorkflowTestsCollector(pytest.Collector):
         tempdir = (self.config.workflow_temp_dir /
                    Path(replace_whitespace(self.name, '_')))
 
-        # Remove the tempdir if it exists. This is needed for shutil.copytree
-        # to work properly.
+        # The warnings are given here, rather than in prepare_workflow_dir,
+        # so they are reported by pytest.
         if tempdir.exists():
             warnings.warn(
                 f"'{tempdir}' already exists. Deleting ...")
-            shutil.rmtree(str(tempdir))
 
         # Warn users of git that they should use the --git-aware option.
         # The .git directory contains all files ever checked in, and all diffs
         # in the entire history.
         root_dir = Path(self.config.rootdir)
-        git_aware = self.config.getoption("git_aware")
         git_dir = root_dir / ".git"
-        if git_dir.exists() and not git_aware:
+        if (git_dir.exists() and not self.config.getoption("git_aware") and
+                self.workflow_test.inputs is None):
             warnings.warn(
                 f".git dir detected: {str(git_dir)}. pytest-workflow "
                 f"will copy the entire .git directory and all files ignored "
                 f"by git. It is recommended to use the --git-aware option.")
-        # Copy the project directory to the temporary directory using pytest's
-        # rootdir.
-        duplicate_tree(root_dir, tempdir,
-                       symlink=self.config.getoption("symlink"),
-                       git_aware=git_aware)
 
         # Create a workflow and make sure it runs in the tempdir
         workflow = Workflow(command=self.workflow_test.command,
                             cwd=tempdir,
-                            name=self.workflow_test.name)
-
-        # Add the workflow to the workflow queue.
-        self.config.workflow_queue.put(workflow)
+                            name=self.workflow_test.name,
+                            prepare=functools.partial(
+                                self.prepare_workflow_dir, tempdir),
+                            estimate_disk=self.estimate_disk_usage,
+                            max_disk=self.workflow_test.max_disk,
+                            cpus=self.workflow_test.cpus,
+                            memory=self.workflow_test.memory,
+                            desired_exit_code=self.workflow_test.exit_code,
+                            depends_on=self.workflow_test.depends_on,
+                            executor=self.config.workflow_executor,  # type: ignore  # noqa: E501
+                            timeout=(self.workflow_test.timeout
+                                     if self.workflow_test.timeout is not None
+                                     else self.config.getoption(
+                                         "workflow_timeout")))
+
+        # Register the workflow, so it can be queued at the end of
+        # collection.
+        self.config.workflows[self.workflow_test.name] = workflow
+
+        # With --start-during-collection the workflow is started right away.
+        # Workflows with dependencies are queued at the end of collection,
+        # when all their dependencies are known.
+        if (start_during_collection(self.config) and
+                not self.workflow_test.depends_on):
+            workflow_queue: WorkflowQueue = self.config.workflow_queue  # type: ignore  # noqa: E501
+            if not workflow_queue.started:
+                workflow_queue.start(workflow_threads(self.config))
+            workflow.expected_duration = workflow_durations(
+                self.config).get(workflow.name)
+            workflow_queue.put(workflow)
 
         # Add the tempdir to the removal queue. We do not use a teardown method
         # because this will remove the tempdir right after all the tests from
         # this node have finished. If custom tests are defined this should not
-        # happen. The removal queue is processed just before pytest finishes
-        # and all tests have run.
+        # happen. The tempdir is removed when the last test of the workflow,
+        # including custom tests, has finished. See pytest_runtest_teardown.
+        # Remaining directories are removed just before pytest finishes.
         self.config.workflow_cleanup_dirs.append(tempdir)
         return workflow
 
+    def prepare_workflow_dir(self, tempdir: Path):
+        """Copies the project directory to the temporary directory of the
+        workflow. This is run by the workflow queue in a separate thread,
+        so the workflows can already run while others are prepared."""
+        config = self.config
+        # Remove the tempdir if it exists. This is needed for shutil.copytree
+        # to work properly.
+        if tempdir.exists():
+            shutil.rmtree(str(tempdir))
+
+        root_dir = Path(str(config.rootdir))
+        # The plan takes --git-aware into account.
+        plan = workflow_copy_plan(config)
+        if config.getoption("snapshot"):
+            root_dir = self.snapshot(root_dir, plan)
+        hardlink = config.getoption("hardlink")
+        if hardlink:
+            # All workflow directories share the inodes of the source. So
+            # the files only need to be registered once, before any workflow
+            # has run. The full plan is used, as the inputs of the workflows
+            # differ.
+            with config.workflow_setup_lock:  # type: ignore
+                hardlink_stats = config.workflow_hardlink_stats  # type: ignore
+                if not hardlink_stats:
+                    hardlink_stats.update(plan_file_stats(root_dir, plan))
+        if self.workflow_test.inputs is not None:
+            plan = filter_plan(plan, self.workflow_test.inputs)
+        # Copy the project directory to the temporary directory using pytest's
+        # rootdir.
+        duplicate_tree(root_dir, tempdir,
+                       symlink=config.getoption("symlink"),
+                       reflink=reflink_mode(config),
+                       hardlink=hardlink,
+                       threads=config.getoption("copy_threads"),
+                       plan=plan)
+        # The outputs of the dependencies are linked rather than copied. The
+        # logs are not linked, as the workflow writes its own.
+        workflow: Workflow = config.workflows[self.workflow_test.name]  # type: ignore  # noqa: E501
+        for dependency in workflow.dependencies:
+            link_outputs(dependency.cwd, tempdir,
+                         exclude=(dependency.stdout_file.name,
+                                  dependency.stderr_file.name))
+
+    def estimate_disk_usage(self) -> int:
+        """Estimates the disk usage of the temporary directory of the
+        workflow. This is the size of the files that are copied plus the size
+        of the output of the workflow in earlier test sessions."""
+        config = self.config
+        copy_size = 0
+        # Linked files do not use extra disk space.
+        if not (config.getoption("symlink") or config.getoption("hardlink") or
+                reflink_mode(config) is not None):
+            sizes = workflow_plan_file_sizes(config)
+            if self.workflow_test.inputs is None:
+                copy_size = sum(sizes.values())
+            else:
+                plan = filter_plan(workflow_copy_plan(config),
+                                   self.workflow_test.inputs)
+                copy_size = sum(sizes.get(path, 0) for path, is_dir in plan
+                                if not is_dir)
+        config.workflow_copy_sizes[self.workflow_test.name] = copy_size  # type: ignore  # noqa: E501
+        disk_usage = workflow_previous_disk_usage(config)
+        return copy_size + disk_usage.get(self.workflow_test.name, 0)
+
+    def snapshot(self, root_dir: Path, plan: List[Tuple[str, bool]]
+                 ) -> Path:
+        """Returns the snapshot directory of the rootdir. The workflow
+        directories are prepared in multiple threads, so the snapshot is
+        created under a lock."""
+        with self.config.workflow_setup_lock:  # type: ignore
+            return self._snapshot(root_dir, plan)
+
+    def _snapshot(self, root_dir: Path, plan: List[Tuple[str, bool]]
+                  ) -> Path:
+        """Returns the snapshot directory of the rootdir. The snapshot is
+        created by the first workflow that needs it and shared by all
+        workflows in the session."""
+        config = self.config
+        snapshot_dir: Optional[Path] = config.workflow_snapshot_dir  # type: ignore  # noqa: E501
+        if snapshot_dir is not None:
+            return snapshot_dir
+
+        snapshot_dir = config.workflow_temp_dir / ".snapshot"  # type: ignore
+        if snapshot_dir.exists():
+            warnings.warn(
+                f"'{snapshot_dir}' already exists. Deleting ...")
+            shutil.rmtree(str(snapshot_dir))
+        # Reflinks are also used for the snapshot, as this saves disk space.
+        # Linking the snapshot would defeat its purpose.
+        duplicate_tree(root_dir, snapshot_dir,
+                       reflink=reflink_mode(config),
+                       threads=config.getoption("copy_threads"),
+                       plan=plan)
+        config.workflow_snapshot_dir = snapshot_dir  # type: ignore
+        # The snapshot is removed together with the workflow directories.
+        config.workflow_cleanup_dirs.append(snapshot_dir)  # type: ignore
+        return snapshot_dir
+
     def collect(self):
         """This runs the workflow and starts all the associated tests
         The idea is that isolated parts of the yaml get their own collector or
@@ -435,7 +1582,7 @@ class WorkflowTestsCollector(pytest.Collector):
                 self.nodeid)
 
         # This creates a workflow that is queued for processing after the
-        # collection phase.
+        # collection phase, if any of its tests are selected.
         workflow = self.queue_workflow()
 
         # Below structure makes it easy to append tests
@@ -482,6 +1629,9 @@ class ExitCodeTest(pytest.Item):
         assert self.workflow.exit_code == self.desired_exit_code
 
     def repr_failure(self, excinfo, style=None):
+        if self.workflow.kill_reason is not None:
+            return (f"'{self.workflow.name}' was killed: "
+                    f"{self.workflow.kill_reason}.")
         message = (f"'{self.workflow.name}' exited with exit code " +
                    f"'{self.workflow.exit_code}' instead of "
                    f"'{self.desired_exit_code}'.")
@@ -22,11 +22,13 @@ from typing import List, Optional
 
 import jsonschema
 
-from .util import replace_whitespace
+from .util import parse_size, replace_whitespace
 
 SCHEMA = Path(__file__).parent / "schema" / "schema.json"
 DEFAULT_EXIT_CODE = 0
 DEFAULT_FILE_SHOULD_EXIST = True
+DEFAULT_CPUS = 1
+DEFAULT_MEMORY = 0
 
 JSON_SCHEMA = json.loads(SCHEMA.read_text())
 
@@ -157,7 +159,13 @@ class WorkflowTest(object):
                  exit_code: int = DEFAULT_EXIT_CODE,
                  stdout: ContentTest = ContentTest(),
                  stderr: ContentTest = ContentTest(),
-                 files: Optional[List[FileTest]] = None):
+                 files: Optional[List[FileTest]] = None,
+                 inputs: Optional[List[str]] = None,
+                 max_disk: Optional[int] = None,
+                 cpus: int = DEFAULT_CPUS,
+                 memory: int = DEFAULT_MEMORY,
+                 depends_on: Optional[List[str]] = None,
+                 timeout: Optional[float] = None):
         """
         Create a WorkflowTest object.
         :param name: The name of the test
@@ -166,6 +174,16 @@ class WorkflowTest(object):
         :param stdout: a ContentTest object
         :param stderr: a ContentTest object
         :param files: a list of FileTest objects
+        :param inputs: a list of glob patterns of the files that are copied
+        to the workflow directory. All files are copied if None.
+        :param max_disk: the maximum disk space in bytes the workflow directory
+        may use. No limit if None.
+        :param cpus: the number of cpus the workflow uses
+        :param memory: the memory in bytes the workflow uses
+        :param depends_on: the names of the workflows whose outputs this
+        workflow uses
+        :param timeout: the number of seconds the workflow may run. No limit
+        if None.
         """
         self.name = name
         self.command = command
@@ -174,12 +192,20 @@ class WorkflowTest(object):
         self.stderr = stderr
         self.files = files or []
         self.tags = tags or []
+        self.inputs = inputs
+        self.max_disk = max_disk
+        self.cpus = cpus
+        self.memory = memory
+        self.depends_on = depends_on or []
+        self.timeout = timeout
 
     @classmethod
     def from_schema(cls, schema: dict):
         """Generate a WorkflowTest object from schema objects"""
         test_file_dicts = schema.get("files", [])
         test_files = [FileTest(**d) for d in test_file_dicts]
+        max_disk = schema.get("max_disk")
+        resources = schema.get("resources", {})
 
         return cls(
             name=schema["name"],
@@ -188,5 +214,11 @@ class WorkflowTest(object):
             exit_code=schema.get("exit_code", DEFAULT_EXIT_CODE),
             stdout=ContentTest(**schema.get("stdout", {})),
             stderr=ContentTest(**schema.get("stderr", {})),
-            files=test_files
+            files=test_files,
+            inputs=schema.get("inputs"),
+            max_disk=parse_size(max_disk) if max_disk is not None else None,
+            cpus=resources.get("cpus", DEFAULT_CPUS),
+            memory=parse_size(resources.get("memory", DEFAULT_MEMORY)),
+            depends_on=schema.get("depends_on"),
+            timeout=schema.get("timeout")
         )
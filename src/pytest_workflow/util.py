@@ -1,5 +1,8 @@
+import concurrent.futures
+import errno
 import functools
 import hashlib
+import math
 import os
 import re
 import shutil
@@ -7,10 +10,43 @@ import subprocess  # nosec
 import sys
 import warnings
 from pathlib import Path
-from typing import Callable, Iterator, List, Set, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, \
+    Pattern, Sequence, Set, Tuple, Union
 
 Filepath = Union[str, os.PathLike]
 
+# Request code for the FICLONE ioctl as defined in linux/fs.h. It is only
+# exposed by the fcntl module from python 3.12 onwards.
+FICLONE = 0x40049409
+
+# Errors raised by the FICLONE ioctl when the filesystem (combination) does
+# not support copy-on-write cloning.
+REFLINK_UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV,
+                              errno.EINVAL, errno.ENOTTY, errno.ENOSYS}
+REFLINK_MODES = ("auto", "always")
+
+# Errors raised by link() when a hardlink can not be created. For example
+# because the destination is on another filesystem.
+HARDLINK_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK,
+                               errno.EOPNOTSUPP}
+
+
+# Multipliers of the units that can be used in disk sizes.
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3,
+              "T": 1024 ** 4}
+SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$",
+                        re.IGNORECASE)
+
+# The number of workflow threads is derived from the available cpus with
+# this value.
+AUTO_THREADS = "auto"
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+# Under pytest-xdist the workflow group of a test is appended to its node id
+# after this separator. The scheduler sends all tests of a group to the same
+# worker.
+WORKFLOW_GROUP_SEPARATOR = "@workflow:"
+
 
 # This function was created to ensure the same conversion is used throughout
 # pytest-workflow.
@@ -64,32 +100,83 @@ def git_root(path: Filepath) -> str:
     return output.strip()  # Remove trailing newline
 
 
-def git_ls_files(path: Filepath) -> List[str]:
-    output = _run_command("git", "-C", os.fspath(path), "ls-files",
-                          # Make sure submodules are included.
-                          "--recurse-submodules")
-    # Remove trailing newlines and split to output all the paths
-    return output.strip("\n").split("\n")
+def git_ls_files(path: Filepath, block_size: int = 64 * 1024
+                 ) -> Iterator[str]:
+    """
+    Lists all files registered in git. The output of git is streamed, so the
+    paths can already be processed while git is still running. This matters
+    for repositories with millions of files.
+    :param path: The directory in which git is run
+    :param block_size: The number of bytes read from git at a time
+    :return: An iterator over the paths relative to path
+    """
+    args = ["git", "-C", os.fspath(path), "ls-files",
+            # Separate paths with NUL characters. Otherwise paths with
+            # special characters are quoted.
+            "-z",
+            # Make sure submodules are included.
+            "--recurse-submodules"]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)  # nosec
+    remainder = b""
+    for block in iter(lambda: process.stdout.read(block_size), b""):  # type: ignore  # noqa: E501
+        # The last part is incomplete, unless the block ends with NUL, in
+        # which case it is empty.
+        *file_paths, remainder = (remainder + block).split(b"\0")
+        for file_path in file_paths:
+            yield os.fsdecode(file_path)
+    process.stdout.close()  # type: ignore
+    returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def git_index_path(path: Filepath) -> Optional[Path]:
+    """
+    Finds the index file of the git repository path belongs to. The index
+    changes whenever the output of git ls-files changes.
+    :param path: A directory inside a git repository
+    :return: The path to the index. None if path is not in a git repository,
+    when the repository is a worktree or when it has submodules, which have
+    their own indexes.
+    """
+    resolved_path = Path(path).resolve()
+    for directory in [resolved_path] + list(resolved_path.parents):
+        if (directory / ".git").exists():
+            index = directory / ".git" / "index"
+            if (directory / ".gitmodules").exists() or not index.is_file():
+                return None
+            return index
+    return None
 
 
-def _duplicate_tree(src: Filepath, dest: Filepath
+def _duplicate_tree(src: Filepath, dest: Filepath,
+                    ignore: Optional["IgnorePatterns"] = None,
+                    relative_dir: str = ''
                     ) -> Iterator[Tuple[str, str, bool]]:
     """Traverses src and for each file or directory yields a path to it,
-    its destination, and whether it is a directory."""
+    its destination, and whether it is a directory. Ignored directories are
+    not traversed."""
     for entry in os.scandir(src):  # type: os.DirEntry
+        relative_path = os.path.join(relative_dir, entry.name)
         if entry.is_dir():
+            if ignore is not None and ignore.match(relative_path, True):
+                continue
             dir_src = entry.path
             dir_dest = os.path.join(dest, entry.name)
             yield dir_src, dir_dest, True
-            yield from _duplicate_tree(dir_src, dir_dest)
+            yield from _duplicate_tree(dir_src, dir_dest, ignore,
+                                       relative_path)
         elif entry.is_file() or entry.is_symlink():
+            if ignore is not None and ignore.match(relative_path, False):
+                continue
             yield entry.path, os.path.join(dest, entry.name), False
         else:
             warnings.warn(f"Unsupported filetype for copying. "
                           f"Skipping {entry.path}")
 
 
-def _duplicate_git_tree(src: Filepath, dest: Filepath
+def _duplicate_git_tree(src: Filepath, dest: Filepath,
+                        ignore: Optional["IgnorePatterns"] = None
                         ) -> Iterator[Tuple[str, str, bool]]:
     """Traverses src, finds all files registered in git and for each file or
     directory yields a path to it, its destination and whether it is a
@@ -98,6 +185,8 @@ def _duplicate_git_tree(src: Filepath, dest: Filepath
     # os.path.dirname when the path is in the current directory.
     yielded_dirs: Set[str] = {''}
     for path in git_ls_files(src):
+        if ignore is not None and ignore.match_file(path):
+            continue
         # git ls-files does not list directories. Yield parent first to prevent
         # creating files in non-existing directories. Also check if it is
         # yielded before so each directory is only yielded once.
@@ -125,40 +214,306 @@ def _duplicate_git_tree(src: Filepath, dest: Filepath
         yield src_path, dest_path, False
 
 
+def reflink_file(src: Filepath, dest: Filepath) -> None:
+    """
+    Creates a copy-on-write clone of a file using the linux FICLONE ioctl.
+    This only works on filesystems that support it, such as btrfs and XFS.
+    Metadata is copied in the same way as shutil.copy2.
+    :param src: The source file
+    :param dest: The destination file
+    """
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP,
+                      "Reflinks are only supported on linux", os.fspath(src))
+    import fcntl  # Not available on all platforms.
+    with open(src, "rb") as src_h, open(dest, "wb") as dest_h:
+        fcntl.ioctl(dest_h.fileno(), FICLONE, src_h.fileno())
+    shutil.copystat(src, dest)
+
+
+def reflink_or_copy(src: Filepath, dest: Filepath) -> None:
+    """
+    Clones a file using a reflink. Falls back to a normal copy when the
+    filesystem does not support reflinks.
+    :param src: The source file
+    :param dest: The destination file
+    """
+    try:
+        reflink_file(src, dest)
+    except OSError as error:
+        if error.errno not in REFLINK_UNSUPPORTED_ERRNOS:
+            raise
+        shutil.copy2(src, dest)
+
+
+def hardlink_or_copy(src: Filepath, dest: Filepath) -> None:
+    """
+    Creates a hardlink to a file. Falls back to a normal copy when the file
+    can not be linked, for example because dest is on another filesystem.
+    :param src: The source file
+    :param dest: The destination file
+    """
+    try:
+        os.link(src, dest)
+    except OSError as error:
+        if error.errno not in HARDLINK_UNSUPPORTED_ERRNOS:
+            raise
+        shutil.copy2(src, dest)
+
+
+def copy_plan(src: Filepath, git_aware: bool = False,
+              ignore: Optional["IgnorePatterns"] = None
+              ) -> List[Tuple[str, bool]]:
+    """
+    Lists everything that needs to be duplicated from src. The plan can be
+    passed to duplicate_tree, so src only needs to be traversed once for
+    multiple duplications.
+    :param src: The source directory
+    :param git_aware: Only list files registered by git.
+    :param ignore: Paths matching these patterns are not listed.
+    :return: A list of (path relative to src, whether it is a directory)
+    tuples. Directories are always listed before their contents.
+    """
+    if not os.path.isdir(src):
+        raise NotADirectoryError(f"Not a directory: '{src}'")
+    # Joining '' with a path results in the path itself. So all destinations
+    # are relative paths.
+    if git_aware:
+        path_iter = _duplicate_git_tree(src, '', ignore)
+    else:
+        path_iter = _duplicate_tree(src, '', ignore)
+    return [(path, is_dir) for _, path, is_dir in path_iter]
+
+
+class IgnorePatterns(object):
+    """
+    Matches relative paths against gitignore-style patterns. A pattern
+    without a slash matches at any depth, a pattern with a slash is relative
+    to the root. A trailing slash only matches directories and a leading '!'
+    re-includes previously ignored paths. Lines starting with '#' are
+    comments.
+    """
+    def __init__(self, patterns: Iterable[str]):
+        self.rules: List[Tuple[Pattern, bool, bool]] = []
+        for pattern in patterns:
+            pattern = pattern.rstrip("\n").rstrip(" ")
+            if not pattern or pattern.startswith("#"):
+                continue
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            elif pattern.startswith("\\"):
+                # Escaped '#' or '!'
+                pattern = pattern[1:]
+            directory_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            regex = glob_to_regex(pattern.lstrip("/"))
+            if "/" not in pattern:
+                regex = "(?:.*/)?" + regex
+            self.rules.append((re.compile(regex), negate, directory_only))
+        # Files are matched including their parent directories. Cache the
+        # results for the directories.
+        self._dir_cache: Dict[str, bool] = {}
+
+    @classmethod
+    def from_file(cls, path: Filepath, extra_patterns: Iterable[str] = ()
+                  ) -> "IgnorePatterns":
+        """Reads the patterns from an ignore file. Extra patterns are
+        applied after the patterns in the file."""
+        with open(path, "rt") as ignore_file:
+            return cls(list(ignore_file) + list(extra_patterns))
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def match(self, path: str, is_dir: bool) -> bool:
+        """
+        Checks if a path is ignored. Parent directories are not checked.
+        :param path: A path relative to the root
+        :param is_dir: Whether the path is a directory
+        :return: True if the path is ignored
+        """
+        posix_path = path.replace(os.sep, "/")
+        ignored = False
+        # Like git, the last matching pattern decides.
+        for regex, negate, directory_only in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(posix_path):
+                ignored = not negate
+        return ignored
+
+    def match_file(self, path: str) -> bool:
+        """
+        Checks if a file is ignored, either by itself or because one of its
+        parent directories is ignored. This is needed when the directories
+        are not traversed, for example when the files are listed by git.
+        :param path: A path relative to the root
+        :return: True if the file is ignored
+        """
+        parent = os.path.dirname(path)
+        if parent and self._match_dir(parent):
+            return True
+        return self.match(path, False)
+
+    def _match_dir(self, path: str) -> bool:
+        if path not in self._dir_cache:
+            parent = os.path.dirname(path)
+            self._dir_cache[path] = (
+                (bool(parent) and self._match_dir(parent)) or
+                self.match(path, True))
+        return self._dir_cache[path]
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translates a glob pattern for relative paths into a regular expression.
+    '*' and '?' do not match the path separator '/'. '**' matches any number
+    of directories.
+    :param pattern: The glob pattern
+    :return: A regular expression that matches the whole path.
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            char_class = pattern[i + 1:end]
+            if char_class.startswith("!"):
+                char_class = "^" + char_class[1:]
+            regex += "[" + char_class.replace("\\", "\\\\") + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex + r"\Z"
+
+
+def filter_plan(plan: Sequence[Tuple[str, bool]], patterns: Iterable[str]
+                ) -> List[Tuple[str, bool]]:
+    """
+    Filters a copy plan so only the paths matching one of the glob patterns
+    remain. A directory that matches a pattern is kept with all its
+    contents. The parent directories of everything that is kept are kept
+    as well.
+    :param plan: The output of copy_plan
+    :param patterns: Glob patterns relative to the source directory
+    :return: The filtered plan, in the same order.
+    """
+    regexes = [re.compile(glob_to_regex(pattern.strip("/")))
+               for pattern in patterns]
+    matched_dirs: Set[str] = set()
+    keep: Set[str] = set()
+    for path, is_dir in plan:
+        parent = os.path.dirname(path)
+        posix_path = path.replace(os.sep, "/")
+        if (parent in matched_dirs or
+                any(regex.match(posix_path) for regex in regexes)):
+            if is_dir:
+                matched_dirs.add(path)
+            keep.add(path)
+            # Keep all parents.
+            while parent and parent not in keep:
+                keep.add(parent)
+                parent = os.path.dirname(parent)
+    return [(path, is_dir) for path, is_dir in plan if path in keep]
+
+
 def duplicate_tree(src: Filepath, dest: Filepath,
                    symlink: bool = False,
-                   git_aware: bool = False):
+                   git_aware: bool = False,
+                   reflink: Optional[str] = None,
+                   hardlink: bool = False,
+                   threads: int = 1,
+                   plan: Optional[Sequence[Tuple[str, bool]]] = None,
+                   ignore: Optional[IgnorePatterns] = None):
     """
     Duplicates a filetree
     :param src: The source directory
     :param dest: The destination directory
     :param symlink: Create symlinks nstead of copying the files.
     :param git_aware: Only copy/symlink files registered by git.
+    :param reflink: Clone the files using copy-on-write reflinks. 'auto'
+    falls back to copying when reflinks are not supported, 'always' raises
+    an error instead.
+    :param hardlink: Create hardlinks instead of copying the files. Falls
+    back to copying when files can not be linked.
+    :param threads: The number of threads used to copy/link the files.
+    :param plan: The output of copy_plan. When given, src is not traversed
+    and git_aware and ignore have no effect.
+    :param ignore: Paths matching these patterns are not duplicated.
     """
-    if not symlink and not git_aware:
-        shutil.copytree(src, dest)
+    if reflink is not None and reflink not in REFLINK_MODES:
+        raise ValueError(f"Unknown reflink mode: '{reflink}'. Choose one "
+                         f"of: {', '.join(REFLINK_MODES)}.")
+    if sum((symlink, hardlink, reflink is not None)) > 1:
+        raise ValueError("Only one of symlink, hardlink and reflink can be "
+                         "used at the same time.")
+
+    if symlink:
+        copy: Callable[[Filepath, Filepath], None] = \
+            functools.partial(os.symlink, target_is_directory=False)
+    elif hardlink:
+        copy = hardlink_or_copy
+    elif reflink == "always":
+        copy = reflink_file
+    elif reflink == "auto":
+        copy = reflink_or_copy
+    else:
+        copy = shutil.copy2  # Preserves metadata, also used by shutil.copytree
+
+    if (plan is None and not symlink and not git_aware and threads == 1
+            and not ignore):
+        shutil.copytree(src, dest, copy_function=copy)
         return
 
     if not os.path.isdir(src):
         # shutil.copytree also throws a NotADirectoryError
         raise NotADirectoryError(f"Not a directory: '{src}'")
 
-    if git_aware:
-        path_iter = _duplicate_git_tree(src, dest)
-    else:
-        path_iter = _duplicate_tree(src, dest)
-    if symlink:
-        copy: Callable[[Filepath, Filepath], None] = \
-            functools.partial(os.symlink, target_is_directory=False)
+    if plan is not None:
+        path_iter: Iterator[Tuple[Filepath, Filepath, bool]] = (
+            (os.path.join(src, path), os.path.join(dest, path), is_dir)
+            for path, is_dir in plan)
+    elif git_aware:
+        path_iter = _duplicate_git_tree(src, dest, ignore)
     else:
-        copy = shutil.copy2  # Preserves metadata, also used by shutil.copytree
+        path_iter = _duplicate_tree(src, dest, ignore)
 
     os.makedirs(dest, exist_ok=False)
-    for src_path, dest_path, is_dir in path_iter:
-        if is_dir:
-            os.mkdir(dest_path)
-        else:
-            copy(src_path, dest_path)
+    if threads == 1:
+        for src_path, dest_path, is_dir in path_iter:
+            if is_dir:
+                os.mkdir(dest_path)
+            else:
+                copy(src_path, dest_path)
+        return
+
+    # Directories are always yielded before their contents. So directories
+    # are created in the main thread while the files are copied concurrently
+    # by the pool as soon as their parent exists.
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        futures = []
+        for src_path, dest_path, is_dir in path_iter:
+            if is_dir:
+                os.mkdir(dest_path)
+            else:
+                futures.append(executor.submit(copy, src_path, dest_path))
+        # Raise the first error that occurred while copying.
+        for future in futures:
+            future.result()
 
 
 def link_tree(src: Filepath, dest: Filepath) -> None:
@@ -172,6 +527,374 @@ def link_tree(src: Filepath, dest: Filepath) -> None:
     duplicate_tree(src, dest, symlink=True)
 
 
+def link_outputs(src: Filepath, dest: Filepath,
+                 exclude: Iterable[str] = ()) -> List[str]:
+    """
+    Symlinks everything in src that does not exist in dest. Directories that
+    only exist in src are linked as a whole. Directories that exist in both
+    are searched for missing paths recursively.
+    :param src: The source directory
+    :param dest: The destination directory
+    :param exclude: Paths relative to src that are not linked
+    :return: A list of the linked paths relative to dest
+    """
+    excluded = set(exclude)
+    linked = []
+
+    def _link(relative_dir: str):
+        for entry in os.scandir(os.path.join(src, relative_dir)):
+            relative_path = os.path.join(relative_dir, entry.name)
+            if relative_path in excluded:
+                continue
+            dest_path = os.path.join(dest, relative_path)
+            if not os.path.lexists(dest_path):
+                os.symlink(entry.path, dest_path)
+                linked.append(relative_path)
+            elif (entry.is_dir(follow_symlinks=False) and
+                  os.path.isdir(dest_path) and
+                  not os.path.islink(dest_path)):
+                _link(relative_path)
+
+    _link("")
+    return linked
+
+
+def move_to_trash(directories: Iterable[Filepath], trash: Filepath
+                  ) -> Dict[str, str]:
+    """
+    Moves directories into a trash directory. Renaming is atomic, so the
+    directories disappear from their original location immediately, however
+    large they are. The trash must be on the same filesystem.
+    :param directories: The directories to move. Directories that do not
+    exist are skipped.
+    :param trash: The trash directory
+    :return: A dictionary with the paths of the directories in the trash as
+    keys and their original paths as values.
+    """
+    trashed = {}
+    for i, directory in enumerate(directories):
+        # Prefix with a number, as directories may have the same name.
+        destination = os.path.join(
+            trash, f"{i}_{os.path.basename(directory)}")
+        try:
+            os.rename(directory, destination)
+        except FileNotFoundError:
+            continue
+        trashed[destination] = os.fspath(directory)
+    return trashed
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def remove_trees(directories: Iterable[Filepath],
+                 threads: Optional[int] = None) -> List[str]:
+    """
+    Removes directory trees. The entries of the directories are removed in
+    parallel.
+    :param directories: The directories to remove
+    :param threads: The number of threads. Defaults to the default of
+    concurrent.futures.ThreadPoolExecutor.
+    :return: The directories that could not be removed due to permission
+    errors.
+    """
+    unremovable = []
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        futures = {}
+        for directory in directories:
+            try:
+                futures[str(directory)] = [
+                    executor.submit(_remove, entry.path)
+                    for entry in os.scandir(str(directory))]
+            except PermissionError:
+                unremovable.append(str(directory))
+        for directory, entry_futures in futures.items():
+            try:
+                for future in entry_futures:
+                    future.result()
+                os.rmdir(directory)
+            except PermissionError:
+                unremovable.append(directory)
+    return unremovable
+
+
+def remove_tree_in_background(directory: Filepath):
+    """
+    Removes a directory tree in a detached process, which keeps running
+    after the python process has finished.
+    :param directory: The directory to remove
+    """
+    subprocess.Popen(  # nosec: Shell is not enabled.
+        [sys.executable, "-c",
+         "import shutil, sys; shutil.rmtree(sys.argv[1], ignore_errors=True)",
+         os.fspath(directory)],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def parse_size(size: Union[str, int]) -> int:
+    """
+    Converts a human readable disk size to a number of bytes.
+    :param size: A number of bytes or a string such as '500M' or '1.5GiB'.
+    The units K, M, G and T are powers of 1024.
+    :return: The size in bytes
+    """
+    if isinstance(size, int):
+        return size
+    match = SIZE_REGEX.match(size)
+    if match is None:
+        raise ValueError(f"Invalid disk size: '{size}'. Use a number of "
+                         f"bytes optionally followed by K, M, G or T.")
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
+def parse_threads(threads: str) -> Union[int, str]:
+    """
+    Converts the number of workflow threads given on the command line.
+    :param threads: A positive number or 'auto'.
+    :return: The number of threads or 'auto'
+    """
+    if threads.strip().lower() == AUTO_THREADS:
+        return AUTO_THREADS
+    try:
+        number = int(threads)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ValueError(f"Invalid number of threads: '{threads}'. Use a "
+                         f"positive number or '{AUTO_THREADS}'.")
+    return number
+
+
+def parse_copy_threads(threads: str) -> int:
+    """
+    Converts the number of copy threads given on the command line.
+    :param threads: A positive number
+    :return: The number of threads
+    """
+    try:
+        number = int(threads)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ValueError(f"Invalid number of copy threads: '{threads}'. Use "
+                         f"a positive number.")
+    return number
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Converts the shard given on the command line.
+    :param shard: The index and the total number of shards, such as '2/8'.
+    The index starts at 1.
+    :return: The index and the total number of shards
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", shard)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard: '{shard}'. Use INDEX/TOTAL, such "
+                         f"as 2/8, with an index from 1 to the total.")
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """
+    Converts an address given on the command line.
+    :param address: The host and port, such as 'buildnode:8765'.
+    :return: The host and the port
+    """
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit() or not 0 <= int(port) <= 65535:
+        raise ValueError(f"Invalid address: '{address}'. Use HOST:PORT, "
+                         f"such as localhost:8765.")
+    return host, int(port)
+
+
+def cgroup_cpu_limit(cgroup_root: Path = CGROUP_ROOT) -> Optional[int]:
+    """
+    Reads the cpu quota of the cgroup pytest runs in. Containers are often
+    limited this way, while all cpus of the host are visible.
+    :param cgroup_root: Where the cgroup filesystem is mounted.
+    :return: The number of cpus the quota allows, rounded up. None if there
+    is no quota.
+    """
+    # cgroup v2 stores the quota and the period in one file. The quota is
+    # 'max' when there is no limit.
+    cpu_max = cgroup_root / "cpu.max"
+    # cgroup v1 stores these in separate files. The quota is -1 when there is
+    # no limit.
+    cfs_quota = cgroup_root / "cpu" / "cpu.cfs_quota_us"
+    cfs_period = cgroup_root / "cpu" / "cpu.cfs_period_us"
+    try:
+        if cpu_max.exists():
+            quota, period = cpu_max.read_text().split()[:2]
+            if quota == "max":
+                return None
+        elif cfs_quota.exists() and cfs_period.exists():
+            quota = cfs_quota.read_text().strip()
+            period = cfs_period.read_text().strip()
+        else:
+            return None
+        if int(quota) <= 0 or int(period) <= 0:
+            return None
+        return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus(cgroup_root: Path = CGROUP_ROOT) -> int:
+    """
+    Returns the number of cpus pytest may use. This takes the cpu affinity
+    and the cgroup cpu quota into account.
+    :param cgroup_root: Where the cgroup filesystem is mounted.
+    :return: The number of cpus
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))  # type: ignore
+    except AttributeError:
+        # sched_getaffinity is not available on macOS.
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit(cgroup_root)
+    if limit is not None:
+        cpus = min(cpus, limit)
+    return max(1, cpus)
+
+
+def load_average() -> Optional[float]:
+    """
+    Returns the load average of the host over the last minute. None if it
+    can not be determined.
+    """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def workflow_group_from_nodeid(nodeid: str) -> Optional[str]:
+    """
+    Returns the workflow group that was appended to a node id.
+    :param nodeid: The node id of a test
+    :return: The workflow group. None if the test does not belong to a
+    workflow.
+    """
+    _, separator, group = nodeid.rpartition(WORKFLOW_GROUP_SEPARATOR)
+    return group if separator else None
+
+
+def xdist_worker_index(worker_id: str) -> int:
+    """
+    Returns the index of a pytest-xdist worker.
+    :param worker_id: The id of the worker, such as 'gw3'
+    :return: The index, such as 3
+    """
+    return int(worker_id.lstrip("gw"))
+
+
+def plan_size(src: Filepath, plan: Iterable[Tuple[str, bool]]) -> int:
+    """
+    Calculates the total size of the files in a copy plan.
+    :param src: The directory the plan was made for
+    :param plan: A copy plan as returned by copy_plan
+    :return: The size in bytes
+    """
+    return sum(plan_file_sizes(src, plan).values())
+
+
+def plan_file_sizes(src: Filepath, plan: Iterable[Tuple[str, bool]]
+                    ) -> Dict[str, int]:
+    """
+    Calculates the size of each file in a copy plan, so the size of parts of
+    the plan can be calculated without statting the files again.
+    :param src: The directory the plan was made for
+    :param plan: A copy plan as returned by copy_plan
+    :return: A dictionary with the paths relative to src as keys and their
+    sizes in bytes as values. Files that do not exist are left out.
+    """
+    sizes = {}
+    for path, is_dir in plan:
+        if is_dir:
+            continue
+        try:
+            sizes[path] = os.stat(os.path.join(src, path),
+                                  follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return sizes
+
+
+def directory_disk_usage(directory: Filepath) -> int:
+    """
+    Calculates the disk space used by the files in a directory. Files that
+    are hardlinked from elsewhere do not use any extra space and are not
+    counted.
+    :param directory: The directory to measure
+    :return: The disk usage in bytes
+    """
+    usage = 0
+    for root, _, files in os.walk(str(directory)):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name),
+                               follow_symlinks=False)
+            except FileNotFoundError:
+                # The workflow may remove files while they are counted.
+                continue
+            if stat.st_nlink == 1:
+                usage += stat.st_blocks * 512
+    return usage
+
+
+def plan_file_stats(src: Filepath, plan: Iterable[Tuple[str, bool]]
+                    ) -> Dict[str, Tuple[int, int, int]]:
+    """
+    Stats the files in a copy plan, so later modifications can be detected
+    with modified_hardlinks.
+    :param src: The directory the plan was made for
+    :param plan: A copy plan as returned by copy_plan
+    :return: A dictionary with the paths relative to src as keys and a tuple
+    of (inode, modification time in ns, size) as values. Files that do not
+    exist are left out.
+    """
+    stats = {}
+    for path, is_dir in plan:
+        if is_dir:
+            continue
+        try:
+            stat = os.stat(os.path.join(src, path), follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        stats[path] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    return stats
+
+
+def modified_hardlinks(directory: Filepath,
+                       stats: Dict[str, Tuple[int, int, int]]) -> List[str]:
+    """
+    Checks which of the hardlinked files have been modified. Files that
+    have been replaced by a new file (and thus have a new inode) are not
+    reported, as the change is not shared with other paths.
+    :param directory: The directory the relative paths in stats refer to
+    :param stats: The output of plan_file_stats
+    :return: A list of paths to files that have been modified
+    """
+    modified = []
+    for relpath, (inode, mtime_ns, size) in stats.items():
+        path = os.path.join(directory, relpath)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if (stat.st_ino == inode and
+                (stat.st_mtime_ns != mtime_ns or stat.st_size != size)):
+            modified.append(path)
+    return modified
+
+
 # block_size 64k with python is a few percent faster than linux native md5sum.
 def file_md5sum(filepath: Path, block_size=64 * 1024) -> str:
     """
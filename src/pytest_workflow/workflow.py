@@ -20,14 +20,24 @@ on stdout, stderr and exit code.
 This file was created by A.H.B. Bollen. Multithreading functionality was added
 later.
 """
+import math
 import queue
 import shlex
+import shutil
+import signal
 import subprocess  # nosec: security implications have been considered
 import tempfile
 import threading
 import time
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from .executors import Executor, Job, LocalExecutor
+from .util import directory_disk_usage, load_average
+
+# The number of seconds a killed workflow gets to terminate, before it is
+# killed with SIGKILL.
+KILL_GRACE_SECS = 5.0
 
 
 class Workflow(object):
@@ -35,7 +45,17 @@ class Workflow(object):
     def __init__(self,
                  command: str,
                  cwd: Optional[Path] = None,
-                 name: Optional[str] = None):
+                 name: Optional[str] = None,
+                 prepare: Optional[Callable[[], Any]] = None,
+                 estimate_disk: Optional[Callable[[], int]] = None,
+                 max_disk: Optional[int] = None,
+                 cpus: int = 1,
+                 memory: int = 0,
+                 desired_exit_code: int = 0,
+                 depends_on: Optional[List[str]] = None,
+                 timeout: Optional[float] = None,
+                 kill_grace_secs: float = KILL_GRACE_SECS,
+                 executor: Optional[Executor] = None):
         """
         Initiates a workflow object
         :param command: The string that represents the command to be run
@@ -43,6 +63,27 @@ class Workflow(object):
         be executed. If None given will default to Path()
         :param name: An alias for the workflow. This looks nicer than a printed
         command.
+        :param prepare: A function that creates the working directory. It is
+        called by the prepare method, before the workflow is started.
+        :param estimate_disk: A function that estimates the disk space in
+        bytes the working directory will use. Used by the workflow queue when
+        a disk budget is set.
+        :param max_disk: The maximum disk space in bytes the working directory
+        may use. The workflow is killed by the workflow queue when it uses
+        more.
+        :param cpus: The number of cpus the workflow uses.
+        :param memory: The memory in bytes the workflow uses.
+        :param desired_exit_code: The exit code of a successful run. The
+        workflows that depend on this workflow are skipped otherwise.
+        :param depends_on: The names of the workflows whose outputs this
+        workflow uses. The workflow queue starts this workflow when these
+        have finished successfully.
+        :param timeout: The number of seconds the workflow may run. The
+        workflow is killed when it runs longer. No limit if None.
+        :param kill_grace_secs: The number of seconds a killed workflow gets
+        to terminate, before it is killed with SIGKILL.
+        :param executor: Launches the command. By default the command runs
+        in a subprocess on this machine.
         """
         if command == "":
             raise ValueError("command can not be an empty string")
@@ -65,77 +106,258 @@ class Workflow(object):
                                              suffix=".err").name)
             if cwd is None
             else self.cwd / Path("log.err"))
-        self._popen: Optional[subprocess.Popen] = None
+        self.executor = executor or LocalExecutor()
+        self._job: Optional[Job] = None
+        self._prepare = prepare
+        self._prepared = False
         self._started = False
+        # Waiters block on these events, so they do not need to poll.
+        self._started_event = threading.Event()
+        self._finished_event = threading.Event()
+        # Called when the workflow has finished, see add_done_callback.
+        self._done_callbacks: List[Callable[["Workflow"], Any]] = []
+        self._callback_lock = threading.Lock()
+        self._timeout_timer: Optional[threading.Timer] = None
+        self._kill_timer: Optional[threading.Timer] = None
+        self.cancelled = False
+        self._estimate_disk = estimate_disk
+        self.max_disk = max_disk
+        self.cpus = cpus
+        self.memory = memory
+        self.desired_exit_code = desired_exit_code
+        self.depends_on = depends_on or []
+        self.timeout = timeout
+        self.kill_grace_secs = kill_grace_secs
+        # The workflows in depends_on. These are set when all workflows are
+        # known.
+        self.dependencies: List["Workflow"] = []
+        # Why the workflow was not run, if it was cancelled.
+        self.skip_reason: Optional[str] = None
+        # The estimated and the last measured disk usage of the working
+        # directory. These are set by the workflow queue.
+        self.disk_estimate = 0
+        self.disk_usage: Optional[int] = None
+        # Why the workflow was killed, if it was.
+        self.kill_reason: Optional[str] = None
+        # The duration in seconds of an earlier run of the workflow. The
+        # workflow queue starts the longest workflows first.
+        self.expected_duration: Optional[float] = None
+        self.duration: Optional[float] = None
+        self._start_time = 0.0
         self.errors: List[Exception] = []
+        self.prepare_lock = threading.Lock()
         self.start_lock = threading.Lock()
 
+    def prepare(self):
+        """Prepares the working directory of the workflow. This is done only
+        once, even if it is called from multiple threads."""
+        with self.prepare_lock:
+            if self._prepared:
+                return
+            try:
+                if self._prepare is not None:
+                    self._prepare()
+            except Exception as error:
+                # Append the error so it can be raised in the main thread.
+                # This also prevents the workflow from starting.
+                self.errors.append(error)
+            finally:
+                self._prepared = True
+
     def start(self):
         """Runs the workflow in a subprocess in the background.
         To make sure the workflow is finished use the `.wait()` method"""
         # The lock ensures that the workflow is started only once, even if it
         # is started from multiple threads.
         with self.start_lock:
-            if not self._started:
+            if self.cancelled:
+                # The workflow was cancelled after it was queued.
+                return
+            elif not self._started and self.errors:
+                # The working directory could not be prepared. Mark the
+                # workflow as started so nothing waits on it forever.
+                self._mark_finished()
+            elif not self._started:
                 try:
-                    stdout_h = self.stdout_file.open('wb')
-                    stderr_h = self.stderr_file.open('wb')
                     sub_process_args = shlex.split(self.command)
-                    self._popen = subprocess.Popen(  # nosec: Shell is not enabled. # noqa
-                        sub_process_args, stdout=stdout_h,
-                        stderr=stderr_h, cwd=str(self.cwd))
+                    self._start_time = time.monotonic()
+                    self._job = self.executor.submit(
+                        sub_process_args, self.cwd, self.stdout_file,
+                        self.stderr_file)
                 except Exception as error:
                     # Append the error so it can be raised in the main thread.
                     self.errors.append(error)
-                finally:
+                    self._mark_finished()
+                else:
+                    # The job calls _job_done when it has finished, which
+                    # notifies all waiters. No thread waits on the job here.
                     self._started = True
-                    stdout_h.close()
-                    stderr_h.close()
+                    self._started_event.set()
+                    if self.timeout is not None:
+                        self._timeout_timer = threading.Timer(
+                            self.timeout, self.kill,
+                            args=(f"it did not finish within "
+                                  f"{self.timeout:g} seconds",))
+                        self._timeout_timer.daemon = True
+                        self._timeout_timer.start()
+                    self._job.add_done_callback(self._job_done)
             else:
                 raise ValueError("Workflows can only be started once")
+        # The callbacks are called without holding the start lock, as they
+        # may kill or cancel other workflows.
+        self._call_done_callbacks()
+
+    def cancel(self, reason: Optional[str] = None):
+        """Cancels a workflow that has not started yet. The workflow is marked
+        as started, so nothing waits on it forever.
+        :param reason: Why the workflow is not run. The tests of the workflow
+        are skipped with this reason.
+        """
+        with self.start_lock:
+            if not self._started:
+                self.cancelled = True
+                self.skip_reason = reason
+                self._mark_finished()
+        self._call_done_callbacks()
+
+    def _mark_finished(self):
+        """Marks a workflow that will not run as started and finished, so
+        nothing waits on it forever."""
+        self._started = True
+        self._started_event.set()
+        self._finished_event.set()
+
+    def _job_done(self, error: Optional[Exception]):
+        """Called by the job when it has finished. Notifies the waiters."""
+        # The process group of a finished job may be reused by other
+        # processes, so it is not killed anymore.
+        for timer in (self._timeout_timer, self._kill_timer):
+            if timer is not None:
+                timer.cancel()
+        if error is not None:
+            # For example, the connection to a remote executor was lost.
+            # Append the error so it can be raised in the main thread.
+            self.errors.append(error)
+        self.duration = time.monotonic() - self._start_time
+        self._finished_event.set()
+        self._call_done_callbacks()
+
+    def add_done_callback(self, callback: Callable[["Workflow"], Any]):
+        """
+        Calls a function when the workflow has finished, was cancelled or
+        could not be started. The function is called right away if this has
+        already happened. It is called from the thread that notices the
+        workflow has finished, so it should not block.
+        :param callback: Called with the workflow
+        """
+        with self._callback_lock:
+            if not self._finished_event.is_set():
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _call_done_callbacks(self):
+        """Calls the callbacks once the workflow has finished."""
+        with self._callback_lock:
+            if not self._finished_event.is_set():
+                return
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def kill(self, reason: str):
+        """Kills the workflow and all processes it started, if it is running.
+        These get SIGTERM first and SIGKILL after the grace period.
+        :param reason: Why the workflow was killed. This is reported by the
+        exit code test.
+        """
+        with self.start_lock:
+            if self._job is None or self._finished_event.is_set():
+                return
+            if self.kill_reason is None:
+                self.kill_reason = reason
+            # Only the first kill starts the timer.
+            timer = None
+            if self._kill_timer is None:
+                timer = threading.Timer(self.kill_grace_secs,
+                                        self._signal_group,
+                                        args=(signal.SIGKILL,))
+                timer.daemon = True
+                self._kill_timer = timer
+        # A job can finish when it is signalled, which calls the callbacks.
+        # These may kill other workflows, so the start lock is not held.
+        self._signal_group(signal.SIGTERM)
+        if timer is not None and not self._finished_event.is_set():
+            timer.start()
+
+    def _signal_group(self, signal_number: int):
+        """Sends a signal to the processes of the workflow, if it has not
+        finished."""
+        if self._finished_event.is_set():
+            return
+        try:
+            self._job.signal(signal_number)  # type: ignore
+        except (OSError, RuntimeError):
+            # The executor could not be reached. This is reported when
+            # waiting on the job.
+            pass
+
+    def estimate_disk(self) -> int:
+        """Returns the estimated disk usage of the working directory in
+        bytes."""
+        if self._estimate_disk is None:
+            return 0
+        return self._estimate_disk()
+
+    @property
+    def failed(self) -> bool:
+        """Whether the workflow has not run or not exited with the desired
+        exit code."""
+        return (self.cancelled or bool(self.errors) or
+                self.kill_reason is not None or
+                (self._job is not None and
+                 self._job.returncode != self.desired_exit_code))
+
+    @property
+    def prepared(self) -> bool:
+        """Whether the working directory has been prepared."""
+        return self._prepared
+
+    @property
+    def running(self) -> bool:
+        """Whether the workflow is about to run or running."""
+        return not self._finished_event.is_set()
 
     def run(self):
         """Runs the workflow and blocks until it is finished"""
+        self.prepare()
         self.start()
         self.wait()
 
     def wait(self, timeout_secs: Optional[float] = None,
-             wait_interval_secs: float = 0.01):
+             wait_interval_secs: Optional[float] = None):
         """Waits for the workflow to complete
         :param timeout_secs: how many seconds should be waited on a workflow
         the total wait time = wait_to_start_time + run_time. This is set to
         None by default as it is very hard to predict how long a workflow runs
         and how long it has to wait on other workflows before starting.
-        :param wait_interval_secs: check interval secs if a workflow is started
-        """
-        wait_time = 0.0
-        # Wait until the workflow is started.
-        # Unless the main thread has stopped
-        while not self._started and threading.main_thread().is_alive():
-            # This piece of code checks if a workflow has started yet. If
-            # it has not, it waits. A counter is implemented here because
-            # incrementing a counter is much faster than checking system
-            # time
-            if (timeout_secs is not None
-                    and wait_time > timeout_secs):
-                raise TimeoutError(
-                    f"Waiting on a workflow that has not started within the "
-                    f"last {timeout_secs} seconds")
-            time.sleep(wait_interval_secs)
-            wait_time += wait_interval_secs
-
-        # Stdout and stderr are written to files. So popen.wait() does not
-        # block process completion with long stderr or stdout.
-        if timeout_secs is not None and self._popen is not None:
-            # Wait for timeout_secs number of secs minus te time that was
-            # already spent waiting for the workflow to start
-            self._popen.wait(timeout_secs - wait_time)
-        elif self._popen is not None:
-            self._popen.wait()
-        else:
-            # If self._popen is none, something went wrong during starting the
-            # workflow
-            pass
+        :param wait_interval_secs: Not used. Waiting threads are notified when
+        the workflow has started or finished. Kept for backwards
+        compatibility.
+        """
+        start_time = time.monotonic()
+        if not self._started_event.wait(timeout_secs):
+            raise TimeoutError(
+                f"Waiting on a workflow that has not started within the "
+                f"last {timeout_secs} seconds")
+
+        remaining_secs = (None if timeout_secs is None else
+                          timeout_secs - (time.monotonic() - start_time))
+        # Stdout and stderr are written to files. So the process does not
+        # block on long stderr or stdout.
+        if not self._finished_event.wait(remaining_secs):
+            raise subprocess.TimeoutExpired(self.command,
+                                            timeout_secs)  # type: ignore
 
     @property
     def stdout(self) -> bytes:
@@ -152,74 +374,472 @@ class Workflow(object):
     @property
     def exit_code(self) -> int:
         self.wait()
-        if self._popen is not None:
-            return self._popen.returncode
+        if self._job is not None and self._job.returncode is not None:
+            return self._job.returncode
         else:
             raise ValueError("No exit code after waiting. Please contact the "
                              "developers and report this issue.")
 
 
 class WorkflowQueue(queue.Queue):
-    """A Queue object that will keep running 'n' numbers of workflows
-    simultaneously until the queue is empty."""
+    """A Queue object that will keep running workflows simultaneously until
+    the queue is empty. The number of simultaneously running workflows is
+    limited by a number of threads and by the available resources."""
 
-    def __init__(self):
+    def __init__(self, disk_budget: Optional[int] = None,
+                 temp_dir: Optional[Path] = None,
+                 check_interval_secs: float = 1.0,
+                 cpus: Optional[int] = None,
+                 memory: Optional[int] = None,
+                 max_load: Optional[float] = None,
+                 max_failures: Optional[int] = None,
+                 report: Callable[[str], Any] = print):
+        """
+        :param disk_budget: The disk space in bytes the working directories
+        of the workflows may use together. A workflow is only started when
+        its estimated disk usage fits in the remaining budget.
+        :param temp_dir: The directory the working directories are created
+        in. Workflows are only started when there is enough free space on
+        its filesystem.
+        :param check_interval_secs: How often the disk usage of the running
+        workflows is measured. When measuring takes longer than a tenth of
+        the interval, the interval is lengthened to ten times the time it
+        takes.
+        :param cpus: The number of cpus the running workflows may use
+        together. No limit if None.
+        :param memory: The memory in bytes the running workflows may use
+        together. No limit if None.
+        :param max_load: The load of the host that may not be exceeded when
+        starting another workflow. The load that is not caused by the
+        running workflows is estimated from the load average. At least one
+        workflow is always running. No limit if None.
+        :param max_failures: The number of failed workflows after which the
+        waiting workflows are skipped and the running workflows are killed.
+        All workflows are run if None.
+        :param report: Writes the messages about the workflows. These are
+        written from the threads of the queue.
+        """
         # No argument for maxsize. This queue is infinite.
         super().__init__()
         # Collect errors during thread processing.
-        self._process_errors = []
+        self._process_errors: List[Exception] = []
+        self.disk_budget = disk_budget
+        self.temp_dir = temp_dir or Path(tempfile.gettempdir())
+        self.check_interval_secs = check_interval_secs
+        self.cpus = cpus
+        self.memory = memory
+        self.max_load = max_load
+        self.max_failures = max_failures
+        self.report = report
+        # The names of the workflows that failed, and the workflow that
+        # caused the other workflows to be stopped.
+        self._failures: List[str] = []
+        self._stopped_by: Optional[str] = None
+        # The workflows that are waiting to be started, in queue order.
+        self._pending: List[Workflow] = []
+        # The workflows that are started and have not finished yet.
+        self._running: Set[Workflow] = set()
+        # The workflows that are admitted within the disk budget.
+        self._admitted: List[Workflow] = []
+        # The condition is notified whenever a workflow is queued, prepared
+        # or finished, so the dispatcher can start the next workflows.
+        self._condition = threading.Condition()
+        # Set when no more workflows are put in the queue.
+        self._closed = threading.Event()
+        # Set when processing has stopped.
+        self._finished = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._monitor: Optional[threading.Thread] = None
 
     def put(self, item, block=True, timeout=None):
         """Like Queue.put() but tests if item is a Workflow"""
         if isinstance(item, Workflow):
             super().put(item, block, timeout)
+            with self._condition:
+                self._condition.notify_all()
         else:
             raise ValueError("Only Workflow type objects can be submitted to "
                              "this queue.")
 
-    # Queue processing with workers example taken from
-    # https://docs.python.org/3.5/library/queue.html?highlight=queue#queue.Queue.join  # noqa
-    def process(self, number_of_threads: int = 1):
+    def process(self, number_of_threads: Optional[int] = 1):
+        """
+        Processes the workflow queue. Workflows are started longest first,
+        based on the duration of earlier runs, as soon as they fit in the
+        number of threads and in the cpu, memory and disk budgets. When the
+        first waiting workflow does not fit, later workflows that do fit are
+        started instead. The working directories are prepared in a separate
+        thread, so the next workflow is prepared while the others are
+        running. Blocks until all workflows have finished.
+        :param number_of_threads: The maximum number of workflows that run
+        simultaneously. No limit if None. Not used when processing was
+        already started.
+        """
+        if not self.started:
+            self.start(number_of_threads)
+        self.close()
+        self.wait()
+
+    def start(self, number_of_threads: Optional[int] = 1):
         """
-        Processes the workflow queue with a number of threads
-        :param number_of_threads: The number of threads
+        Starts processing the workflow queue in the background. Workflows
+        that are put in the queue are started until close is called. See
+        process.
+        :param number_of_threads: The maximum number of workflows that run
+        simultaneously. No limit if None.
         """
-        threads = []
-        for _ in range(number_of_threads):
-            thread = threading.Thread(target=self.worker)
+        self._finished.clear()
+        self._closed.clear()
+        threads = [
+            threading.Thread(target=self._dispatcher,
+                             args=(number_of_threads,)),
+            threading.Thread(target=self.preparer)]
+        # The dispatcher may add the disk monitor to the threads as soon as
+        # it is started.
+        self._threads = list(threads)
+        for thread in threads:
             thread.start()
-            threads.append(thread)
-        self.join()
+        if self.disk_budget is not None:
+            with self._condition:
+                self._start_disk_monitor()
+
+    @property
+    def started(self) -> bool:
+        """Whether the queue is being processed."""
+        return bool(self._threads)
+
+    def close(self):
+        """Signals that no more workflows are put in the queue. Processing
+        stops when the queued workflows have finished."""
+        with self._condition:
+            self._closed.set()
+            self._condition.notify_all()
+
+    def wait(self):
+        """Waits until processing has stopped. Raises the first error that
+        occurred during processing."""
+        # The dispatcher thread is the first thread. The disk monitor may be
+        # started while the dispatcher is running.
+        self._threads[0].join()
+        for thread in self._threads[1:]:
+            thread.join()
+        self._threads = []
         # If errors are detected raise the first error. Raising all errors
         # is not possible.
         if len(self._process_errors) > 0:
             raise self._process_errors[0]
-        for thread in threads:
-            thread.join()
 
-    def worker(self):
+    def _start_disk_monitor(self):
+        """Starts measuring the disk usage of the running workflows, if this
+        has not started yet. Should be called with the condition acquired."""
+        if self._monitor is None or not self._monitor.is_alive():
+            self._monitor = threading.Thread(target=self.disk_monitor)
+            self._monitor.start()
+            self._threads.append(self._monitor)
+
+    def _dispatcher(self, number_of_threads: Optional[int]):
+        """Starts the queued workflows until the queue is closed and all
+        workflows have finished."""
+        try:
+            self._dispatch_all(number_of_threads)
+        except Exception as error:
+            self._process_errors.append(error)
+        finally:
+            with self._condition:
+                # Nothing should wait forever on workflows that are not
+                # started anymore, for example after an error.
+                while self.qsize():
+                    self._pending.append(self.get_nowait())
+                for workflow in self._pending:
+                    workflow.cancel()
+                self._pending.clear()
+                self._finished.set()
+                self._condition.notify_all()
+
+    def _dispatch_all(self, number_of_threads: Optional[int]):
+        """Starts the queued workflows until all have finished."""
+        while True:
+            new_workflows = self._get_all()
+            with self._condition:
+                self._pending.extend(new_workflows)
+                # Start the longest workflows first. This way the session is
+                # not prolonged by a long workflow that is started last.
+                # Workflows with an unknown duration are started first, as
+                # they might be long. The sort is stable, so otherwise the
+                # queue order is kept.
+                self._pending.sort(
+                    key=lambda workflow: -(workflow.expected_duration
+                                           if workflow.expected_duration
+                                           is not None else math.inf))
+                self._dispatch(number_of_threads)
+                # Let the preparer prepare the next waiting workflow.
+                self._condition.notify_all()
+                if (self._closed.is_set() and
+                        not (self._pending or self._running or
+                             self.qsize())):
+                    return
+                # Removed directories and changes in load are not
+                # notified. So check the disk budget and the load again
+                # after an interval.
+                self._condition.wait(
+                    self.check_interval_secs
+                    if self.disk_budget is not None or
+                    self.max_load is not None else None)
+
+    def wait_for_any(self, workflows: List[Workflow]):
         """
-        Run workflows until the queue is empty
+        Blocks until at least one of the workflows has finished or has been
+        skipped. This is used to run the tests of workflows while other
+        workflows are still running.
+        :param workflows: The workflows to wait on
         """
+        with self._condition:
+            while all(workflow.running for workflow in workflows):
+                self._condition.wait()
+
+    def _get_all(self) -> List[Workflow]:
+        """Gets all workflows from the queue. Their disk usage is estimated
+        if there is a disk budget."""
+        workflows: List[Workflow] = []
         while True:
             try:
                 # We know the type is Workflow, because this was enforced in
                 # the put method.
                 workflow: Workflow = self.get_nowait()
             except queue.Empty:
-                break
-            else:
-                print(
-                    f"\n{workflow.name}:\n"
-                    f"\tcommand:   {workflow.command}\n"
-                    f"\tdirectory: {workflow.cwd}\n"
-                    f"\tstdout:    {workflow.stdout_file}\n"
-                    f"\tstderr:    {workflow.stderr_file}")
-                workflow.run()
-                # Collect the workflow errors.
-                self._process_errors.extend(workflow.errors)
-                self.task_done()
-                # Some reporting
-                result = ("python error during starting"
-                          if workflow.errors else "done")
-                print(f"'{workflow.name}' {result}.")
+                return workflows
+            if self.disk_budget is not None:
+                workflow.disk_estimate = workflow.estimate_disk()
+            workflows.append(workflow)
+
+    def _requested(self, workflow: Workflow) -> Tuple[int, int]:
+        """Returns the cpus and memory a workflow requests. Requests that are
+        larger than the budget are reduced to the budget, otherwise the
+        workflow would never run."""
+        cpus = (workflow.cpus if self.cpus is None
+                else min(workflow.cpus, self.cpus))
+        memory = (workflow.memory if self.memory is None
+                  else min(workflow.memory, self.memory))
+        return cpus, memory
+
+    def _fits(self, workflow: Workflow, number_of_threads: Optional[int]
+              ) -> bool:
+        """Whether a workflow fits in the number of threads and in the cpu,
+        memory and disk budgets next to the running workflows."""
+        if (number_of_threads is not None and
+                len(self._running) >= number_of_threads):
+            return False
+        cpus, memory = self._requested(workflow)
+        used = [self._requested(running) for running in self._running]
+        if (self.cpus is not None and
+                sum(used_cpus for used_cpus, _ in used) + cpus > self.cpus):
+            return False
+        if (self.memory is not None and
+                sum(used_memory for _, used_memory in used) + memory >
+                self.memory):
+            return False
+        if not self._fits_load(
+                cpus, sum(used_cpus for used_cpus, _ in used)):
+            return False
+        return (workflow in self._admitted or
+                self._fits_disk(workflow.disk_estimate))
+
+    def _fits_load(self, cpus: int, used_cpus: int) -> bool:
+        """Whether a workflow that requests cpus can be started without
+        saturating the host. The running workflows are assumed to cause a
+        load of the cpus they use. The rest of the load average is caused by
+        other processes on the host."""
+        if self.max_load is None or not self._running:
+            return True
+        load = load_average()
+        if load is None:
+            return True
+        other_load = max(0.0, load - used_cpus)
+        return other_load + used_cpus + cpus <= self.max_load
+
+    def _ready(self, workflow: Workflow) -> bool:
+        """Whether all dependencies of a workflow have finished. A workflow
+        with a failed dependency is skipped. Should be called with the
+        condition acquired."""
+        if any(dependency.running for dependency in workflow.dependencies):
+            return False
+        failed = [dependency.name for dependency in workflow.dependencies
+                  if dependency.failed]
+        if failed:
+            workflow.cancel(f"'{workflow.name}' was skipped because its "
+                            f"dependency '{failed[0]}' did not succeed")
+            self.report(f"\n{workflow.skip_reason}.")
+            self._pending.remove(workflow)
+            self.task_done()
+            return False
+        return True
+
+    def _dispatch(self, number_of_threads: Optional[int]):
+        """Starts all waiting workflows whose dependencies have finished and
+        that fit. Should be called with the condition acquired."""
+        # Skipping a workflow can cause the workflows that depend on it to be
+        # skipped too. So repeat until no more workflows are skipped.
+        number_pending = None
+        while number_pending != len(self._pending):
+            number_pending = len(self._pending)
+            for workflow in list(self._pending):
+                if self._stopped_by is not None:
+                    workflow.cancel(f"'{workflow.name}' was skipped because "
+                                    f"'{self._stopped_by}' failed")
+                if workflow.cancelled:
+                    # The workflow was cancelled after it was queued.
+                    self._pending.remove(workflow)
+                    self.task_done()
+                    continue
+                if not (self._ready(workflow) and
+                        self._fits(workflow, number_of_threads)):
+                    continue
+                self._pending.remove(workflow)
+                self._running.add(workflow)
+                if workflow.max_disk is not None:
+                    self._start_disk_monitor()
+                if self.disk_budget is not None and \
+                        workflow not in self._admitted:
+                    self._admitted.append(workflow)
+                threading.Thread(target=self.worker,
+                                 args=(workflow,)).start()
+
+    def preparer(self):
+        """
+        Prepares the working directory of the first waiting workflow, so it
+        can be started immediately when resources become available. Only one
+        working directory is prepared ahead.
+        """
+        with self._condition:
+            while not self._finished.is_set():
+                # The outputs of the dependencies are linked into the working
+                # directory. So it can only be prepared when these are done.
+                workflow = next((waiting for waiting in self._pending
+                                 if not waiting.prepared and
+                                 not any(dependency.failed or
+                                         dependency.running
+                                         for dependency in
+                                         waiting.dependencies)), None)
+                if (workflow is None or
+                        any(waiting.prepared for waiting in self._pending) or
+                        not (workflow in self._admitted or
+                             self._fits_disk(workflow.disk_estimate))):
+                    self._condition.wait(self.check_interval_secs
+                                         if self.disk_budget is not None
+                                         else None)
+                    continue
+                if self.disk_budget is not None:
+                    self._admitted.append(workflow)
+                self._condition.release()
+                try:
+                    workflow.prepare()
+                finally:
+                    self._condition.acquire()
+                self._condition.notify_all()
+
+    def worker(self, workflow: Workflow):
+        """
+        Prepares and starts a workflow. The working directory may already
+        have been prepared by the preparer. The thread does not wait on the
+        workflow: _workflow_done is called when it has finished.
+        """
+        workflow.prepare()
+        self.report(
+            f"\n{workflow.name}:\n"
+            f"\tcommand:   {workflow.command}\n"
+            f"\tdirectory: {workflow.cwd}\n"
+            f"\tstdout:    {workflow.stdout_file}\n"
+            f"\tstderr:    {workflow.stderr_file}")
+        workflow.add_done_callback(self._workflow_done)
+        workflow.start()
+
+    def _workflow_done(self, workflow: Workflow):
+        """Reports a finished workflow and lets the dispatcher start the
+        next workflows."""
+        # The final disk usage is used to estimate the disk usage in later
+        # sessions.
+        if self.disk_budget is not None and not workflow.errors:
+            workflow.disk_usage = directory_disk_usage(workflow.cwd)
+        # Some reporting
+        result = ("python error during starting"
+                  if workflow.errors else "done")
+        self.report(f"'{workflow.name}' {result}.")
+        if workflow.kill_reason is not None:
+            self.report(f"'{workflow.name}' was killed: "
+                        f"{workflow.kill_reason}.")
+        with self._condition:
+            # Collect the workflow errors.
+            self._process_errors.extend(workflow.errors)
+            self._running.discard(workflow)
+            if (workflow.failed and not workflow.cancelled and
+                    self._stopped_by is None):
+                self._failures.append(workflow.name)
+                if (self.max_failures is not None and
+                        len(self._failures) >= self.max_failures):
+                    self._stop(workflow.name)
+            self.task_done()
+            self._condition.notify_all()
+
+    def _stop(self, failed: str):
+        """Kills the running workflows. The waiting workflows are skipped by
+        the dispatcher. Should be called with the condition acquired.
+        :param failed: The name of the workflow whose failure stopped the
+        other workflows.
+        """
+        self._stopped_by = failed
+        self.report(f"\n'{failed}' failed. Stopping the other workflows.")
+        # Workflows that finish when they are killed are removed from the
+        # running workflows right away.
+        for running in list(self._running):
+            # Workflows that are still being prepared are not started.
+            running.cancel(f"'{running.name}' was skipped because "
+                           f"'{failed}' failed")
+            running.kill(f"'{failed}' failed")
+
+    def _fits_disk(self, estimate: int) -> bool:
+        """Whether a workflow with the estimated disk usage fits in the disk
+        budget and in the free space on the filesystem. Should be called with
+        the condition acquired."""
+        if self.disk_budget is None:
+            return True
+        # Directories that have been removed do not use disk space anymore.
+        self._admitted = [workflow for workflow in self._admitted
+                          if workflow.cwd.exists() or not workflow.prepared]
+        running = [workflow for workflow in self._admitted
+                   if workflow.running]
+        # Always admit a workflow when no other workflows are running.
+        # Otherwise a workflow that is larger than the budget never runs.
+        if not running:
+            return True
+        used = sum(max(workflow.disk_estimate, workflow.disk_usage or 0)
+                   for workflow in self._admitted)
+        # The running workflows will use the rest of their estimate.
+        reserved = sum(max(0, workflow.disk_estimate -
+                           (workflow.disk_usage or 0))
+                       for workflow in running)
+        free = shutil.disk_usage(str(self.temp_dir)).free - reserved
+        return used + estimate <= self.disk_budget and estimate <= free
+
+    def disk_monitor(self):
+        """
+        Measures the disk usage of the running workflows until all workflows
+        have finished. Workflows that use more disk space than their maximum
+        are killed.
+        """
+        interval = self.check_interval_secs
+        while not self._finished.wait(interval):
+            with self._condition:
+                running = list(self._running)
+            start_time = time.monotonic()
+            for workflow in running:
+                usage = directory_disk_usage(workflow.cwd)
+                workflow.disk_usage = usage
+                if workflow.max_disk is not None and usage > workflow.max_disk:
+                    workflow.kill(f"the working directory used {usage} bytes "
+                                  f"of disk space, more than the maximum of "
+                                  f"{workflow.max_disk} bytes")
+            with self._condition:
+                self._condition.notify_all()
+            # Large directories take long to measure. Spend at most a tenth
+            # of the time measuring.
+            interval = max(self.check_interval_secs,
+                           10 * (time.monotonic() - start_time))
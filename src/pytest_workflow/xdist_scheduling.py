@@ -0,0 +1,112 @@
+# Copyright (C) 2018 Leiden University Medical Center
+# This file is part of pytest-workflow
+#
+# pytest-workflow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# pytest-workflow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+
+"""
+Schedules the tests on pytest-xdist workers, so all tests of a workflow run
+on the worker that runs the workflow. This module is only imported when
+pytest-xdist is used.
+"""
+
+from collections import OrderedDict
+from typing import Dict
+
+from _pytest.config import Config as PytestConfig
+
+from xdist.scheduler import LoadScopeScheduling
+
+from .util import workflow_group_from_nodeid, xdist_worker_index
+
+
+class WorkflowScheduling(LoadScopeScheduling):
+    """Like the load, loadfile and loadscope scheduling of pytest-xdist, but
+    the tests of each workflow group are sent to the worker that owns the
+    group. The workers append the group to the node ids of the tests of
+    workflows. The groups are divided over the workers in the order they are
+    first collected, the same way the workers divide the workflows among
+    themselves."""
+
+    def __init__(self, config: PytestConfig, log=None):
+        super().__init__(config, log)
+        # The index of the worker that owns each workflow group.
+        self.owners: Dict[str, int] = {}
+        self.dist: str = config.getvalue("dist")
+
+    def _split_scope(self, nodeid: str) -> str:
+        """The scope of a test of a workflow is its group. Other tests are
+        grouped like the distribution mode does: one by one with load, by
+        file with loadfile and by class or file with loadscope."""
+        group = workflow_group_from_nodeid(nodeid)
+        if group is not None:
+            return group
+        if self.dist == "loadfile":
+            return nodeid.split("::", 1)[0]
+        if self.dist == "loadscope":
+            return nodeid.rsplit("::", 1)[0]
+        return nodeid
+
+    def schedule(self):
+        """Divides the collected tests in work units. Unlike the load scope
+        scheduling, no workers are shut down when there are more workers than
+        work units, as each worker runs its own workflows."""
+        assert self.collection_is_completed
+
+        if self.collection is None:
+            if not self._check_nodes_have_same_collection():
+                self.log("**Different tests collected, aborting run**")
+                return
+            self.collection = list(
+                next(iter(self.registered_collections.values())))
+            for nodeid in self.collection:
+                scope = self._split_scope(nodeid)
+                if (workflow_group_from_nodeid(nodeid) is not None and
+                        scope not in self.owners):
+                    self.owners[scope] = len(self.owners) % self.numnodes
+                work_unit = self.workqueue.setdefault(scope, OrderedDict())
+                work_unit[nodeid] = False
+
+        # Like the load scope scheduling, the workers start with two work
+        # units where possible. A worker only runs a test once it has
+        # received the next test or is shut down.
+        for _ in range(2):
+            for node in self.nodes:
+                self._reschedule(node)
+
+    def _may_run(self, scope: str, index: int) -> bool:
+        """Whether the worker with the index may run a work unit."""
+        owner = self.owners.get(scope)
+        running = {xdist_worker_index(node.gateway.id) for node in self.nodes}
+        return owner is None or owner == index or owner not in running
+
+    def _assign_work_unit(self, node):
+        """Assigns the first work unit the worker may run. Workflow groups of
+        workers that are no longer running can be run by any worker."""
+        index = xdist_worker_index(node.gateway.id)
+        scope = next((scope for scope in self.workqueue
+                      if self._may_run(scope, index)), None)
+        if scope is None:
+            return
+        work_unit = self.workqueue.pop(scope)
+        self.assigned_work.setdefault(node, OrderedDict())[scope] = work_unit
+        worker_collection = self.registered_collections[node]
+        node.send_runtest_some([worker_collection.index(nodeid)
+                                for nodeid, completed in work_unit.items()
+                                if not completed])
+        # Workers that are waiting for work of other workers are not
+        # rescheduled. So shut all workers down once all work is assigned.
+        if not self.workqueue:
+            for other in self.nodes:
+                if not other.shutting_down:
+                    other.shutdown()
@@ -0,0 +1,130 @@
+# Copyright (C) 2018 Leiden University Medical Center
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/
+
+"""Tests workflows that depend on other workflows"""
+
+import textwrap
+
+import pytest
+
+DEPENDENCY_TESTS = textwrap.dedent("""\
+- name: align
+  command: bash -c 'cat index/index.txt > aligned.txt'
+  depends_on:
+    - index
+  files:
+    - path: aligned.txt
+      contains:
+        - indexed
+- name: index
+  command: bash -c 'mkdir index && sleep 0.5 && echo indexed > index/index.txt'
+  files:
+    - path: index/index.txt
+""")
+
+
+def test_dependency_outputs_linked(testdir):
+    testdir.makefile(".yml", test=DEPENDENCY_TESTS)
+    result = testdir.runpytest("-v", "--wt", "2")
+    assert result.ret == 0
+    result.assert_outcomes(passed=5)
+
+
+def test_dependency_run_when_deselected(testdir):
+    testdir.makefile(".yml", test=DEPENDENCY_TESTS)
+    result = testdir.runpytest("-v", "-k", "align")
+    assert result.ret == 0
+    assert "command:   bash -c 'mkdir index" in result.stdout.str()
+    result.assert_outcomes(passed=3)
+
+
+def test_failed_dependency_skips(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: index
+          command: bash -c 'exit 1'
+        - name: align
+          command: echo align
+          depends_on:
+            - index
+        """))
+    result = testdir.runpytest("-v")
+    result.assert_outcomes(failed=1, skipped=1)
+    assert ("'align' was skipped because its dependency 'index' did not "
+            "succeed") in result.stdout.str()
+
+
+def test_dependency_not_run_skips(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: index
+          command: echo index
+        - name: align
+          command: echo align
+          tags:
+            - align
+          depends_on:
+            - index
+        """))
+    result = testdir.runpytest("-v", "-rs", "--tag", "align")
+    result.assert_outcomes(skipped=1)
+    assert ("'align' was skipped because its dependency 'index' has not run"
+            ) in result.stdout.str()
+
+
+def test_dependency_cycle(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: index
+          command: echo index
+          depends_on:
+            - align
+        - name: align
+          command: echo align
+          depends_on:
+            - index
+        """))
+    result = testdir.runpytest("-v")
+    assert result.ret == pytest.ExitCode.INTERRUPTED
+    result.stdout.fnmatch_lines([
+        "*ERROR collecting test.yml*",
+        "*Workflows can not depend on each other: index -> align -> index.",
+        "*1 error during collection*"])
+    assert "INTERNALERROR" not in result.stdout.str()
+
+
+@pytest.mark.parametrize("options", [["--stream"], ["-n", "2"]])
+def test_dependency_cycle_options(testdir, options):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: index
+          command: echo index
+          depends_on:
+            - align
+        - name: align
+          command: echo align
+          depends_on:
+            - index
+        - name: other
+          command: echo other
+        """))
+    result = testdir.runpytest("-v", *options)
+    assert result.ret != pytest.ExitCode.OK
+    result.stdout.fnmatch_lines([
+        "*Workflows can not depend on each other: index -> align -> index."])
+    assert "INTERNALERROR" not in result.stdout.str()
+
+
+def test_dependency_start_during_collection(testdir):
+    testdir.makefile(".yml", test=DEPENDENCY_TESTS)
+    result = testdir.runpytest("-v", "--wt", "2", "--start-during-collection")
+    assert result.ret == 0
+    result.assert_outcomes(passed=5)
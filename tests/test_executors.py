@@ -0,0 +1,322 @@
+# Copyright (C) 2018 Leiden University Medical Center
+# This file is part of pytest-workflow
+#
+# pytest-workflow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# pytest-workflow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+
+"""Tests running workflows with executors and the worker daemon"""
+
+import os
+import shutil
+import signal
+import tempfile
+import textwrap
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from pytest_workflow.executors import BatchExecutor, Executor, Job, \
+    RemoteExecutor, TOKEN_VARIABLE, WorkerDaemon
+from pytest_workflow.workflow import Workflow, WorkflowQueue
+
+
+# Runs the tasks of an array job in the background, like
+# 'sbatch --array=0-{last}' would.
+SUBMIT_SCRIPT = textwrap.dedent("""\
+    #!/usr/bin/env bash
+    echo "$1" >> "$(dirname "$0")/submissions.txt"
+    for task in $(seq 0 "$1"); do
+        TASK_ID=$task bash "$2" > /dev/null 2>&1 &
+        echo $! >> "$(dirname "$0")/pids.txt"
+    done
+    """)
+
+
+@pytest.fixture()
+def submit_command(tmp_path):
+    script = tmp_path / "submit.sh"
+    script.write_text(SUBMIT_SCRIPT)
+    return f"bash {script} {{last}}"
+
+
+@pytest.fixture()
+def worker_daemon():
+    daemon = WorkerDaemon()
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    daemon.server_close()
+
+
+def test_remote_executor(worker_daemon, tmp_path):
+    executor = RemoteExecutor(worker_daemon.address, worker_daemon.token,
+                              poll_interval_secs=0.05)
+    workflow = Workflow("bash -c 'echo moo && echo bah >&2 && pwd && exit 3'",
+                        cwd=tmp_path, executor=executor)
+    workflow.run()
+    assert workflow.exit_code == 3
+    assert workflow.stdout == f"moo\n{tmp_path}\n".encode()
+    assert workflow.stderr == b"bah\n"
+    # The daemon forgets the job once it has finished.
+    assert worker_daemon._jobs == {}
+
+
+def test_remote_executor_timeout(worker_daemon):
+    executor = RemoteExecutor(worker_daemon.address, worker_daemon.token,
+                              poll_interval_secs=0.05)
+    workflow = Workflow("sleep 30", timeout=0.2, executor=executor)
+    workflow.run()
+    assert workflow.kill_reason == "it did not finish within 0.2 seconds"
+    assert workflow.failed
+
+
+def test_remote_executor_unreachable(worker_daemon):
+    executor = RemoteExecutor(worker_daemon.address, worker_daemon.token)
+    worker_daemon.shutdown()
+    worker_daemon.server_close()
+    workflow = Workflow("echo moo", executor=executor)
+    workflow.run()
+    assert workflow.failed
+    assert isinstance(workflow.errors[0], ConnectionRefusedError)
+
+
+def test_remote_executor_unknown_job(worker_daemon):
+    executor = RemoteExecutor(worker_daemon.address, worker_daemon.token)
+    with pytest.raises(RuntimeError) as error:
+        executor.request(action="status", job="42")
+    error.match("could not status: Unknown job: '42'")
+
+
+def test_remote_executor_invalid_token(worker_daemon, tmp_path):
+    executor = RemoteExecutor(worker_daemon.address, "wrong",
+                              poll_interval_secs=0.05)
+    workflow = Workflow("touch moo.txt", cwd=tmp_path, executor=executor)
+    workflow.run()
+    assert workflow.failed
+    assert "Invalid token" in str(workflow.errors[0])
+    assert not (tmp_path / "moo.txt").exists()
+
+
+def test_worker_daemon_generates_token():
+    with WorkerDaemon() as first, WorkerDaemon() as second:
+        assert first.token
+        assert first.token != second.token
+
+
+def test_workflow_remote_option(worker_daemon, testdir, monkeypatch):
+    monkeypatch.setenv(TOKEN_VARIABLE, worker_daemon.token)
+    host, port = worker_daemon.address
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: remote
+          command: bash -c 'echo moo > moo.txt'
+          files:
+            - path: moo.txt
+              contains:
+                - moo
+        """))
+    result = testdir.runpytest("-v", "--workflow-remote", f"{host}:{port}")
+    result.assert_outcomes(passed=3)
+
+
+def test_workflow_remote_option_without_token(testdir, monkeypatch):
+    monkeypatch.delenv(TOKEN_VARIABLE, raising=False)
+    testdir.makefile(".yml", test="- name: remote\n  command: echo moo\n")
+    result = testdir.runpytest("--workflow-remote", "127.0.0.1:1")
+    assert result.ret != 0
+    result.stderr.fnmatch_lines(
+        [f"*--workflow-remote requires the token*{TOKEN_VARIABLE}*"])
+
+
+def test_workflow_executor_hook(testdir):
+    testdir.makeconftest(textwrap.dedent("""\
+        from pytest_workflow.executors import LocalExecutor
+
+        class EchoExecutor(LocalExecutor):
+            def submit(self, args, cwd, stdout_file, stderr_file):
+                return super().submit(["echo", "executed"] + args, cwd,
+                                      stdout_file, stderr_file)
+
+        def pytest_workflow_executor(config):
+            return EchoExecutor()
+        """))
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: hooked
+          command: exit 1
+          stdout:
+            contains:
+              - executed exit 1
+        """))
+    result = testdir.runpytest("-v")
+    result.assert_outcomes(passed=2)
+
+
+def test_incomplete_executor_fails_on_creation():
+    class NoSubmitExecutor(Executor):
+        pass
+
+    class NoSignalJob(Job):
+        returncode = None
+
+        def wait(self, timeout=None):
+            return 0
+
+    with pytest.raises(TypeError) as error:
+        NoSubmitExecutor()
+    error.match("submit")
+    with pytest.raises(TypeError) as error:
+        NoSignalJob()
+    error.match("signal")
+
+
+def test_batch_executor_array_job(submit_command, tmp_path):
+    executor = BatchExecutor(submit_command, tmp_path / "batch",
+                             task_variable="TASK_ID", poll_interval_secs=0.2)
+    workflows = [Workflow(f"bash -c 'echo {number} && exit {number}'",
+                          name=f"workflow{number}", executor=executor)
+                 for number in range(3)]
+    for workflow in workflows:
+        workflow.start()
+    for number, workflow in enumerate(workflows):
+        workflow.wait(timeout_secs=30)
+        assert workflow.exit_code == number
+        assert workflow.stdout == f"{number}\n".encode()
+    # The workflows are submitted together as one array job.
+    assert (tmp_path / "submissions.txt").read_text() == "2\n"
+
+
+def test_batch_executor_no_thread_per_workflow(submit_command, tmp_path):
+    # The executor notifies the queue when a task has finished, so no
+    # thread waits on each workflow.
+    executor = BatchExecutor(submit_command, tmp_path / "batch",
+                             task_variable="TASK_ID", poll_interval_secs=0.1)
+    workflows = [Workflow("sleep 2", name=f"workflow{number}",
+                          executor=executor)
+                 for number in range(20)]
+    workflow_queue = WorkflowQueue()
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    threads = threading.active_count()
+    workflow_queue.start(None)
+    time.sleep(1)
+    extra_threads = threading.active_count() - threads
+    workflow_queue.process(None)
+    assert extra_threads < 5
+    assert all(workflow.exit_code == 0 for workflow in workflows)
+
+
+def test_batch_executor_timeout(submit_command, tmp_path):
+    executor = BatchExecutor(submit_command, tmp_path / "batch",
+                             task_variable="TASK_ID", poll_interval_secs=0.2)
+    workflow = Workflow("sleep 30", timeout=0.5, executor=executor)
+    start_time = time.time()
+    workflow.run()
+    assert time.time() - start_time < 10
+    assert workflow.kill_reason == "it did not finish within 0.5 seconds"
+    assert workflow.failed
+
+
+def test_batch_executor_submit_fails(tmp_path):
+    executor = BatchExecutor("bash -c 'echo busy >&2 && exit 1'",
+                             tmp_path / "batch", poll_interval_secs=0.1)
+    workflow = Workflow("echo moo", executor=executor)
+    workflow.run()
+    assert workflow.failed
+    assert "failed: busy" in str(workflow.errors[0])
+
+
+def test_batch_executor_task_never_starts(tmp_path):
+    # The scheduler accepts the array job, but never starts it.
+    cancelled = tmp_path / "cancelled.txt"
+    executor = BatchExecutor(
+        "bash -c 'echo Submitted batch job 42'", tmp_path / "batch",
+        cancel_command=f"bash -c 'echo $0 > {cancelled}' {{job}}_{{task}}",
+        poll_interval_secs=0.1)
+    workflow = Workflow("echo moo", timeout=0.5, executor=executor)
+    start_time = time.time()
+    workflow.run()
+    assert time.time() - start_time < 5
+    assert workflow.kill_reason == "it did not finish within 0.5 seconds"
+    assert cancelled.read_text() == "42_0\n"
+
+
+def test_batch_executor_task_terminated(submit_command, tmp_path):
+    # The scheduler terminates the task, for example at its time limit.
+    executor = BatchExecutor(submit_command, tmp_path / "batch",
+                             task_variable="TASK_ID", poll_interval_secs=0.1)
+    workflow = Workflow("sleep 30", executor=executor)
+    workflow.start()
+    started_file = tmp_path / "batch" / f"0_{Path.cwd().name}.started"
+    for _ in range(100):
+        if started_file.exists():
+            break
+        time.sleep(0.1)
+    os.kill(int((tmp_path / "pids.txt").read_text()), signal.SIGTERM)
+    workflow.wait(timeout_secs=10)
+    assert workflow.exit_code == 128 + signal.SIGTERM
+
+
+def test_workflow_batch_submit_timeout(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: queued
+          command: echo moo
+        """))
+    start_time = time.time()
+    result = testdir.runpytest("-v", "--workflow-batch-submit", "true",
+                               "--workflow-timeout", "1")
+    assert time.time() - start_time < 15
+    result.assert_outcomes(failed=1)
+    assert "'queued' was killed: it did not finish within 1 seconds" in (
+        result.stdout.str())
+
+
+def test_workflow_batch_submit_dependency(submit_command, testdir):
+    # The files of the tasks are not linked into the directories of the
+    # workflows that depend on them.
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: first
+          command: echo first
+        - name: second
+          command: echo second
+          depends_on:
+            - first
+        """))
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("-v", "--kwd", "--basetemp", tempdir,
+                               "--workflow-batch-submit", submit_command,
+                               "--workflow-batch-task-variable", "TASK_ID")
+    result.assert_outcomes(passed=2)
+    for workflow in ("first", "second"):
+        assert sorted(path.name for path in Path(tempdir, workflow).iterdir()
+                      ) == ["log.err", "log.out", "test.yml"]
+    scripts = sorted(Path(tempdir, ".batch").glob("*_first.sh"))
+    assert len(scripts) == 1
+    assert "echo first" in scripts[0].read_text()
+    shutil.rmtree(tempdir)
+
+
+def test_workflow_batch_submit_option(submit_command, testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: batch
+          command: bash -c 'echo moo > moo.txt'
+          files:
+            - path: moo.txt
+              contains:
+                - moo
+        """))
+    result = testdir.runpytest("-v", "--workflow-batch-submit",
+                               submit_command,
+                               "--workflow-batch-task-variable", "TASK_ID")
+    result.assert_outcomes(passed=3)
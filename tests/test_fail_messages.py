@@ -16,7 +16,14 @@
 
 """Tests the failure messages"""
 
+import shutil
+import signal
+import subprocess  # nosec
+import sys
+import tempfile
 import textwrap
+import time
+from pathlib import Path
 from typing import List, Tuple  # noqa: F401  # Used in comments
 
 import pytest
@@ -160,6 +167,18 @@ FAILURE_MESSAGE_TESTS: List[Tuple[str, str]] = [
             - "^He.*"
      """,
      "to file::file.txt::content::does not contain '^He.*"),
+    ("""\
+    - name: too large
+      command: bash -c 'head -c 100000 /dev/zero > out.bin && sleep 5'
+      max_disk: 1K
+    """,
+     "'too large' was killed: the working directory used"),
+    ("""\
+    - name: too slow
+      command: sleep 30
+      timeout: 0.5
+    """,
+     "'too slow' was killed: it did not finish within 0.5 seconds"),
 ]
 
 
@@ -170,3 +189,61 @@ def test_messages(test: str, message: str, testdir):
     # possible due to multiple levels of process launching.
     result = testdir.runpytest("-v")
     assert message in result.stdout.str()
+
+
+def test_workflow_timeout_frees_thread(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: hangs
+          command: sleep 30
+        - name: next
+          command: echo next
+        """))
+    result = testdir.runpytest("-v", "--wt", "1", "--workflow-timeout", "0.5")
+    result.assert_outcomes(passed=1, failed=1)
+    assert ("'hangs' was killed: it did not finish within 0.5 seconds"
+            in result.stdout.str())
+
+
+def test_workflow_fail_fast(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: broken
+          command: bash -c 'sleep 0.5 && exit 1'
+        - name: slow
+          command: sleep 30
+        - name: waiting
+          command: echo waiting
+        """))
+    result = testdir.runpytest("-v", "-rs", "--wt", "2",
+                               "--workflow-fail-fast")
+    result.assert_outcomes(failed=2, skipped=1)
+    output = result.stdout.str()
+    assert "'slow' was killed: 'broken' failed" in output
+    assert "'waiting' was skipped because 'broken' failed" in output
+
+
+@pytest.mark.parametrize("options", [[], ["--stream"]])
+def test_interrupt_kills_workflows(testdir, options):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: first
+          command: bash -c 'touch ../first_started && sleep 20'
+        - name: second
+          command: bash -c 'touch ../second_started && sleep 20'
+        """))
+    tempdir = Path(tempfile.mkdtemp())
+    process = subprocess.Popen(  # nosec
+        [sys.executable, "-m", "pytest", "--wt", "2",
+         "--basetemp", str(tempdir)] + options,
+        cwd=str(testdir.tmpdir), stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    started = [tempdir / "first_started", tempdir / "second_started"]
+    for _ in range(100):
+        if all(path.exists() for path in started):
+            break
+        time.sleep(0.1)
+    start_time = time.time()
+    process.send_signal(signal.SIGINT)
+    output, _ = process.communicate(timeout=30)
+    # The workflows are killed rather than waited on.
+    assert time.time() - start_time < 10
+    assert b"KeyboardInterrupt" in output
+    shutil.rmtree(str(tempdir))
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
 
+import textwrap
 import time
 
 import pytest
@@ -58,3 +59,131 @@ def test_multithreaded(threads, testdir):
     # If the completion time is longer than (iterations * SLEEP_TIME + 1) then
     # the code is probably not threaded properly.
     assert completion_time < ((iterations + 1) * SLEEP_TIME)
+
+
+def test_workflow_cpus(testdir):
+    test = [dict(name="large", command=SLEEP_COMMAND,
+                 resources=dict(cpus=2)),
+            dict(name="small", command=SLEEP_COMMAND),
+            dict(name="other small", command=SLEEP_COMMAND)]
+    testdir.makefile(".yml", test=yaml.safe_dump(test))
+    start_time = time.time()
+    result = testdir.runpytest("-v", "--workflow-cpus", "2")
+    completion_time = time.time() - start_time
+    assert result.ret == 0
+    # The large workflow uses both cpus. The small workflows run together.
+    assert (2 * SLEEP_TIME) < completion_time < (3 * SLEEP_TIME)
+
+
+STREAM_TESTS = textwrap.dedent("""\
+    - name: slow
+      command: bash -c 'sleep 1 && touch done'
+      files:
+        - path: done
+    - name: fast
+      command: echo fast
+    """)
+
+STREAM_CUSTOM_TESTS = textwrap.dedent("""\
+    import pytest
+
+    @pytest.mark.workflow("fast")
+    def test_fast(workflow_dir):
+        # The slow workflow is still running.
+        assert not (workflow_dir.parent / "slow" / "done").exists()
+
+    def test_without_workflow():
+        pass
+    """)
+
+
+def test_stream(testdir):
+    testdir.makefile(".yml", test_stream=STREAM_TESTS)
+    testdir.makefile(".py", test_stream_custom=STREAM_CUSTOM_TESTS)
+    result = testdir.runpytest("-v", "--stream", "--wt", "2", "--kwd")
+    result.assert_outcomes(passed=5)
+    output = result.stdout.str()
+    # Tests without a workflow are run first. The tests of the slow workflow
+    # are run last.
+    assert (output.index("test_without_workflow PASSED") <
+            output.index("test_fast[fast] PASSED") <
+            output.index("slow::exit code should be 0 PASSED"))
+
+
+def test_stream_reports_between_tests(testdir):
+    # The slow workflow finishes while the test of the fast workflow runs.
+    # Its report is written after the line of that test.
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: fast
+          command: echo fast
+        - name: slow
+          command: sleep 0.5
+        """))
+    testdir.makefile(".py", test_custom=textwrap.dedent("""\
+        import time
+
+        import pytest
+
+        @pytest.mark.workflow("fast")
+        def test_fast():
+            time.sleep(1.5)
+        """))
+    result = testdir.runpytest("-v", "--stream", "--wt", "2")
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines(["*test_fast*PASSED*", "'slow' done."])
+
+
+def test_stream_stops_workflows(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: broken
+          command: bash -c 'exit 1'
+        - name: slow
+          command: sleep 30
+        """))
+    start_time = time.time()
+    result = testdir.runpytest("-v", "--stream", "--wt", "2", "-x")
+    # The slow workflow is killed rather than waited on.
+    assert time.time() - start_time < 10
+    result.assert_outcomes(failed=1)
+
+
+def test_no_stream(testdir):
+    testdir.makefile(".yml", test_stream=STREAM_TESTS)
+    testdir.makefile(".py", test_stream_custom=STREAM_CUSTOM_TESTS)
+    result = testdir.runpytest("-v", "--wt", "2", "--kwd")
+    result.assert_outcomes(passed=4, failed=1)
+
+
+COLLECTION_TESTS = textwrap.dedent("""\
+    import time
+    from pathlib import Path
+
+    # Collection of this module waits for the workflow to have run.
+    STARTED = Path("{started}")
+    for _ in range(100):
+        if STARTED.exists():
+            break
+        time.sleep(0.1)
+
+    def test_started_during_collection():
+        assert STARTED.exists()
+    """)
+
+
+def test_start_during_collection(testdir):
+    started = testdir.tmpdir / "started"
+    # The YAML file is collected before the python module.
+    testdir.makefile(".yml", test=textwrap.dedent(f"""\
+        - name: early
+          command: touch {started}
+        """))
+    testdir.makefile(".py", test_collection=COLLECTION_TESTS.format(
+        started=started))
+    result = testdir.runpytest("-v", "--start-during-collection")
+    result.assert_outcomes(passed=2)
+
+
+def test_workflow_threads_auto(testdir):
+    testdir.makefile(".yml", test=yaml.safe_dump(MULTHITHREADED_TEST))
+    result = testdir.runpytest("-v", "--wt", "auto")
+    result.assert_outcomes(passed=4)
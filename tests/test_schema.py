@@ -50,6 +50,18 @@ def test_workflowtest():
         assert tests[0].stdout.contains == ["bla"]
         assert tests[0].exit_code == 127
         assert tests[0].tags == ["simple", "use_echo"]
+        assert tests[0].inputs == ["config.yml", "data/**/*.fastq"]
+        assert tests[1].inputs is None
+        assert tests[0].max_disk == 2 * 1024 ** 3
+        assert tests[1].max_disk is None
+        assert tests[0].cpus == 4
+        assert tests[0].memory == 8 * 1024 ** 3
+        assert tests[1].cpus == 1
+        assert tests[1].memory == 0
+        assert tests[0].depends_on == ["other test"]
+        assert tests[1].depends_on == []
+        assert tests[0].timeout == 3600
+        assert tests[1].timeout is None
 
 
 def test_workflowtest_regex():
@@ -72,3 +72,33 @@ def test_category_tag2(testdir):
     assert "three again" not in result
     assert "four" in result
     assert "nine" not in result
+
+
+def test_deselected_workflows_not_run(testdir):
+    testdir.makefile(".yml", test_tags=TAG_TESTS)
+    result = testdir.runpytest("-v", "-k", "four").stdout.str()
+    assert "command:   echo 4" in result
+    assert "command:   echo 3" not in result
+    assert "command:   echo 9" not in result
+
+
+def test_custom_test_selects_workflow(testdir):
+    testdir.makefile(".yml", test_tags=TAG_TESTS)
+    testdir.makefile(".py", test_custom=textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.workflow("nine")
+        def test_nine(workflow_dir):
+            assert (workflow_dir / "log.out").read_text() == "9\\n"
+        """))
+    result = testdir.runpytest("-v", "-k", "test_nine")
+    assert "command:   echo 9" in result.stdout.str()
+    assert "command:   echo 4" not in result.stdout.str()
+    result.assert_outcomes(passed=1)
+
+
+def test_collect_only_does_not_run_workflows(testdir):
+    testdir.makefile(".yml", test_tags=TAG_TESTS)
+    result = testdir.runpytest("-v", "--collect-only").stdout.str()
+    assert "command:" not in result
+    assert "exit code should be 0" in result
@@ -15,12 +15,17 @@
 
 """Tests whether the temporary directories are correctly saved/destroyed"""
 
+import json
 import re
 import shutil
+import subprocess  # nosec
 import tempfile
 import textwrap
+import time
 from pathlib import Path
 
+from pytest_workflow import plugin
+
 from .test_success_messages import SIMPLE_ECHO
 
 
@@ -46,6 +51,44 @@ def test_directory_not_kept(testdir):
             ) in result.stdout.str()
 
 
+def test_directory_removed_after_last_test(testdir):
+    testdir.makefile(".yml", test_a=textwrap.dedent("""\
+        - name: first
+          command: echo first
+        """), test_b=textwrap.dedent("""\
+        - name: second
+          command: echo second
+        """))
+    testdir.makefile(".py", test_c=textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.workflow("second")
+        def test_second(workflow_dir):
+            # The tests of the first workflow have all finished.
+            assert not (workflow_dir.parent / "first").exists()
+            assert workflow_dir.exists()
+        """))
+    result = testdir.runpytest("-v")
+    assert result.ret == 0
+    result.assert_outcomes(passed=3)
+
+
+def test_directory_removed_in_background(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("-v", "--background-cleanup",
+                               "--basetemp", tempdir)
+    assert result.ret == 0
+    # The directory is moved to the trash before pytest finishes.
+    assert not Path(tempdir, "simple_echo").exists()
+    for _ in range(100):
+        if not list(Path(tempdir).iterdir()):
+            break
+        time.sleep(0.05)
+    assert list(Path(tempdir).iterdir()) == []
+    shutil.rmtree(tempdir)
+
+
 def test_basetemp_correct(testdir):
     testdir.makefile(".yml", test=SIMPLE_ECHO)
     tempdir = tempfile.mkdtemp()
@@ -148,6 +191,280 @@ def test_directory_of_symlinks(testdir):
     shutil.rmtree(working_dir)
 
 
+def test_directory_of_reflinks(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    subdir = testdir.mkdir("subdir")
+    Path(str(subdir), "subfile.txt").write_text("test")
+    result = testdir.runpytest("-v", "--reflink", "--kwd")
+    working_dir = re.search(
+        r"command:   echo moo\n\tdirectory: ([\w/_-]*)",
+        result.stdout.str()).group(1)
+    assert result.ret == 0
+    assert not Path(working_dir, "test.yml").is_symlink()
+    assert Path(working_dir, "subdir", "subfile.txt").read_text() == "test"
+    shutil.rmtree(working_dir)
+
+
+def test_reflink_before_path(testdir):
+    # --reflink does not take the path of the tests as its value.
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    result = testdir.runpytest("-v", "--reflink", "test.yml")
+    assert result.ret == 0
+
+
+def test_symlink_and_reflink_incompatible(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    result = testdir.runpytest("-v", "--symlink", "--reflink")
+    assert ("Only one of --symlink, --hardlink and --reflink can be used."
+            in result.stderr.str())
+
+
+def test_directory_of_hardlinks(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    subdir = testdir.mkdir("subdir")
+    subfile = Path(str(subdir), "subfile.txt")
+    subfile.write_text("test")
+    result = testdir.runpytest("-v", "--hardlink", "--kwd")
+    working_dir = re.search(
+        r"command:   echo moo\n\tdirectory: ([\w/_-]*)",
+        result.stdout.str()).group(1)
+    assert result.ret == 0
+    linked_file = Path(working_dir, "subdir", "subfile.txt")
+    assert not linked_file.is_symlink()
+    assert linked_file.stat().st_ino == subfile.stat().st_ino
+    assert "have been modified" not in result.stdout.str()
+    shutil.rmtree(working_dir)
+
+
+def test_hardlink_modified_message(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: modify shared file
+          command: bash -c 'echo moo >> data.txt'
+        """))
+    data = Path(str(testdir.tmpdir), "data.txt")
+    data.write_text("data\n")
+    result = testdir.runpytest("-v", "--hardlink")
+    assert ("The following files were hardlinked into the workflow "
+            f"directories and have been modified: {data}."
+            ) in result.stdout.str()
+
+
+def test_hardlink_modified_message_with_inputs(testdir):
+    # The directory of small is prepared first and only contains a.txt. The
+    # modification of b.txt by writer is reported as well.
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: small
+          command: cat a.txt
+          inputs:
+            - a.txt
+        - name: writer
+          command: bash -c 'echo changed >> b.txt'
+          depends_on:
+            - small
+        """))
+    Path(str(testdir.tmpdir), "a.txt").write_text("a\n")
+    data = Path(str(testdir.tmpdir), "b.txt")
+    data.write_text("b\n")
+    result = testdir.runpytest("-v", "--hardlink")
+    assert ("The following files were hardlinked into the workflow "
+            f"directories and have been modified: {data}."
+            ) in result.stdout.str()
+
+
+def test_directory_copy_threads(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    subdir = testdir.mkdir("subdir")
+    Path(str(subdir), "subfile.txt").write_text("test")
+    result = testdir.runpytest("-v", "--copy-threads", "4", "--kwd")
+    working_dir = re.search(
+        r"command:   echo moo\n\tdirectory: ([\w/_-]*)",
+        result.stdout.str()).group(1)
+    assert result.ret == 0
+    assert Path(working_dir, "subdir", "subfile.txt").read_text() == "test"
+    shutil.rmtree(working_dir)
+
+
+def test_directory_snapshot(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    subdir = testdir.mkdir("subdir")
+    subfile = Path(str(subdir), "subfile.txt")
+    subfile.write_text("test")
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("-v", "--snapshot", "--hardlink", "--kwd",
+                               "--basetemp", tempdir)
+    assert result.ret == 0
+    snapshot_file = Path(tempdir, ".snapshot", "subdir", "subfile.txt")
+    workflow_file = Path(tempdir, "simple_echo", "subdir", "subfile.txt")
+    assert snapshot_file.read_text() == "test"
+    # The workflow directory is linked to the snapshot, not to the rootdir.
+    assert workflow_file.stat().st_ino == snapshot_file.stat().st_ino
+    assert workflow_file.stat().st_ino != subfile.stat().st_ino
+    shutil.rmtree(tempdir)
+
+
+def test_directory_snapshot_multiple_workflows(testdir):
+    # The workflow directories are prepared in parallel. The snapshot is
+    # created only once.
+    testdir.makefile(".yml", test="".join(
+        f"- name: workflow{number}\n  command: cat d0/f0.txt\n"
+        for number in range(6)))
+    for directory in range(5):
+        subdir = testdir.mkdir(f"d{directory}")
+        for number in range(50):
+            Path(str(subdir), f"f{number}.txt").write_text("test")
+    result = testdir.runpytest("-v", "--snapshot", "--wt", "4")
+    assert result.ret == 0
+    result.assert_outcomes(passed=6)
+
+
+def test_directory_snapshot_removed(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("-v", "--snapshot", "--basetemp", tempdir)
+    assert result.ret == 0
+    assert not Path(tempdir, ".snapshot").exists()
+    shutil.rmtree(tempdir)
+
+
+def test_git_aware_copy_plan_cached(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    testdir_path = Path(str(testdir.tmpdir))
+    Path(testdir_path, "tracked.txt").write_text("tracked")
+    subprocess.run(["git", "-C", str(testdir_path), "init"])  # nosec
+    subprocess.run(["git", "-C", str(testdir_path), "add",  # nosec
+                    "test.yml", "tracked.txt"])
+    tempdir = tempfile.mkdtemp()
+    testdir.runpytest("-v", "--git-aware", "--basetemp", tempdir)
+    cache_file = Path(testdir_path, ".pytest_cache", "v", "pytest_workflow",
+                      "copy_plan")
+    cache = json.loads(cache_file.read_text())
+    assert ["tracked.txt", False] in cache["plan"]
+    # The cached plan is used as long as the git index does not change.
+    cache["plan"].remove(["tracked.txt", False])
+    cache_file.write_text(json.dumps(cache))
+    testdir.runpytest("-v", "--git-aware", "--kwd", "--basetemp", tempdir)
+    assert Path(tempdir, "simple_echo", "test.yml").exists()
+    assert not Path(tempdir, "simple_echo", "tracked.txt").exists()
+    # Changing the index invalidates the cache.
+    Path(testdir_path, "new.txt").write_text("new")
+    subprocess.run(["git", "-C", str(testdir_path), "add",  # nosec
+                    "new.txt"])
+    testdir.runpytest("-v", "--git-aware", "--kwd", "--basetemp", tempdir)
+    assert Path(tempdir, "simple_echo", "tracked.txt").exists()
+    assert Path(tempdir, "simple_echo", "new.txt").exists()
+    shutil.rmtree(tempdir)
+
+
+def test_directory_inputs(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: inputs
+          command: cat data/needed.txt
+          inputs:
+            - data/needed.txt
+        """))
+    data = testdir.mkdir("data")
+    Path(str(data), "needed.txt").write_text("needed")
+    Path(str(data), "not_needed.txt").write_text("not needed")
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("-v", "--kwd", "--basetemp", tempdir)
+    assert result.ret == 0
+    assert Path(tempdir, "inputs", "data", "needed.txt").exists()
+    assert not Path(tempdir, "inputs", "data", "not_needed.txt").exists()
+    assert not Path(tempdir, "inputs", "test.yml").exists()
+    shutil.rmtree(tempdir)
+
+
+def test_directory_workflow_ignore(testdir):
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    Path(str(testdir.tmpdir), ".workflowignore").write_text(
+        "# Ignore the outputs of earlier runs\nresults/\n")
+    results = testdir.mkdir("results")
+    Path(str(results), "old.txt").write_text("old")
+    Path(str(testdir.tmpdir), "run.log").write_text("log")
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("-v", "--kwd", "--basetemp", tempdir,
+                               "--workflow-ignore", "*.log")
+    assert result.ret == 0
+    assert Path(tempdir, "simple_echo", "test.yml").exists()
+    assert not Path(tempdir, "simple_echo", "results").exists()
+    assert not Path(tempdir, "simple_echo", "run.log").exists()
+    shutil.rmtree(tempdir)
+
+
+def test_disk_budget_saves_disk_usage(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: large output
+          command: bash -c 'head -c 100000 /dev/zero > out.bin'
+        """))
+    result = testdir.runpytest("-v", "--workflow-disk-budget", "10M")
+    assert result.ret == 0
+    disk_usage = json.loads(Path(str(testdir.tmpdir), ".pytest_cache", "v",
+                                 "pytest_workflow", "disk_usage").read_text())
+    assert disk_usage["large output"] >= 100000
+
+
+def test_disk_budget_stats_plan_once(testdir, monkeypatch):
+    # The files of the rootdir are statted once, not once per workflow.
+    calls = []
+    plan_file_sizes = plugin.plan_file_sizes
+
+    def counting_plan_file_sizes(src, plan):
+        calls.append(src)
+        return plan_file_sizes(src, plan)
+
+    monkeypatch.setattr(plugin, "plan_file_sizes", counting_plan_file_sizes)
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: first
+          command: echo moo
+        - name: second
+          command: echo moo
+        - name: with inputs
+          command: echo moo
+          inputs:
+            - test.yml
+        """))
+    result = testdir.runpytest("-v", "--workflow-disk-budget", "10M",
+                               "--wt", "3", "--workflow-check-interval",
+                               "0.1")
+    assert result.ret == 0
+    assert len(calls) == 1
+
+
+def test_durations_saved(testdir):
+    testdir.makefile(".yml", test=textwrap.dedent("""\
+        - name: short
+          command: sleep 0.1
+        - name: long
+          command: sleep 0.5
+        """))
+    testdir.runpytest("-v")
+    durations = json.loads(Path(str(testdir.tmpdir), ".pytest_cache", "v",
+                                "pytest_workflow", "durations").read_text())
+    assert 0.1 < durations["short"] < durations["long"]
+    # The longest workflow is started first in the next session.
+    result = testdir.runpytest("-v")
+    assert (result.stdout.str().index("command:   sleep 0.5") <
+            result.stdout.str().index("command:   sleep 0.1"))
+
+
+def test_directory_unremovable_original_path(testdir, monkeypatch):
+    # Directories that can not be removed are moved back from the trash and
+    # reported at their original path.
+    monkeypatch.setattr(plugin, "remove_trees", lambda directories: [
+        str(directory) for directory in directories])
+    testdir.makefile(".yml", test=SIMPLE_ECHO)
+    tempdir = tempfile.mkdtemp()
+    result = testdir.runpytest("--basetemp", tempdir)
+    assert result.ret == 0
+    workflow_dir = Path(tempdir, "simple_echo")
+    assert workflow_dir.exists()
+    assert not any(path.name.startswith(".trash_")
+                   for path in Path(tempdir).iterdir())
+    assert (f"Unable to remove the following directories due to permission "
+            f"errors: {workflow_dir}." in result.stdout.str())
+    shutil.rmtree(tempdir)
+
+
 def test_directory_unremovable_message(testdir):
     # Following directory contains nested contents owned by root.
     test = textwrap.dedent("""
@@ -13,17 +13,27 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+import errno
+import fcntl
 import hashlib
 import os
+import re
 import shutil
 import subprocess  # nosec
 import tempfile
+import time
 from pathlib import Path
 
 import pytest
 
-from pytest_workflow.util import duplicate_tree, file_md5sum, git_root, \
-    is_in_dir, link_tree, replace_whitespace
+from pytest_workflow.util import IgnorePatterns, available_cpus, \
+    cgroup_cpu_limit, copy_plan, directory_disk_usage, duplicate_tree, \
+    file_md5sum, filter_plan, git_index_path, git_root, glob_to_regex, \
+    is_in_dir, link_outputs, link_tree, modified_hardlinks, move_to_trash, \
+    parse_address, parse_copy_threads, parse_shard, parse_size, \
+    parse_threads, plan_file_sizes, plan_file_stats, plan_size, \
+    reflink_or_copy, remove_tree_in_background, remove_trees, \
+    replace_whitespace, workflow_group_from_nodeid, xdist_worker_index
 
 WHITESPACE_TESTS = [
     ("bla\nbla", "bla_bla"),
@@ -126,6 +136,164 @@ def test_duplicate(git_dir):
     assert (dest / "test" / "test.txt").exists()
 
 
+@pytest.mark.parametrize(["symlink", "git_aware"],
+                         [(False, False), (True, False), (False, True)])
+def test_duplicate_threaded(git_dir, symlink, git_aware):
+    subdir = git_dir / "test" / "subdir"
+    subdir.mkdir()
+    for i in range(20):
+        Path(subdir, f"{i}.txt").write_text(str(i))
+    subprocess.run(["git", "-C", str(git_dir), "add", str(subdir)])  # nosec
+    dest = Path(tempfile.mkdtemp()) / "test"
+    duplicate_tree(git_dir, dest, symlink=symlink, git_aware=git_aware,
+                   threads=4)
+    assert (dest / ".git").exists() is not git_aware
+    assert (dest / "test" / "test.txt").exists()
+    for i in range(20):
+        dest_file = Path(dest, "test", "subdir", f"{i}.txt")
+        assert dest_file.read_text() == str(i)
+        assert dest_file.is_symlink() is symlink
+    shutil.rmtree(dest.parent)
+
+
+def test_copy_plan(git_dir):
+    (git_dir / "untracked.txt").touch()
+    plan = copy_plan(git_dir, git_aware=True)
+    assert plan == [("test", True), (os.path.join("test", "test.txt"), False)]
+    plan = copy_plan(git_dir)
+    assert ("untracked.txt", False) in plan
+    assert (".git", True) in plan
+    # Directories are listed before their contents.
+    assert plan.index(("test", True)) < plan.index(
+        (os.path.join("test", "test.txt"), False))
+
+
+def test_duplicate_with_plan(git_dir):
+    (git_dir / "untracked.txt").touch()
+    dest = Path(tempfile.mkdtemp()) / "test"
+    # The plan is used instead of traversing the directory.
+    duplicate_tree(git_dir, dest, plan=[("test", True)])
+    assert (dest / "test").is_dir()
+    assert not (dest / "test" / "test.txt").exists()
+    assert not (dest / "untracked.txt").exists()
+    shutil.rmtree(dest.parent)
+
+
+GLOB_TESTS = [
+    ("data/*.txt", "data/a.txt", True),
+    ("data/*.txt", "data/sub/a.txt", False),
+    ("data/**/*.txt", "data/a.txt", True),
+    ("data/**/*.txt", "data/sub/sub/a.txt", True),
+    ("**", "data/sub/a.txt", True),
+    ("data?.txt", "data/.txt", False),
+    ("data[0-9].txt", "data1.txt", True),
+    ("data[!0-9].txt", "data1.txt", False),
+    ("data.txt", "dataXtxt", False),
+]
+
+
+@pytest.mark.parametrize(["pattern", "path", "match"], GLOB_TESTS)
+def test_glob_to_regex(pattern, path, match):
+    assert bool(re.match(glob_to_regex(pattern), path)) is match
+
+
+def test_filter_plan():
+    plan = [("config.yml", False),
+            ("data", True),
+            (os.path.join("data", "big.bam"), False),
+            (os.path.join("data", "small"), True),
+            (os.path.join("data", "small", "a.txt"), False),
+            (os.path.join("data", "small", "b.txt"), False),
+            ("src", True),
+            (os.path.join("src", "main.py"), False)]
+    assert filter_plan(plan, ["config.yml", "data/small/"]) == [
+        ("config.yml", False),
+        ("data", True),
+        (os.path.join("data", "small"), True),
+        (os.path.join("data", "small", "a.txt"), False),
+        (os.path.join("data", "small", "b.txt"), False)]
+    assert filter_plan(plan, ["**/a.txt"]) == [
+        ("data", True),
+        (os.path.join("data", "small"), True),
+        (os.path.join("data", "small", "a.txt"), False)]
+    assert filter_plan(plan, ["does_not_exist"]) == []
+
+
+IGNORE_PATTERNS = ["# comment", "node_modules/", "*.log", "!keep.log",
+                   "/build", "results/**/*.bam"]
+
+IGNORE_TESTS = [
+    ("node_modules", True, True),
+    (os.path.join("sub", "node_modules"), True, True),
+    ("node_modules", False, False),
+    (os.path.join("sub", "run.log"), False, True),
+    ("keep.log", False, False),
+    ("build", True, True),
+    (os.path.join("sub", "build"), True, False),
+    (os.path.join("results", "a", "b.bam"), False, True),
+    (os.path.join("results", "b.bai"), False, False),
+]
+
+
+@pytest.mark.parametrize(["path", "is_dir", "ignored"], IGNORE_TESTS)
+def test_ignore_patterns(path, is_dir, ignored):
+    assert IgnorePatterns(IGNORE_PATTERNS).match(path, is_dir) is ignored
+
+
+def test_ignore_patterns_match_file():
+    ignore = IgnorePatterns(IGNORE_PATTERNS)
+    assert ignore.match_file(os.path.join("node_modules", "pkg", "index.js"))
+    assert not ignore.match_file(os.path.join("src", "index.js"))
+
+
+def test_duplicate_ignore(git_dir):
+    (git_dir / "test" / "ignored.log").touch()
+    node_modules = git_dir / "node_modules"
+    node_modules.mkdir()
+    (node_modules / "module.js").touch()
+    subprocess.run(["git", "-C", str(git_dir), "add",  # nosec
+                    "test/ignored.log", "node_modules"])
+    ignore = IgnorePatterns(["node_modules/", "*.log"])
+    for git_aware in (True, False):
+        dest = Path(tempfile.mkdtemp()) / "test"
+        duplicate_tree(git_dir, dest, git_aware=git_aware, ignore=ignore)
+        assert (dest / "test" / "test.txt").exists()
+        assert not (dest / "test" / "ignored.log").exists()
+        assert not (dest / "node_modules").exists()
+        shutil.rmtree(dest.parent)
+
+
+def test_duplicate_ignore_pruned(git_dir, monkeypatch):
+    (git_dir / "node_modules").mkdir()
+    original_scandir = os.scandir
+    scanned = []
+
+    def scandir(path):
+        scanned.append(os.path.basename(path))
+        return original_scandir(path)
+    monkeypatch.setattr(os, "scandir", scandir)
+    copy_plan(git_dir, ignore=IgnorePatterns(["node_modules/"]))
+    assert "test" in scanned
+    assert "node_modules" not in scanned
+
+
+def test_duplicate_git_tree_special_characters(git_dir):
+    special_file = git_dir / "test" / "special \"file\"\nwith ü.txt"
+    special_file.write_text("moo")
+    subprocess.run(["git", "-C", str(git_dir), "add",  # nosec
+                    str(special_file)])
+    dest = Path(tempfile.mkdtemp()) / "test"
+    duplicate_tree(git_dir, dest, git_aware=True)
+    assert (dest / "test" / special_file.name).read_text() == "moo"
+    shutil.rmtree(dest.parent)
+
+
+def test_git_index_path(git_dir):
+    assert git_index_path(git_dir / "test") == git_dir / ".git" / "index"
+    (git_dir / ".gitmodules").touch()
+    assert git_index_path(git_dir / "test") is None
+
+
 def test_duplicate_notadirerror():
     fd, file = tempfile.mkstemp()
     dir = tempfile.mkdtemp()
@@ -136,6 +304,261 @@ def test_duplicate_notadirerror():
     os.remove(file)
 
 
+def test_duplicate_reflink(git_dir):
+    dest = Path(tempfile.mkdtemp()) / "test"
+    # Whether the filesystem supports reflinks or not, auto should always
+    # produce a copy.
+    duplicate_tree(git_dir, dest, reflink="auto")
+    assert (dest / ".git").is_dir()
+    assert (dest / "test" / "test.txt").is_file()
+    assert not (dest / "test" / "test.txt").is_symlink()
+    shutil.rmtree(dest.parent)
+
+
+def reflink_unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+
+def test_reflink_or_copy_fallback(monkeypatch):
+    monkeypatch.setattr(fcntl, "ioctl", reflink_unsupported)
+    src_dir = Path(tempfile.mkdtemp())
+    src = src_dir / "src.txt"
+    src.write_text("moo")
+    dest = src_dir / "dest.txt"
+    reflink_or_copy(src, dest)
+    assert dest.read_text() == "moo"
+    shutil.rmtree(src_dir)
+
+
+def test_duplicate_reflink_always_unsupported(git_dir, monkeypatch):
+    monkeypatch.setattr(fcntl, "ioctl", reflink_unsupported)
+    dest = Path(tempfile.mkdtemp()) / "test"
+    with pytest.raises(OSError) as error:
+        duplicate_tree(git_dir, dest, git_aware=True, reflink="always")
+    assert error.value.errno == errno.EOPNOTSUPP
+    shutil.rmtree(dest.parent)
+
+
+def test_duplicate_symlink_reflink_error(git_dir):
+    dest = Path(tempfile.mkdtemp()) / "test"
+    with pytest.raises(ValueError) as error:
+        duplicate_tree(git_dir, dest, symlink=True, reflink="auto")
+    error.match("Only one of symlink, hardlink and reflink can be used at the "
+                "same time.")
+    shutil.rmtree(dest.parent)
+
+
+def test_duplicate_hardlink(git_dir):
+    dest = Path(tempfile.mkdtemp()) / "test"
+    duplicate_tree(git_dir, dest, git_aware=True, hardlink=True)
+    src_file = git_dir / "test" / "test.txt"
+    dest_file = dest / "test" / "test.txt"
+    assert not dest_file.is_symlink()
+    assert dest_file.stat().st_ino == src_file.stat().st_ino
+    shutil.rmtree(dest.parent)
+
+
+def test_modified_hardlinks(git_dir):
+    dest = Path(tempfile.mkdtemp()) / "test"
+    plan = copy_plan(git_dir, git_aware=True)
+    stats = plan_file_stats(git_dir, plan)
+    assert os.path.join("test", "test.txt") in stats
+    duplicate_tree(git_dir, dest, hardlink=True, plan=plan)
+    assert modified_hardlinks(git_dir, stats) == []
+    with Path(dest, "test", "test.txt").open("at") as file_h:
+        file_h.write("moo")
+    assert modified_hardlinks(git_dir, stats) == [
+        os.path.join(git_dir, "test", "test.txt")]
+    shutil.rmtree(dest.parent)
+
+
+@pytest.mark.parametrize(["size", "result"], [
+    (1000, 1000),
+    ("1000", 1000),
+    ("2K", 2048),
+    ("1.5G", int(1.5 * 1024 ** 3)),
+    ("10 MiB", 10 * 1024 ** 2),
+    ("3gb", 3 * 1024 ** 3),
+])
+def test_parse_size(size, result):
+    assert parse_size(size) == result
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError) as error:
+        parse_size("lots")
+    error.match("Invalid disk size: 'lots'")
+
+
+@pytest.mark.parametrize(["threads", "result"], [
+    ("4", 4),
+    ("auto", "auto"),
+    ("AUTO", "auto"),
+])
+def test_parse_threads(threads, result):
+    assert parse_threads(threads) == result
+
+
+@pytest.mark.parametrize("threads", ["0", "-1", "many"])
+def test_parse_threads_invalid(threads):
+    with pytest.raises(ValueError) as error:
+        parse_threads(threads)
+    error.match(f"Invalid number of threads: '{threads}'")
+
+
+@pytest.mark.parametrize("threads", ["0", "-1", "many"])
+def test_parse_copy_threads_invalid(threads):
+    with pytest.raises(ValueError) as error:
+        parse_copy_threads(threads)
+    error.match(f"Invalid number of copy threads: '{threads}'")
+
+
+def test_copy_threads_option_invalid(testdir):
+    testdir.makefile(".yml", test="- name: echo\n  command: echo moo\n")
+    result = testdir.runpytest("--copy-threads", "0")
+    assert result.ret == pytest.ExitCode.USAGE_ERROR
+    result.stderr.fnmatch_lines(["*--copy-threads*"])
+
+
+@pytest.mark.parametrize(["address", "result"], [
+    ("localhost:8765", ("localhost", 8765)),
+    ("10.0.0.1:0", ("10.0.0.1", 0)),
+    ("::1:8765", ("::1", 8765)),
+])
+def test_parse_address(address, result):
+    assert parse_address(address) == result
+
+
+@pytest.mark.parametrize("address", ["localhost", ":8765", "host:port",
+                                     "host:70000"])
+def test_parse_address_invalid(address):
+    with pytest.raises(ValueError) as error:
+        parse_address(address)
+    error.match(f"Invalid address: '{address}'")
+
+
+@pytest.mark.parametrize(["shard", "result"], [
+    ("1/1", (1, 1)),
+    ("2/8", (2, 8)),
+    (" 3 / 4 ", (3, 4)),
+])
+def test_parse_shard(shard, result):
+    assert parse_shard(shard) == result
+
+
+@pytest.mark.parametrize("shard", ["0/2", "3/2", "1", "1/2/3", "a/b"])
+def test_parse_shard_invalid(shard):
+    with pytest.raises(ValueError) as error:
+        parse_shard(shard)
+    error.match(f"Invalid shard: '{shard}'")
+
+
+@pytest.mark.parametrize(["files", "limit"], [
+    ({}, None),
+    ({"cpu.max": "max 100000\n"}, None),
+    ({"cpu.max": "250000 100000\n"}, 3),
+    ({"cpu.max": "50000 100000\n"}, 1),
+    ({"cpu/cpu.cfs_quota_us": "-1\n", "cpu/cpu.cfs_period_us": "100000\n"},
+     None),
+    ({"cpu/cpu.cfs_quota_us": "200000\n",
+      "cpu/cpu.cfs_period_us": "100000\n"}, 2),
+])
+def test_cgroup_cpu_limit(files, limit):
+    cgroup_root = Path(tempfile.mkdtemp())
+    for name, content in files.items():
+        path = cgroup_root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    assert cgroup_cpu_limit(cgroup_root) == limit
+    assert 1 <= available_cpus(cgroup_root) <= (limit or os.cpu_count())
+    shutil.rmtree(cgroup_root)
+
+
+def test_plan_size_and_disk_usage():
+    tempdir = Path(tempfile.mkdtemp())
+    Path(tempdir, "sub").mkdir()
+    Path(tempdir, "sub", "file").write_bytes(b"x" * 10000)
+    Path(tempdir, "small").write_bytes(b"x" * 10)
+    assert plan_size(tempdir, copy_plan(tempdir)) == 10010
+    assert plan_file_sizes(tempdir, copy_plan(tempdir)) == {
+        "small": 10, os.path.join("sub", "file"): 10000}
+    usage = directory_disk_usage(tempdir)
+    assert usage >= 10010
+    # Hardlinked files do not use extra disk space.
+    os.link(str(tempdir / "sub" / "file"), str(tempdir / "link"))
+    assert directory_disk_usage(tempdir) < usage
+    shutil.rmtree(tempdir)
+
+
+def test_link_outputs():
+    src = Path(tempfile.mkdtemp())
+    dest = Path(tempfile.mkdtemp())
+    for directory in (src, dest):
+        Path(directory, "data").mkdir()
+        Path(directory, "data", "input").write_text("input")
+    Path(src, "data", "output").write_text("output")
+    Path(src, "results", "sub").mkdir(parents=True)
+    Path(src, "log.out").write_text("log")
+    linked = link_outputs(src, dest, exclude=["log.out"])
+    assert sorted(linked) == [os.path.join("data", "output"), "results"]
+    assert Path(dest, "results").is_symlink()
+    assert Path(dest, "data", "output").read_text() == "output"
+    assert not Path(dest, "data", "input").is_symlink()
+    assert not Path(dest, "log.out").exists()
+    shutil.rmtree(src)
+    shutil.rmtree(dest)
+
+
+def test_remove_trees():
+    tempdir = Path(tempfile.mkdtemp())
+    trash = tempdir / "trash"
+    trash.mkdir()
+    directories = [tempdir / "a", tempdir / "b", tempdir / "does_not_exist"]
+    for directory in directories[:2]:
+        Path(directory, "sub", "subsub").mkdir(parents=True)
+        Path(directory, "sub", "subsub", "file").touch()
+        Path(directory, "file").touch()
+        Path(directory, "link").symlink_to(directory / "sub")
+    trashed = move_to_trash(directories, trash)
+    assert trashed == {str(trash / "0_a"): str(tempdir / "a"),
+                       str(trash / "1_b"): str(tempdir / "b")}
+    assert not directories[0].exists()
+    assert remove_trees(trashed, threads=4) == []
+    assert list(trash.iterdir()) == []
+    shutil.rmtree(tempdir)
+
+
+def test_remove_trees_unreadable(monkeypatch):
+    tempdir = Path(tempfile.mkdtemp())
+    Path(tempdir, "unreadable").mkdir()
+    Path(tempdir, "readable").mkdir()
+    scandir = os.scandir
+
+    def unreadable_scandir(path):
+        # shutil.rmtree scans directories by their file descriptor.
+        if isinstance(path, str) and path.endswith("unreadable"):
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", unreadable_scandir)
+    assert remove_trees([tempdir / "unreadable", tempdir / "readable"]) == [
+        str(tempdir / "unreadable")]
+    assert not Path(tempdir, "readable").exists()
+    shutil.rmtree(tempdir)
+
+
+def test_remove_tree_in_background():
+    tempdir = Path(tempfile.mkdtemp())
+    Path(tempdir, "sub").mkdir()
+    Path(tempdir, "sub", "file").touch()
+    remove_tree_in_background(tempdir)
+    for _ in range(100):
+        if not tempdir.exists():
+            break
+        time.sleep(0.05)
+    assert not tempdir.exists()
+
+
 def test_git_root(git_dir):
     assert git_root(git_dir / "test") == str(git_dir)
 
@@ -149,3 +572,16 @@ def test_file_md5sum(hash_file: Path):
     whole_file_md5 = hashlib.md5(hash_file.read_bytes()).hexdigest()  # nosec
     per_line_md5 = file_md5sum(hash_file)
     assert whole_file_md5 == per_line_md5
+
+
+@pytest.mark.parametrize(["nodeid", "group"], [
+    ("test.yml::moo::exit code should be 0@workflow:moo", "moo"),
+    ("test_moo.py::test_moo[moo]@workflow:moo", "moo"),
+    ("test_moo.py::test_moo[a@b]", None),
+])
+def test_workflow_group_from_nodeid(nodeid, group):
+    assert workflow_group_from_nodeid(nodeid) == group
+
+
+def test_xdist_worker_index():
+    assert xdist_worker_index("gw12") == 12
@@ -15,10 +15,14 @@
 # along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
 
 """Tests the Workflow class"""
+import signal
 import subprocess  # nosec. This is just for the Timeout exception.
+import threading
+import time
 
 import pytest
 
+from pytest_workflow.executors import LocalExecutor, LocalJob
 from pytest_workflow.workflow import Workflow
 
 
@@ -96,3 +100,98 @@ def test_workflow_name():
 def test_workflow_name_inferred():
     workflow = Workflow("echo moo")
     assert workflow.name == "echo"
+
+
+def test_prepare_before_start(tmp_path):
+    cwd = tmp_path / "workflow"
+    workflow = Workflow("ls moo", cwd=cwd,
+                        prepare=lambda: (cwd / "moo").mkdir(parents=True))
+    workflow.run()
+    assert workflow.exit_code == 0
+
+
+def test_prepare_error():
+    def prepare():
+        raise OSError("disk full")
+    workflow = Workflow("echo moo", prepare=prepare)
+    workflow.run()
+    assert str(workflow.errors[0]) == "disk full"
+    # The workflow was not started.
+    with pytest.raises(ValueError):
+        workflow.exit_code
+
+
+def test_cancel():
+    workflow = Workflow("echo moo")
+    workflow.cancel()
+    assert workflow.cancelled
+    # Waiting on a cancelled workflow returns immediately.
+    workflow.wait(timeout_secs=0.1)
+    # A cancelled workflow is never started.
+    workflow.start()
+    with pytest.raises(ValueError):
+        workflow.exit_code
+
+
+def test_wait_notifies_all_waiters():
+    workflow = Workflow("sleep 0.1")
+    waiters = [threading.Thread(target=workflow.wait) for _ in range(100)]
+    for waiter in waiters:
+        waiter.start()
+    workflow.run()
+    for waiter in waiters:
+        waiter.join(timeout=1)
+        assert not waiter.is_alive()
+
+
+def test_cancel_releases_waiters():
+    workflow = Workflow("echo moo")
+    waiter = threading.Thread(target=workflow.wait)
+    waiter.start()
+    workflow.cancel()
+    waiter.join(timeout=1)
+    assert not waiter.is_alive()
+
+
+def test_timeout():
+    workflow = Workflow("sleep 30", timeout=0.1)
+    workflow.run()
+    assert workflow.kill_reason == "it did not finish within 0.1 seconds"
+    assert workflow.failed
+
+
+def test_kill_no_sigkill_after_exit():
+    # The process group of a workflow that exited on SIGTERM may be reused,
+    # so it does not get SIGKILL after the grace period.
+    signals = []
+
+    class RecordingJob(LocalJob):
+        def signal(self, signal_number):
+            signals.append(signal_number)
+            super().signal(signal_number)
+
+    class RecordingExecutor(LocalExecutor):
+        def submit(self, args, cwd, stdout_file, stderr_file):
+            job = super().submit(args, cwd, stdout_file, stderr_file)
+            return RecordingJob(job.popen)
+
+    workflow = Workflow("sleep 30", kill_grace_secs=0.2,
+                        executor=RecordingExecutor())
+    workflow.start()
+    workflow.kill("too slow")
+    workflow.wait(timeout_secs=5)
+    time.sleep(0.5)
+    assert signals == [signal.SIGTERM]
+
+
+def test_kill_escalates_to_sigkill():
+    # The workflow ignores SIGTERM, so it is killed after the grace period.
+    workflow = Workflow("bash -c 'trap \"\" TERM; sleep 30 & wait'",
+                        kill_grace_secs=0.2)
+    workflow.start()
+    time.sleep(0.2)
+    start_time = time.time()
+    workflow.kill("too slow")
+    workflow.wait(timeout_secs=5)
+    assert time.time() - start_time < 2
+    assert workflow.exit_code == -signal.SIGKILL
@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
 
+import tempfile
 import time
+from pathlib import Path
 
 import pytest
 
@@ -45,6 +47,10 @@ def generate_sleep_workflows(number: int, sleep_time: float):
     return [Workflow(f"sleep {sleep_time}") for _ in range(number)]
 
 
+def end_time(workflow: Workflow) -> float:
+    return workflow._start_time + workflow.duration
+
+
 QUEUE_TESTS = [
     (2, 0.1, 1),
     (6, 0.1, 3)
@@ -71,3 +77,201 @@ def test_workflow_queue(workflow_number: int, sleep_time: float, threads: int):
     # If the completion time is longer than (iterations * sleep_time + 1) then
     # the code is probably not threaded properly.
     assert completion_time < (iterations + 1) * sleep_time
+
+
+def test_workflow_queue_prepares_ahead():
+    # The second workflow is prepared while the first one runs.
+    prepare_times = []
+
+    def prepare():
+        prepare_times.append(time.monotonic())
+        time.sleep(0.3)
+
+    workflows = [Workflow("sleep 0.3", prepare=prepare) for _ in range(2)]
+    workflow_queue = WorkflowQueue()
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    workflow_queue.process(1)
+    first, second = sorted(workflows, key=lambda w: w._start_time)
+    assert max(prepare_times) < end_time(first)
+    assert second._start_time >= end_time(first)
+
+
+def test_workflow_queue_disk_budget():
+    # Both workflows fit in the threads, but not in the disk budget. So they
+    # run one after the other.
+    workflows = [Workflow("sleep 0.3", cwd=Path(tempfile.mkdtemp()),
+                          estimate_disk=lambda: 1000)
+                 for _ in range(2)]
+    workflow_queue = WorkflowQueue(disk_budget=1500,
+                                   check_interval_secs=0.05)
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    start_time = time.time()
+    workflow_queue.process(2)
+    completion_time = time.time() - start_time
+    assert completion_time > 0.6
+    assert [workflow.disk_estimate for workflow in workflows] == [1000, 1000]
+    assert workflows[0].disk_usage == 0
+
+
+def test_workflow_queue_disk_monitor_backs_off(monkeypatch):
+    # Measuring takes 0.1 seconds, so the disk usage is measured about once
+    # per second rather than every 0.01 seconds.
+    measurements = []
+
+    def slow_disk_usage(directory):
+        measurements.append(directory)
+        time.sleep(0.1)
+        return 0
+
+    monkeypatch.setattr("pytest_workflow.workflow.directory_disk_usage",
+                        slow_disk_usage)
+    workflow = Workflow("sleep 1.5", cwd=Path(tempfile.mkdtemp()),
+                        estimate_disk=lambda: 1000)
+    workflow_queue = WorkflowQueue(disk_budget=2000,
+                                   check_interval_secs=0.01)
+    workflow_queue.put(workflow)
+    workflow_queue.process(1)
+    assert 1 <= len(measurements) <= 3
+
+
+def test_workflow_queue_disk_budget_fits():
+    workflows = [Workflow("sleep 0.3", cwd=Path(tempfile.mkdtemp()),
+                          estimate_disk=lambda: 1000)
+                 for _ in range(2)]
+    workflow_queue = WorkflowQueue(disk_budget=2000)
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    start_time = time.time()
+    workflow_queue.process(2)
+    assert time.time() - start_time < 0.6
+
+
+def test_workflow_queue_max_disk():
+    workflow = Workflow(
+        "bash -c 'head -c 100000 /dev/zero > out.bin && sleep 10'",
+        cwd=Path(tempfile.mkdtemp()), max_disk=1000)
+    workflow_queue = WorkflowQueue(check_interval_secs=0.05)
+    workflow_queue.put(workflow)
+    start_time = time.time()
+    workflow_queue.process(1)
+    assert time.time() - start_time < 5
+    assert workflow.exit_code != 0
+    assert "more than the maximum of 1000 bytes" in workflow.kill_reason
+
+
+def test_workflow_queue_cpus():
+    # Only two workflows of two cpus fit in four cpus.
+    workflows = [Workflow("sleep 0.3", cpus=2) for _ in range(3)]
+    workflow_queue = WorkflowQueue(cpus=4)
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    workflow_queue.process(None)
+    first, second, third = sorted(workflows, key=lambda w: w._start_time)
+    assert second._start_time < end_time(first)
+    assert third._start_time >= min(end_time(first), end_time(second))
+
+
+def test_workflow_queue_backfill():
+    # The large workflow does not fit next to the first small workflow. The
+    # second small workflow is started in the meantime.
+    workflows = [Workflow("sleep 0.3", cpus=1),
+                 Workflow("sleep 0.3", cpus=4),
+                 Workflow("sleep 0.3", cpus=1)]
+    workflow_queue = WorkflowQueue(cpus=4)
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    workflow_queue.process(None)
+    small, large, backfilled = workflows
+    assert backfilled._start_time < end_time(small)
+    assert large._start_time >= max(end_time(small), end_time(backfilled))
+
+
+@pytest.mark.parametrize(["load", "overlap"], [(0.0, True), (8.0, False)])
+def test_workflow_queue_max_load(load, overlap, monkeypatch):
+    # On a saturated host the workflows are run one at a time.
+    monkeypatch.setattr("pytest_workflow.workflow.load_average",
+                        lambda: load)
+    workflows = [Workflow("sleep 0.3") for _ in range(2)]
+    workflow_queue = WorkflowQueue(max_load=4, check_interval_secs=0.05)
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    workflow_queue.process(None)
+    first, second = sorted(workflows, key=lambda w: w._start_time)
+    assert (second._start_time < end_time(first)) is overlap
+
+
+def test_workflow_queue_memory_larger_than_budget():
+    # A workflow that requests more than the budget still runs on its own.
+    workflows = [Workflow("sleep 0.1", memory=2000) for _ in range(2)]
+    workflow_queue = WorkflowQueue(memory=1000)
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    start_time = time.time()
+    workflow_queue.process(None)
+    assert 0.2 < time.time() - start_time < 0.5
+    assert all(workflow.exit_code == 0 for workflow in workflows)
+
+
+def test_workflow_queue_longest_first():
+    workflows = [Workflow("sleep 0.1", name="short"),
+                 Workflow("sleep 0.1", name="unknown"),
+                 Workflow("sleep 0.1", name="long")]
+    workflows[0].expected_duration = 1.0
+    workflows[2].expected_duration = 10.0
+    workflow_queue = WorkflowQueue()
+    for workflow in workflows:
+        workflow_queue.put(workflow)
+    workflow_queue.process(1)
+    start_order = sorted(workflows,
+                         key=lambda workflow: workflow._start_time)
+    assert [workflow.name for workflow in start_order] == [
+        "unknown", "long", "short"]
+    assert all(0.1 < workflow.duration < 0.5 for workflow in workflows)
+
+
+def test_workflow_queue_dependencies():
+    index = Workflow("sleep 0.3", name="index")
+    align = Workflow("sleep 0.1", name="align", depends_on=["index"])
+    align.dependencies = [index]
+    workflow_queue = WorkflowQueue()
+    # The dependent workflow is queued first.
+    workflow_queue.put(align)
+    workflow_queue.put(index)
+    workflow_queue.process(2)
+    assert align._start_time >= index._start_time + index.duration
+    assert not align.failed
+
+
+def test_workflow_queue_failed_dependency():
+    index = Workflow("bash -c 'exit 1'", name="index")
+    align = Workflow("echo align", name="align", depends_on=["index"])
+    align.dependencies = [index]
+    call = Workflow("echo call", name="call", depends_on=["align"])
+    call.dependencies = [align]
+    workflow_queue = WorkflowQueue()
+    for workflow in (call, align, index):
+        workflow_queue.put(workflow)
+    workflow_queue.process(1)
+    assert align.cancelled
+    assert align.skip_reason == ("'align' was skipped because its "
+                                 "dependency 'index' did not succeed")
+    assert call.skip_reason == ("'call' was skipped because its "
+                                "dependency 'align' did not succeed")
+
+
+@pytest.mark.parametrize(["max_failures", "stopped"], [(1, True), (2, False)])
+def test_workflow_queue_max_failures(max_failures, stopped):
+    failing = Workflow("bash -c 'sleep 0.2 && exit 1'")
+    running = Workflow("sleep 1")
+    waiting = Workflow("echo moo")
+    workflow_queue = WorkflowQueue(max_failures=max_failures)
+    for workflow in (failing, running, waiting):
+        workflow_queue.put(workflow)
+    workflow_queue.process(2)
+    assert (running.kill_reason == "'bash' failed") is stopped
+    assert waiting.cancelled is stopped
+    if stopped:
+        assert (waiting.skip_reason ==
+                "'echo' was skipped because 'bash' failed")
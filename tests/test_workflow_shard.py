@@ -0,0 +1,122 @@
+# Copyright (C) 2018 Leiden University Medical Center
+# This file is part of pytest-workflow
+#
+# pytest-workflow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# pytest-workflow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+
+"""Tests dividing workflows over shards with --workflow-shard"""
+
+import json
+import textwrap
+from pathlib import Path
+
+from pytest_workflow.plugin import shard_workflows
+from pytest_workflow.workflow import Workflow
+
+WORKFLOWS = textwrap.dedent("""\
+    - name: one
+      command: bash -c 'echo one >> {runs}'
+    - name: two
+      command: bash -c 'echo two >> {runs}'
+    - name: three
+      command: bash -c 'echo three >> {runs}'
+      depends_on:
+        - one
+    - name: four
+      command: bash -c 'echo four >> {runs}'
+    """)
+
+CUSTOM_TESTS = textwrap.dedent("""\
+    import pytest
+
+    @pytest.mark.workflow("two")
+    def test_two(workflow_dir):
+        pass
+    """)
+
+
+def test_workflow_shards_run_each_workflow_once(testdir):
+    runs = testdir.tmpdir / "runs.txt"
+    testdir.makefile(".yml", test=WORKFLOWS.format(runs=runs))
+    testdir.makefile(".py", test_custom=CUSTOM_TESTS)
+    for index in (1, 2):
+        result = testdir.runpytest("-v", "-rs", "--workflow-shard",
+                                   f"{index}/2")
+        assert result.ret == 0
+    assert sorted(runs.read().split()) == ["four", "one", "three", "two"]
+
+
+def test_workflow_shard_skips_custom_tests(testdir):
+    runs = testdir.tmpdir / "runs.txt"
+    testdir.makefile(".yml", test=WORKFLOWS.format(runs=runs))
+    testdir.makefile(".py", test_custom=CUSTOM_TESTS)
+    # With durations for all workflows the shards are predictable.
+    durations = Path(str(testdir.tmpdir), "durations.json")
+    durations.write_text(json.dumps(
+        {"one": 1.0, "two": 5.0, "three": 1.0, "four": 1.0}))
+    result = testdir.runpytest("-v", "-rs", "--workflow-shard", "2/2",
+                               "--workflow-durations", str(durations))
+    result.assert_outcomes(passed=3, skipped=1)
+    assert "'two' has not run." in result.stdout.str()
+    assert sorted(runs.read().split()) == ["four", "one", "three"]
+
+
+def test_workflow_shard_ignores_cache(testdir):
+    # The cache differs between machines, so it does not change the shards.
+    runs = testdir.tmpdir / "runs.txt"
+    testdir.makefile(".yml", test=WORKFLOWS.format(runs=runs))
+    durations = Path(str(testdir.tmpdir), ".pytest_cache", "v",
+                     "pytest_workflow", "durations")
+    durations.parent.mkdir(parents=True)
+    durations.write_text(json.dumps(
+        {"one": 5.0, "two": 1.0, "three": 1.0, "four": 1.0}))
+    result = testdir.runpytest("-v", "--workflow-shard", "2/2")
+    assert result.ret == 0
+    workflows = {name: Workflow(f"echo {name}", name=name,
+                                depends_on=["one"] if name == "three" else [])
+                 for name in ("one", "two", "three", "four")}
+    expected = sorted(name for name, shard in
+                      shard_workflows(workflows, {}, 2).items() if shard == 2)
+    assert sorted(runs.read().split()) == expected
+
+
+def test_shard_workflows_by_duration():
+    workflows = {
+        "index": Workflow("echo index", name="index"),
+        "align": Workflow("echo align", name="align", depends_on=["index"]),
+        "other": Workflow("echo other", name="other"),
+        "small": Workflow("echo small", name="small"),
+    }
+    durations = {"index": 2.0, "align": 2.0, "other": 3.0, "small": 1.0}
+    assert shard_workflows(workflows, durations, 2) == {
+        "index": 1, "align": 1, "other": 2, "small": 2}
+
+
+def test_shard_workflows_without_durations_is_stable():
+    workflows = {name: Workflow(f"echo {name}", name=name)
+                 for name in ("a", "b", "c", "d", "e")}
+    shards = shard_workflows(workflows, {}, 3)
+    assert set(shards) == set(workflows)
+    assert all(1 <= shard <= 3 for shard in shards.values())
+    reversed_workflows = dict(reversed(list(workflows.items())))
+    assert shard_workflows(reversed_workflows, {}, 3) == shards
+
+
+def test_shard_workflows_with_some_durations_is_stable():
+    # Machines that know the durations of different workflows divide them in
+    # the same way.
+    workflows = {name: Workflow(f"echo {name}", name=name)
+                 for name in ("a", "b", "c", "d", "e")}
+    shards = shard_workflows(workflows, {}, 3)
+    assert shard_workflows(workflows, {"a": 10.0, "b": 1.0}, 3) == shards
+    assert shard_workflows(workflows, {"c": 5.0}, 3) == shards
@@ -0,0 +1,101 @@
+# Copyright (C) 2018 Leiden University Medical Center
+# This file is part of pytest-workflow
+#
+# pytest-workflow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# pytest-workflow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pytest-workflow.  If not, see <https://www.gnu.org/licenses/
+
+"""Tests running workflows with pytest-xdist"""
+
+import textwrap
+
+import pytest
+
+from pytest_workflow.plugin import workflow_groups
+from pytest_workflow.workflow import Workflow
+
+pytest.importorskip("xdist")
+
+WORKFLOWS = textwrap.dedent("""\
+    - name: one
+      command: bash -c 'echo $PYTEST_XDIST_WORKER > worker.txt && echo one >> {runs}'
+    - name: two
+      command: bash -c 'echo $PYTEST_XDIST_WORKER > worker.txt && echo two >> {runs}'
+    - name: three
+      command: bash -c 'echo $PYTEST_XDIST_WORKER > worker.txt && echo three >> {runs}'
+      depends_on:
+        - one
+    """)  # noqa: E501
+
+CUSTOM_TESTS = textwrap.dedent("""\
+    import os
+
+    import pytest
+
+    @pytest.mark.workflow("two")
+    def test_same_worker(workflow_dir):
+        worker = (workflow_dir / "worker.txt").read_text().strip()
+        assert worker == os.environ["PYTEST_XDIST_WORKER"]
+    """)
+
+
+def test_xdist_runs_each_workflow_once(testdir):
+    runs = testdir.tmpdir / "runs.txt"
+    testdir.makefile(".yml", test=WORKFLOWS.format(runs=runs))
+    testdir.makefile(".py", test_custom=CUSTOM_TESTS)
+    result = testdir.runpytest("-v", "-n", "2")
+    result.assert_outcomes(passed=4)
+    assert sorted(runs.read().split()) == ["one", "three", "two"]
+
+
+@pytest.mark.parametrize("dist", ["loadfile", "loadscope"])
+def test_xdist_dist_modes_run_each_workflow_once(testdir, dist):
+    runs = testdir.tmpdir / "runs.txt"
+    testdir.makefile(".yml", test=WORKFLOWS.format(runs=runs))
+    testdir.makefile(".py", test_custom=CUSTOM_TESTS)
+    result = testdir.runpytest("-v", "-n", "2", "--dist", dist)
+    result.assert_outcomes(passed=4)
+    assert sorted(runs.read().split()) == ["one", "three", "two"]
+
+
+def test_xdist_single_tests_and_workflow(testdir):
+    testdir.makefile(".yml", test=WORKFLOWS.format(
+        runs=testdir.tmpdir / "runs.txt"))
+    testdir.makefile(".py", test_plain=textwrap.dedent("""\
+        def test_one():
+            pass
+
+        def test_two():
+            pass
+        """))
+    result = testdir.runpytest("-v", "-n", "2", "-k", "plain or two")
+    result.assert_outcomes(passed=3)
+
+
+def test_xdist_worker_without_workflows(testdir):
+    runs = testdir.tmpdir / "runs.txt"
+    testdir.makefile(".yml", test=WORKFLOWS.format(runs=runs))
+    result = testdir.runpytest("-v", "-n", "2", "-k", "two")
+    result.assert_outcomes(passed=1)
+    assert runs.read().split() == ["two"]
+
+
+def test_workflow_groups():
+    workflows = {
+        "index": Workflow("echo index", name="index"),
+        "align": Workflow("echo align", name="align", depends_on=["index"]),
+        "other": Workflow("echo other", name="other"),
+        "call": Workflow("echo call", name="call", depends_on=["align"]),
+    }
+    assert workflow_groups(workflows) == {
+        "index": "index", "align": "index", "other": "other",
+        "call": "index"}